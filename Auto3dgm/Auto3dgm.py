@@ -1,5 +1,7 @@
+import json
 import os
 import shutil
+import tempfile
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
@@ -7,13 +9,27 @@ import logging
 
 import auto3dgm_nazar
 from auto3dgm_nazar.mesh.meshexport import MeshExport
-from auto3dgm_nazar.analysis.correspondence import Correspondence
 from auto3dgm_nazar.mesh.subsample import Subsample
-from auto3dgm_nazar.dataset.datasetfactory import DatasetFactory
 from auto3dgm_nazar.mesh.meshfactory import MeshFactory
 
 import numpy as np
 
+from Auto3dgmLib.cache import SubsampleCache, meshDigest, subsampleKey
+from Auto3dgmLib.correspondence import KERNELS, correspondenceFromPairs
+from Auto3dgmLib.display import AlignedMeshDisplay
+from Auto3dgmLib.engine import alignAllPairs, checkpointStatus, convergenceStats
+from Auto3dgmLib.fps import ENGINE_VERSION as FPS_ENGINE_VERSION, furthestPointIndices, mapOrdered, nestedSubsamples, sampledIndices
+from Auto3dgmLib.export import LANDMARK_FORMATS, PLY_FORMATS, alignedLandmarks, exportLandmarks, exportMeshes, writeLandmarkArchive
+from Auto3dgmLib.instrument import Instrumentation, stage
+from Auto3dgmLib.jobs import BackgroundJob
+from Auto3dgmLib.meshcache import MeshArrayCache, cachedArrays, loadMeshArrays
+from Auto3dgmLib.neighbors import candidatePairs
+from Auto3dgmLib.pairstore import pointsDigest
+from Auto3dgmLib.parallel import defaultWorkerCount
+from Auto3dgmLib.project import Project, isProject, writeProject
+from Auto3dgmLib.streaming import MeshFile, StreamedMeshes, meshFiles
+from Auto3dgmLib.viewer import DEFAULT_VIEWER_FACES, buildViewerAssets, showViewerAssets
+
 #import web_view_mesh
 
 #
@@ -59,7 +75,43 @@ class Auto3dgmData():
     self.datasetCollection = None
     self.phase1SampledPoints = None
     self.phase2SampledPoints = None
+    # Point numbers of phases 3, 4, ... after the first two
+    self.refinementPoints = []
+    # Start every phase after the first from the previous phase's rotations
+    self.progressive = False
+    # Align each mesh only with this many nearest meshes by shape descriptor,
+    # 0 aligns all pairs
+    self.neighbors = 0
+    self.fpsSeed = None
+    # 'dense' or 'kdtree' (Auto3dgmLib.fps), both give the same samples
+    self.fpsMethod = 'kdtree'
+    self.subsampleMethod = 'FPS'
+    # GPL points of the FPS/GPL hybrid, None for the library default
+    self.hybridPoints = None
+    self.subsampleCache = None
+    self.subsampleCacheReport = None
+    self.pairStoreFolder = None
+    self.checkpointFolder = None
+    self.resume = True
+    self.landmarkFormat = 'csv'
+    # Aligned meshes as full precision 'ascii' or float32 'binary' PLY
+    self.meshFormat = 'ascii'
+    self.inputFolder = None
+    self.runParameters = {}
+    self.instrumentation = None
+    self.pairTimings = False
     self.aligned_meshes = []
+    self.meshDisplay = None
+    # locgpd iteration limit and relative improvement below which a pair stops
+    self.maxIterations = 1000
+    self.convergenceTolerance = 0.0
+    # {phase: engine.convergenceStats} of the last alignment of each phase
+    self.convergence = {}
+    # Refine both handedness of every pair fully instead of pruning
+    self.exhaustiveMirror = True
+    # 'library' aligns pairs with auto3dgm_nazar, 'native' with the faster
+    # batched kernel of Auto3dgmLib.correspondence
+    self.alignmentKernel = 'library'
 #
 # Auto3dgmWidget
 #
@@ -80,9 +132,15 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     self.Auto3dgmData = Auto3dgmData()
     self.webWidget = None
     self.serverNode = None
+    self.job = None
+    self.jobFinished = None
+    self.jobTimer = qt.QTimer()
+    self.jobTimer.setInterval(200)
+    self.jobTimer.connect('timeout()', self.pollJob)
 
     # Instantiate and connect widgets ...
     tabsWidget = qt.QTabWidget()
+    self.tabsWidget = tabsWidget
     setupTab = qt.QWidget()
     setupTabLayout = qt.QFormLayout(setupTab)
     
@@ -127,6 +185,31 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     inputfolderLayout.addRow(self.outputFolderButton)
     self.LMbutton.connect('clicked(bool)', self.selectMeshFolder)
 
+    self.streamCheckBox = qt.QCheckBox("Stream meshes from disk")
+    self.streamCheckBox.checked = 0
+    self.streamCheckBox.setToolTip("Keep only file names in memory and load full meshes when they are subsampled or exported. Use for large datasets that do not fit in memory.")
+    inputfolderLayout.addRow(self.streamCheckBox)
+
+    self.meshCacheCheckBox = qt.QCheckBox("Cache parsed meshes")
+    self.meshCacheCheckBox.checked = 1
+    self.meshCacheCheckBox.setToolTip("Keep parsed meshes in a binary cache and read unchanged files back from it on later loads.")
+    inputfolderLayout.addRow(self.meshCacheCheckBox)
+
+    projectWidget = ctk.ctkCollapsibleButton()
+    projectLayout = qt.QFormLayout(projectWidget)
+    projectWidget.text = "Project"
+    setupTabLayout.addRow(projectWidget)
+
+    self.openProjectButton = qt.QPushButton("Open project")
+    self.openProjectButton.toolTip = "Open the subsamples and alignments of a saved analysis, without recomputing them."
+    self.openProjectButton.connect('clicked(bool)', self.openProjectButtonOnLoad)
+    projectLayout.addRow(self.openProjectButton)
+
+    self.saveProjectButton = qt.QPushButton("Save project")
+    self.saveProjectButton.toolTip = "Save subsamples, alignments and parameters to the project folder in the output folder."
+    self.saveProjectButton.connect('clicked(bool)', self.saveProjectButtonOnLoad)
+    projectLayout.addRow(self.saveProjectButton)
+
     self.parameterWidget = ctk.ctkCollapsibleButton()
     self.parameterLayout = qt.QFormLayout(self.parameterWidget)
     self.parameterWidget.text = "Parameters"
@@ -141,14 +224,35 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     self.maxIterSliderWidget.setToolTip("Maximum possible number of iterations for pairwise alignment optimization.")
     self.parameterLayout.addRow("Maximum iterations", self.maxIterSliderWidget)
 
+    self.toleranceSpinBox = qt.QDoubleSpinBox()
+    self.toleranceSpinBox.setDecimals(6)
+    self.toleranceSpinBox.setMinimum(0.0)
+    self.toleranceSpinBox.setMaximum(0.1)
+    self.toleranceSpinBox.setSingleStep(0.0001)
+    self.toleranceSpinBox.setSpecialValueText("Until matching is stable")
+    self.toleranceSpinBox.setToolTip("Stop a pair's alignment once an iteration improves its distance by less than this fraction. 0 iterates until the point matching no longer changes.")
+    self.parameterLayout.addRow("Convergence tolerance", self.toleranceSpinBox)
+
     self.reflectionCheckBox = qt.QCheckBox()
     self.reflectionCheckBox.checked = 0
     self.reflectionCheckBox.setToolTip("Whether meshes can be reflected/mirrored to achieve more optimal alignments.")
     self.parameterLayout.addRow("Allow reflection", self.reflectionCheckBox)
 
+    self.exhaustiveMirrorCheckBox = qt.QCheckBox()
+    self.exhaustiveMirrorCheckBox.checked = 1
+    self.exhaustiveMirrorCheckBox.setToolTip("Refine reflected and unreflected alignments of every pair fully. Unchecked, a clearly worse handedness is dropped after a few iterations, which is faster but may change the alignment of a pair.")
+    self.parameterLayout.addRow("Exhaustive reflection search", self.exhaustiveMirrorCheckBox)
+
+    self.kernelComboBox = qt.QComboBox()
+    self.kernelComboBox.addItem("auto3dgm_nazar")
+    self.kernelComboBox.addItem("Native batched")
+    self.kernelComboBox.setToolTip("auto3dgm_nazar aligns every pair with the library's Correspondence. Native batched is faster and needed for progressive refinement, iteration limits, tolerances and reflection pruning, but is only checked against the library by its tests.")
+    self.parameterLayout.addRow("Alignment kernel", self.kernelComboBox)
+
     self.parallelizationCheckBox = qt.QCheckBox()
     self.parallelizationCheckBox.checked = 0
     self.parallelizationCheckBox.setToolTip("Whether meshes should be processed in parallel.")
+    self.parallelizationCheckBox.connect('toggled(bool)', self.onParallelizationToggled)
     self.parameterLayout.addRow("Allow parallelization", self.parallelizationCheckBox)
 
     self.subsampleComboBox = qt.QComboBox()
@@ -167,6 +271,11 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     self.hybridPoints.setMaximum(1000)
     self.parameterLayout.addRow("Hybrid GPL Points", self.hybridPoints)
 
+    self.subsampleCacheCheckBox = qt.QCheckBox()
+    self.subsampleCacheCheckBox.checked = 1
+    self.subsampleCacheCheckBox.setToolTip("Reuse subsampled points from earlier runs when mesh, method, point number and seed are unchanged. Runs without a seed are not cached.")
+    self.parameterLayout.addRow("Cache subsamples", self.subsampleCacheCheckBox)
+
     self.phaseChoiceComboBox = qt.QComboBox()
     self.phaseChoiceComboBox.addItem("1 (Single Alignment Pass)")
     self.phaseChoiceComboBox.addItem("2 (Double Alignment Pass)")
@@ -185,12 +294,78 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     self.phase2PointNumber.setValue(1000)
     self.parameterLayout.addRow("Phase 2 Points", self.phase2PointNumber)
 
+    self.refinementPointsText = qt.QLineEdit()
+    self.refinementPointsText.setPlaceholderText("e.g. 4000, 16000")
+    self.refinementPointsText.setToolTip("Point numbers of further phases after phase 2, separated by commas. Run them with 'Refinement phases' or 'Run all steps'.")
+    self.parameterLayout.addRow("Refinement Points", self.refinementPointsText)
+    self.refinementPointsText.connect('textChanged(QString)', lambda text: self.updateProfileStages())
+
+    self.progressiveCheckBox = qt.QCheckBox()
+    self.progressiveCheckBox.checked = 0
+    self.progressiveCheckBox.setToolTip("Start every phase after the first from the previous phase's pairwise rotations and only refine them locally, instead of searching all initial alignments again. Makes high point numbers much cheaper.")
+    self.parameterLayout.addRow("Progressive refinement", self.progressiveCheckBox)
+
+    self.neighborsSpinBox = qt.QSpinBox()
+    self.neighborsSpinBox.setMinimum(0)
+    self.neighborsSpinBox.setMaximum(10000)
+    self.neighborsSpinBox.setSpecialValueText("All pairs")
+    self.neighborsSpinBox.setToolTip("Align each mesh only with this many meshes of most similar shape descriptor (D2 histogram and principal moments), plus the pairs needed to keep all meshes connected. Cost grows with meshes times neighbors instead of meshes squared.")
+    self.parameterLayout.addRow("Nearest neighbors", self.neighborsSpinBox)
+
     self.processingComboBox = qt.QComboBox()
     self.processingComboBox.addItem("Local Single CPU Core")
     self.processingComboBox.addItem("Local Multiple CPU Cores")
     self.processingComboBox.addItem("Cluster/Grid")
+    self.processingComboBox.connect('currentIndexChanged(int)', self.onProcessingChanged)
     self.parameterLayout.addRow("Processing", self.processingComboBox)
 
+    self.workerCountSpinBox = qt.QSpinBox()
+    self.workerCountSpinBox.setMinimum(1)
+    self.workerCountSpinBox.setMaximum(256)
+    self.workerCountSpinBox.setValue(defaultWorkerCount())
+    self.workerCountSpinBox.setToolTip("Number of worker processes used for pairwise alignment when processing on multiple CPU cores or through the Cluster/Grid spool.")
+    self.workerCountSpinBox.enabled = False
+    self.parameterLayout.addRow("Worker processes", self.workerCountSpinBox)
+
+    self.pairStoreCheckBox = qt.QCheckBox()
+    self.pairStoreCheckBox.checked = 1
+    self.pairStoreCheckBox.setToolTip("Keep pairwise alignments in the output folder and only align pairs involving new or changed meshes on later runs.")
+    self.parameterLayout.addRow("Reuse pairwise results", self.pairStoreCheckBox)
+
+    self.landmarkFormatComboBox = qt.QComboBox()
+    self.landmarkFormatComboBox.addItem("CSV (one file per specimen)")
+    self.landmarkFormatComboBox.addItem("NPY (one array per phase)")
+    self.landmarkFormatComboBox.addItem("HDF5 (one file per phase)")
+    self.landmarkFormatComboBox.setToolTip("NPY and HDF5 write all aligned landmarks of a phase as one (specimens, points, 3) array, with the rotations, landmark vertex indices and specimen names next to it.")
+    self.parameterLayout.addRow("Landmark output", self.landmarkFormatComboBox)
+
+    self.meshFormatComboBox = qt.QComboBox()
+    self.meshFormatComboBox.addItem("ASCII PLY (full precision)")
+    self.meshFormatComboBox.addItem("Binary PLY (float32)")
+    self.meshFormatComboBox.setToolTip("Binary PLY files are smaller and faster to write, with vertex coordinates rounded to single precision.")
+    self.parameterLayout.addRow("Mesh output", self.meshFormatComboBox)
+
+  # The parallelization check box and the processing combo box describe the
+  # same choice, keep them in sync.
+  def onParallelizationToggled(self, checked):
+    if checked and self.processingComboBox.currentIndex == 0:
+      self.processingComboBox.setCurrentIndex(1)
+    elif not checked and self.processingComboBox.currentIndex != 0:
+      self.processingComboBox.setCurrentIndex(0)
+
+  def onProcessingChanged(self, index):
+    self.parallelizationCheckBox.checked = index != 0
+    self.workerCountSpinBox.enabled = index != 0
+
+  def processingMode(self):
+    return ['single', 'multicore', 'cluster'][self.processingComboBox.currentIndex]
+
+  def clusterFolder(self, phase = None):
+    if not self.outputFolder:
+      return None
+    folder = os.path.join(self.outputFolder, 'cluster')
+    return os.path.join(folder, 'phase' + str(phase)) if phase else folder
+
   def selectMeshFolder(self):
       self.meshFolder=qt.QFileDialog().getExistingDirectory()
       self.meshInputText.setText(self.meshFolder)
@@ -202,10 +377,62 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
   def selectOutputFolder(self):
     self.outputFolder=qt.QFileDialog().getExistingDirectory()
     self.meshOutputText.setText(self.outputFolder)
+    self.updateCheckpointStatus()
+
+  def openProjectButtonOnLoad(self):
+    folder = qt.QFileDialog().getExistingDirectory()
+    if not folder:
+      return
+    if not isProject(folder):
+      slicer.util.errorDisplay(folder + " is not an Auto3dgm project folder.")
+      return
+    meshCache = MeshArrayCache(Auto3dgmLogic.cacheFolder('meshes')) if self.meshCacheCheckBox.checked else None
+    prefetch = self.workerCountSpinBox.value
+    instrumentation = self.Auto3dgmData.instrumentation
+    def run(job):
+      return Auto3dgmLogic.loadProject(folder, meshCache, prefetch, instrumentation)
+    def finished(data):
+      self.Auto3dgmData = data
+      self.meshFolder = data.inputFolder
+      self.meshInputText.setText(data.inputFolder or "")
+      if data.phase1SampledPoints:
+        self.phase1PointNumber.setValue(data.phase1SampledPoints)
+      if data.phase2SampledPoints:
+        self.phase2PointNumber.setValue(data.phase2SampledPoints)
+      self.refinementPointsText.setText(", ".join(str(points) for points in data.refinementPoints))
+      self.progressiveCheckBox.checked = bool(data.progressive)
+      self.neighborsSpinBox.setValue(data.neighbors or 0)
+      self.maxIterSliderWidget.value = data.maxIterations
+      self.toleranceSpinBox.setValue(data.convergenceTolerance)
+      self.exhaustiveMirrorCheckBox.checked = bool(data.exhaustiveMirror)
+      self.kernelComboBox.setCurrentIndex(KERNELS.index(data.alignmentKernel))
+      self.reflectionCheckBox.checked = bool(data.runParameters.get('mirror', False))
+      if not self.outputFolder:
+        self.outputFolder = os.path.dirname(os.path.normpath(folder))
+        self.meshOutputText.setText(self.outputFolder)
+      self.setRunButtonsEnabled(True)
+      self.tabsWidget.setCurrentIndex(2)
+    self.startJob("Open project", run, finished)
+
+  def saveProjectButtonOnLoad(self):
+    if self.Auto3dgmData.datasetCollection is None or not self.outputFolder:
+      slicer.util.errorDisplay("Load data and choose an output folder before saving a project.")
+      return
+    folder = os.path.join(self.outputFolder, 'project')
+    parameters = {'mirror': self.reflectionCheckBox.checked}
+    def run(job):
+      Auto3dgmLogic.saveProject(self.Auto3dgmData, folder, parameters)
+    self.startJob("Save project", run)
 
   def onLoad(self):
-    self.Auto3dgmData.datasetCollection=Auto3dgmLogic.createDataset(self.meshFolder)
+    meshCache = MeshArrayCache(Auto3dgmLogic.cacheFolder('meshes')) if self.meshCacheCheckBox.checked else None
+    self.Auto3dgmData.inputFolder = self.meshFolder
+    self.storeInstrumentationParameters()
+    self.Auto3dgmData.datasetCollection=Auto3dgmLogic.createDataset(self.meshFolder, stream=self.streamCheckBox.checked,
+      prefetch=self.workerCountSpinBox.value, workers=self.workerCountSpinBox.value, meshCache=meshCache,
+      instrumentation=self.Auto3dgmData.instrumentation)
     print(self.Auto3dgmData.datasetCollection)
+    self.updateStageTable()
     try:
       self.subStepButton.enabled = bool(self.meshFolder)
     except AttributeError:
@@ -246,42 +473,291 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     self.phase2StepButton.connect('clicked(bool)', self.phase2StepButtonOnLoad)
     self.singleStepGroupBoxLayout.addWidget(self.phase2StepButton)
 
+    self.refineStepButton = qt.QPushButton("Refinement phases")
+    self.refineStepButton.toolTip = "Run the phases after phase 2 listed under Refinement Points, each at a higher resolution than the one before."
+    self.refineStepButton.connect('clicked(bool)', self.refineStepButtonOnLoad)
+    self.singleStepGroupBoxLayout.addWidget(self.refineStepButton)
+
+    self.exportButton = qt.QPushButton("Export results")
+    self.exportButton.toolTip = "Export aligned meshes and landmarks of the computed phases again, e.g. after opening a project, without recomputing."
+    self.exportButton.connect('clicked(bool)', self.exportButtonOnLoad)
+    self.singleStepGroupBoxLayout.addWidget(self.exportButton)
+
     self.allStepsButton = qt.QPushButton("Run all steps")
     self.allStepsButton.toolTip = "Run all possible analysis steps and phases."
     self.allStepsButton.connect('clicked(bool)', self.allStepsButtonOnLoad)
     runTabLayout.addRow(self.allStepsButton)
 
+    self.progressGroupBox = qt.QGroupBox("Progress")
+    self.progressGroupBoxLayout = qt.QVBoxLayout()
+    self.progressGroupBox.setLayout(self.progressGroupBoxLayout)
+    runTabLayout.addRow(self.progressGroupBox)
+
+    self.progressLabel = qt.QLabel("Idle")
+    self.progressGroupBoxLayout.addWidget(self.progressLabel)
+
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.setRange(0, 1)
+    self.progressBar.setValue(0)
+    self.progressGroupBoxLayout.addWidget(self.progressBar)
+
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Stop the running step after the current mesh or mesh pair."
+    self.cancelButton.connect('clicked(bool)', self.cancelButtonOnLoad)
+    self.cancelButton.enabled = False
+    self.progressGroupBoxLayout.addWidget(self.cancelButton)
+
+    self.resumeCheckBox = qt.QCheckBox("Resume interrupted runs")
+    self.resumeCheckBox.checked = 1
+    self.resumeCheckBox.toolTip = "Skip mesh pairs already checkpointed in the output folder by an interrupted run with the same inputs and parameters."
+    self.resumeCheckBox.connect('toggled(bool)', lambda checked: self.updateCheckpointStatus())
+    self.progressGroupBoxLayout.addWidget(self.resumeCheckBox)
+
+    self.checkpointLabel = qt.QLabel("No checkpoint")
+    self.progressGroupBoxLayout.addWidget(self.checkpointLabel)
+
+    self.stageGroupBox = qt.QGroupBox("Stage timings")
+    self.stageGroupBoxLayout = qt.QFormLayout()
+    self.stageGroupBox.setLayout(self.stageGroupBoxLayout)
+    runTabLayout.addRow(self.stageGroupBox)
+
+    self.stageTable = qt.QTableWidget(0, 5)
+    self.stageTable.setHorizontalHeaderLabels(["Stage", "Wall (s)", "CPU (s)", "Stage memory (MB)", "Counts"])
+    self.stageTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.stageTable.toolTip = "Stages run since the data was loaded. Every stage is also logged to instrumentation.jsonl in the output folder."
+    self.stageGroupBoxLayout.addRow(self.stageTable)
+
+    self.pairTimingCheckBox = qt.QCheckBox()
+    self.pairTimingCheckBox.checked = 0
+    self.pairTimingCheckBox.toolTip = "Time every mesh pair and log a histogram of pair alignment times."
+    self.stageGroupBoxLayout.addRow("Time every pair", self.pairTimingCheckBox)
+
+    self.profileStageComboBox = qt.QComboBox()
+    self.updateProfileStages()
+    self.profileStageComboBox.toolTip = "Run this stage under cProfile and dump the statistics next to the log. Work done in worker processes is not profiled."
+    self.stageGroupBoxLayout.addRow("Profile stage", self.profileStageComboBox)
+
     runTabLayout.setVerticalSpacing(15)
 
-  def subStepButtonOnLoad(self):
-    print("Mocking a call to the Logic service AL002.1")
+  def setRunButtonsEnabled(self, enabled):
+    for button in [self.phase1StepButton, self.phase2StepButton, self.refineStepButton, self.allStepsButton, self.exportButton, self.openProjectButton, self.saveProjectButton]:
+      button.enabled = enabled
+    self.loadButton.enabled = enabled and bool(self.meshFolder)
+    self.subStepButton.enabled = enabled and self.Auto3dgmData.datasetCollection is not None
+    self.cancelButton.enabled = not enabled
+
+  def startJob(self, name, target, onFinished=None):
+    """Runs target(job) off the GUI thread; onFinished(result) runs on the GUI
+    thread once the job completes successfully."""
+    if self.job is not None and self.job.isRunning():
+      slicer.util.errorDisplay("Another step is still running.")
+      return
+    self.jobFinished = onFinished
+    self.storeInstrumentationParameters()
+    self.setRunButtonsEnabled(False)
+    self.progressLabel.setText(name)
+    self.progressBar.setRange(0, 0)
+    self.job = BackgroundJob(target, name).start()
+    self.jobTimer.start()
+
+  def pollJob(self):
+    stage, done, total = self.job.progress()
+    if total:
+      self.progressBar.setRange(0, total)
+      self.progressBar.setValue(done)
+      self.progressLabel.setText("%s: %d / %d" % (stage, done, total))
+    if self.job.isRunning():
+      return
+    self.jobTimer.stop()
+    self.setRunButtonsEnabled(True)
+    self.updateCheckpointStatus()
+    self.updateStageTable()
+    self.progressBar.setRange(0, 1)
+    if self.job.cancelled:
+      self.progressBar.setValue(0)
+      self.progressLabel.setText(self.job.name + " cancelled")
+    elif self.job.error is not None:
+      self.progressBar.setValue(0)
+      self.progressLabel.setText(self.job.name + " failed")
+      logging.error(self.job.errorTraceback)
+      slicer.util.errorDisplay(self.job.name + " failed: " + str(self.job.error))
+    else:
+      self.progressBar.setValue(1)
+      self.progressLabel.setText(self.job.name + " complete")
+      if self.jobFinished:
+        self.jobFinished(self.job.result)
+
+  def cancelButtonOnLoad(self):
+    if self.job is not None and self.job.isRunning():
+      self.progressLabel.setText("Cancelling " + self.job.name + "...")
+      self.job.cancel()
+
+  def storeSubsampleParameters(self):
     # Store the keys
     self.Auto3dgmData.phase1SampledPoints = self.phase1PointNumber.value
     self.Auto3dgmData.phase2SampledPoints = self.phase2PointNumber.value
-    self.Auto3dgmData.fpsSeed=self.fpsSeed.value
-    Auto3dgmLogic.subsample(self.Auto3dgmData,list_of_pts = [self.phase1PointNumber.value,self.phase2PointNumber.value], meshes=self.Auto3dgmData.datasetCollection.datasets[0])
-    print("Dataset collection updated")
-    print(self.Auto3dgmData.datasetCollection.datasets)
+    self.Auto3dgmData.refinementPoints = self.refinementPoints()
+    self.Auto3dgmData.progressive = self.progressiveCheckBox.checked
+    self.Auto3dgmData.fpsSeed = self.fpsSeed.value if self.fpsSeed.value != self.fpsSeed.minimum else None
+    self.Auto3dgmData.subsampleMethod = ['FPS', 'GPL', 'Hybrid'][self.subsampleComboBox.currentIndex]
+    self.Auto3dgmData.hybridPoints = self.hybridPoints.value if self.hybridPoints.value != self.hybridPoints.minimum else None
+    if self.subsampleCacheCheckBox.checked:
+      self.Auto3dgmData.subsampleCache = SubsampleCache(Auto3dgmLogic.subsampleCacheFolder())
+    else:
+      self.Auto3dgmData.subsampleCache = None
+
+  def refinementPoints(self):
+    points = []
+    for text in self.refinementPointsText.text.replace(';', ',').split(','):
+      text = text.strip()
+      if text.isdigit() and int(text) > 0:
+        points.append(int(text))
+    return points
+
+  def storeAlignmentParameters(self):
+    if self.pairStoreCheckBox.checked and self.outputFolder:
+      self.Auto3dgmData.pairStoreFolder = os.path.join(self.outputFolder, 'pairwise')
+    else:
+      self.Auto3dgmData.pairStoreFolder = None
+    self.Auto3dgmData.checkpointFolder = os.path.join(self.outputFolder, 'checkpoint') if self.outputFolder else None
+    self.Auto3dgmData.resume = self.resumeCheckBox.checked
+    self.Auto3dgmData.landmarkFormat = LANDMARK_FORMATS[self.landmarkFormatComboBox.currentIndex]
+    self.Auto3dgmData.meshFormat = PLY_FORMATS[self.meshFormatComboBox.currentIndex]
+    self.Auto3dgmData.progressive = self.progressiveCheckBox.checked
+    self.Auto3dgmData.neighbors = self.neighborsSpinBox.value
+    self.Auto3dgmData.maxIterations = int(self.maxIterSliderWidget.value)
+    self.Auto3dgmData.convergenceTolerance = self.toleranceSpinBox.value
+    self.Auto3dgmData.exhaustiveMirror = self.exhaustiveMirrorCheckBox.checked
+    self.Auto3dgmData.alignmentKernel = KERNELS[self.kernelComboBox.currentIndex]
+
+  def storeInstrumentationParameters(self):
+    if self.Auto3dgmData.instrumentation is None:
+      self.Auto3dgmData.instrumentation = Instrumentation()
+    instrumentation = self.Auto3dgmData.instrumentation
+    instrumentation.logPath = os.path.join(self.outputFolder, 'instrumentation.jsonl') if self.outputFolder else None
+    index = self.profileStageComboBox.currentIndex
+    instrumentation.profileStage = self.profileStageComboBox.currentText if index > 0 else None
+    self.Auto3dgmData.pairTimings = self.pairTimingCheckBox.checked
+
+  def updateProfileStages(self):
+    # Offer the stages of every phase, phases 3+ come from the refinement points
+    data = Auto3dgmData()
+    data.refinementPoints = self.refinementPoints()
+    selected = self.profileStageComboBox.currentText
+    self.profileStageComboBox.clear()
+    self.profileStageComboBox.addItem("None")
+    for name in Auto3dgmLogic.stageNames(data):
+      self.profileStageComboBox.addItem(name)
+    index = self.profileStageComboBox.findText(selected)
+    self.profileStageComboBox.setCurrentIndex(max(index, 0))
+
+  def updateStageTable(self):
+    instrumentation = self.Auto3dgmData.instrumentation
+    rows = instrumentation.summaryRows() if instrumentation is not None else []
+    self.stageTable.setRowCount(len(rows))
+    for row, values in enumerate(rows):
+      for column, value in enumerate(values):
+        if value is None:
+          text = "-"
+        elif isinstance(value, float):
+          text = "%.2f" % value
+        else:
+          text = str(value)
+        self.stageTable.setItem(row, column, qt.QTableWidgetItem(text))
+    self.stageTable.resizeColumnsToContents()
+
+  def updateCheckpointStatus(self):
+    self.storeAlignmentParameters()
+    lines = []
+    for phase in Auto3dgmLogic.phaseNumbers(self.Auto3dgmData):
+      status = Auto3dgmLogic.checkpointStatus(self.Auto3dgmData, phase, self.reflectionCheckBox.checked)
+      if status is None:
+        continue
+      state, done, total = status
+      if state == 'resume' and self.resumeCheckBox.checked:
+        lines.append("Phase %d: resume (%d / %d pairs done)" % (phase, done, total))
+      elif state == 'stale':
+        lines.append("Phase %d: fresh (checkpoint from other inputs or parameters will be discarded)" % phase)
+      else:
+        lines.append("Phase %d: fresh" % phase)
+    self.checkpointLabel.setText("\n".join(lines) if lines else "No checkpoint")
+
+  def subStepButtonOnLoad(self):
+    self.storeSubsampleParameters()
+    list_of_pts = Auto3dgmLogic.phasePointNumbers(self.Auto3dgmData)
+    meshes = self.Auto3dgmData.datasetCollection.datasets[0]
+    def run(job):
+      return Auto3dgmLogic.subsample(self.Auto3dgmData, list_of_pts, meshes, progress=job.reporter("Subsampling meshes"),
+                                     workers=self.workerCountSpinBox.value)
+    def finished(result):
+      print("Dataset collection updated")
+      print(self.Auto3dgmData.datasetCollection.datasets)
+      report = self.Auto3dgmData.subsampleCacheReport
+      if report:
+        self.progressLabel.setText("Subsample complete (cache: %d hits, %d misses)" % (report['hits'], report['misses']))
+    self.startJob("Subsample", run, finished)
 
   def phase1StepButtonOnLoad(self):
-    #TODO: Added a new parameter to the analysis function representing parallelization
-    self.Auto3dgmData.datasetCollection.add_analysis_set(Auto3dgmLogic.correspondence(self.Auto3dgmData, self.reflectionCheckBox.checked, self.parallelizationCheckBox.checked, phase=1),"Phase 1")
-    self.Auto3dgmData.phase1SampledPoints = self.phase1PointNumber.value
-    print('Exporting data')
-    Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases = [1])
+    self.storeAlignmentParameters()
+    mirror = self.reflectionCheckBox.checked
+    processing, workers = self.processingMode(), self.workerCountSpinBox.value
+    clusterFolder = self.clusterFolder(1)
+    def run(job):
+      corr = Auto3dgmLogic.correspondence(self.Auto3dgmData, mirror, phase=1, progress=job.reporter("Phase 1 pairs"), processing=processing, workers=workers, clusterFolder=clusterFolder)
+      self.Auto3dgmData.datasetCollection.add_analysis_set(corr, "Phase 1")
+      print('Exporting data')
+      Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases = [1], progress=job.reporter("Exporting Phase 1"), workers=workers)
+    self.startJob("Phase 1", run)
 
   def phase2StepButtonOnLoad(self):
-    #TODO: Added a new parameter to the analysis function representing parallelization
-    self.Auto3dgmData.datasetCollection.add_analysis_set(Auto3dgmLogic.correspondence(self.Auto3dgmData, self.reflectionCheckBox.checked, self.parallelizationCheckBox.checked, phase=2),"Phase 2")
-    self.Auto3dgmData.phase1SampledPoints = self.phase1PointNumber.value
-    Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases = [2])
+    self.storeAlignmentParameters()
+    mirror = self.reflectionCheckBox.checked
+    processing, workers = self.processingMode(), self.workerCountSpinBox.value
+    clusterFolder = self.clusterFolder(2)
+    def run(job):
+      corr = Auto3dgmLogic.correspondence(self.Auto3dgmData, mirror, phase=2, progress=job.reporter("Phase 2 pairs"), processing=processing, workers=workers, clusterFolder=clusterFolder)
+      self.Auto3dgmData.datasetCollection.add_analysis_set(corr, "Phase 2")
+      Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases = [2], progress=job.reporter("Exporting Phase 2"), workers=workers)
+    self.startJob("Phase 2", run)
+
+  def refineStepButtonOnLoad(self):
+    self.storeAlignmentParameters()
+    phases = Auto3dgmLogic.phaseNumbers(self.Auto3dgmData)[2:]
+    if not phases:
+      slicer.util.errorDisplay("No refinement phases: enter their point numbers under Refinement Points and subsample again.")
+      return
+    mirror = self.reflectionCheckBox.checked
+    processing, workers = self.processingMode(), self.workerCountSpinBox.value
+    clusterFolders = dict((phase, self.clusterFolder(phase)) for phase in phases)
+    def run(job):
+      for phase in phases:
+        corr = Auto3dgmLogic.correspondence(self.Auto3dgmData, mirror, phase=phase, progress=job.reporter("Phase %d pairs" % phase), processing=processing, workers=workers, clusterFolder=clusterFolders[phase])
+        self.Auto3dgmData.datasetCollection.add_analysis_set(corr, "Phase %d" % phase)
+      Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases = phases, progress=job.reporter("Exporting"), workers=workers)
+    self.startJob("Refinement phases", run)
+
+  def exportButtonOnLoad(self):
+    self.storeAlignmentParameters()
+    analysisSets = self.Auto3dgmData.datasetCollection.analysis_sets if self.Auto3dgmData.datasetCollection else {}
+    phases = [phase for phase in Auto3dgmLogic.phaseNumbers(self.Auto3dgmData) if "Phase %d" % phase in analysisSets]
+    if not phases or not self.outputFolder:
+      slicer.util.errorDisplay("Nothing to export: run or open an analysis and choose an output folder first.")
+      return
+    workers = self.workerCountSpinBox.value
+    def run(job):
+      Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases=phases, progress=job.reporter("Exporting"), workers=workers)
+    self.startJob("Export", run)
 
   def allStepsButtonOnLoad(self):
-    self.Auto3dgmData.phase1SampledPoints = self.phase1PointNumber.value
-    self.Auto3dgmData.phase2SampledPoints = self.phase2PointNumber.value
-    #TODO: Added a new parameter to the analysis function representing parallelization
-    Auto3dgmLogic.runAll(self.Auto3dgmData, self.reflectionCheckBox.checked, self.parallelizationCheckBox.checked)
-    Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases = [1, 2])
+    self.storeSubsampleParameters()
+    self.storeAlignmentParameters()
+    mirror = self.reflectionCheckBox.checked
+    processing, workers = self.processingMode(), self.workerCountSpinBox.value
+    clusterFolder = self.clusterFolder()
+    def run(job):
+      Auto3dgmLogic.runAll(self.Auto3dgmData, mirror, processing=processing, workers=workers, clusterFolder=clusterFolder, job=job)
+      Auto3dgmLogic.exportData(self.Auto3dgmData, self.outputFolder, phases = Auto3dgmLogic.phaseNumbers(self.Auto3dgmData), progress=job.reporter("Exporting"), workers=workers)
+    self.startJob("Run all steps", run)
 
   ### OUTPUT TAB WIDGETS AND BEHAVIORS
 
@@ -310,6 +786,17 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     self.visStartServerButton.connect('clicked(bool)', self.visStartServerButtonOnLoad)
     self.visMeshGroupBoxLayout.addWidget(self.visStartServerButton)
 
+    self.viewerFacesSpinBox = qt.QSpinBox()
+    self.viewerFacesSpinBox.setMinimum(0)
+    self.viewerFacesSpinBox.setMaximum(10000000)
+    self.viewerFacesSpinBox.setSingleStep(1000)
+    self.viewerFacesSpinBox.setValue(DEFAULT_VIEWER_FACES)
+    self.viewerFacesSpinBox.setSpecialValueText("Full resolution")
+    self.viewerFacesSpinBox.setToolTip("Faces per mesh in the viewer. Meshes are decimated once per phase and reused until their export changes.")
+    viewerFacesLayout = qt.QFormLayout()
+    viewerFacesLayout.addRow("Viewer faces per mesh", self.viewerFacesSpinBox)
+    self.visMeshGroupBoxLayout.addLayout(viewerFacesLayout)
+
     self.visPhase1Button = qt.QPushButton("View Phase 1 alignment")
     self.visPhase1Button.toolTip = "Visualize aligned meshes with alignment based on low resolution subsampled points."
     self.visPhase1Button.connect('clicked(bool)', self.visPhase1ButtonOnLoad)
@@ -322,6 +809,17 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
     self.visPhase2Button.enabled = False
     self.visMeshGroupBoxLayout.addWidget(self.visPhase2Button)
 
+    self.visSlicerButton = qt.QPushButton("Show aligned meshes in Slicer")
+    self.visSlicerButton.toolTip = "Show the loaded meshes as models in the 3D view, aligned by the phase chosen below. Switching phases only changes their transforms."
+    self.visSlicerButton.connect('clicked(bool)', self.visSlicerButtonOnLoad)
+    self.visMeshGroupBoxLayout.addWidget(self.visSlicerButton)
+
+    self.visSlicerPhaseComboBox = qt.QComboBox()
+    self.visSlicerPhaseComboBox.connect('currentIndexChanged(int)', self.onVisSlicerPhaseChanged)
+    visSlicerPhaseLayout = qt.QFormLayout()
+    visSlicerPhaseLayout.addRow("Phase shown in Slicer", self.visSlicerPhaseComboBox)
+    self.visMeshGroupBoxLayout.addLayout(visSlicerPhaseLayout)
+
     self.visGroupBox = qt.QGroupBox("Visualize results")
     self.visGroupBoxLayout = qt.QVBoxLayout()
     self.visGroupBoxLayout.setSpacing(5)
@@ -381,14 +879,31 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
         self.serverNode.Cancel()
       Auto3dgmLogic.removeDir(viewerTmp)
 
+  def visSlicerButtonOnLoad(self):
+    phases = Auto3dgmLogic.computedPhases(self.Auto3dgmData)
+    if not phases:
+      slicer.util.errorDisplay("No alignment has been computed")
+      return
+    self.visSlicerPhaseComboBox.blockSignals(True)
+    self.visSlicerPhaseComboBox.clear()
+    for phase in phases:
+      self.visSlicerPhaseComboBox.addItem("Phase %d" % phase, phase)
+    self.visSlicerPhaseComboBox.setCurrentIndex(len(phases) - 1)
+    self.visSlicerPhaseComboBox.blockSignals(False)
+    Auto3dgmLogic.showAlignedMeshes(self.Auto3dgmData, phases[-1])
+
+  def onVisSlicerPhaseChanged(self, index):
+    if index >= 0 and self.Auto3dgmData.meshDisplay is not None:
+      Auto3dgmLogic.showAlignedMeshes(self.Auto3dgmData, self.visSlicerPhaseComboBox.itemData(index))
+
   def visPhase1ButtonOnLoad(self):
     viewerTmp = os.path.join(self.outputFolder, 'viewer_tmp')
-    Auto3dgmLogic.copyAlignedMeshes(viewerTmp, self.outputFolder, phase = 1)
+    Auto3dgmLogic.showViewerPhase(viewerTmp, self.outputFolder, phase = 1, faces = self.viewerFacesSpinBox.value)
     self.webWidget = Auto3dgmLogic.createWebWidget()
 
   def visPhase2ButtonOnLoad(self):
     viewerTmp = os.path.join(self.outputFolder, 'viewer_tmp')
-    Auto3dgmLogic.copyAlignedMeshes(viewerTmp, self.outputFolder, phase = 2)
+    Auto3dgmLogic.showViewerPhase(viewerTmp, self.outputFolder, phase = 2, faces = self.viewerFacesSpinBox.value)
     self.webWidget = Auto3dgmLogic.createWebWidget()
     
   # def outPhase1ButtonOnLoad(self):
@@ -442,7 +957,9 @@ class Auto3dgmWidget(ScriptedLoadableModuleWidget):
   #   print(self.visualizationMeshFolder)
 
   def cleanup(self):
-    pass
+    self.jobTimer.stop()
+    if self.job is not None and self.job.isRunning():
+      self.job.cancel()
 
   def onImportAligned(self):
     Auto3dgmLogic.alignOriginalMeshes(self.Auto3dgmData)
@@ -463,61 +980,346 @@ class Auto3dgmLogic(ScriptedLoadableModuleLogic):
   Uses ScriptedLoadableModuleLogic base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
-  def runAll(Auto3dgmData, mirror):
-    Auto3dgmLogic.subsample(Auto3dgmData,[Auto3dgmData.phase1SampledPoints,Auto3dgmData.phase2SampledPoints],Auto3dgmData.datasetCollection.datasets[0])
-    print("Subsampling complete.")
-    Auto3dgmData.datasetCollection.add_analysis_set(Auto3dgmLogic.correspondence(Auto3dgmData, mirror, phase=1),"Phase 1")
-    print("Phase 1 complete.")
-    Auto3dgmData.datasetCollection.add_analysis_set(Auto3dgmLogic.correspondence(Auto3dgmData, mirror, phase=2),"Phase 2")
-    print("Phase 2 complete.")
+  # Stages recorded by Auto3dgmData.instrumentation (Auto3dgmLib.instrument),
+  # an align, globalize and export stage for every phase.
+  def stageNames(Auto3dgmData):
+    names = ['load', 'subsample']
+    for phase in Auto3dgmLogic.phaseNumbers(Auto3dgmData):
+      names += ['phase%d %s' % (phase, step) for step in ['align', 'globalize', 'export']]
+    return names + ['open project', 'save project']
+
+  def runAll(Auto3dgmData, mirror, processing = 'single', workers = None, clusterFolder = None, job = None):
+    def reporter(stage):
+      return job.reporter(stage) if job else None
+    def phaseFolder(phase):
+      return os.path.join(clusterFolder, 'phase' + str(phase)) if clusterFolder else None
+    Auto3dgmLogic.subsample(Auto3dgmData,Auto3dgmLogic.phasePointNumbers(Auto3dgmData),Auto3dgmData.datasetCollection.datasets[0], progress=reporter("Subsampling meshes"), workers=workers)
+    logging.info("Subsampling complete.")
+    for phase in Auto3dgmLogic.phaseNumbers(Auto3dgmData):
+      Auto3dgmData.datasetCollection.add_analysis_set(Auto3dgmLogic.correspondence(Auto3dgmData, mirror, phase=phase, progress=reporter("Phase %d pairs" % phase), processing=processing, workers=workers, clusterFolder=phaseFolder(phase)),"Phase %d" % phase)
+      logging.info("Phase %d complete." % phase)
 
   # Logic service function AL001.001 Create dataset
-  def createDataset(inputdirectory):
-    dataset = DatasetFactory.ds_from_dir(inputdirectory,center_scale=True)
-    return dataset
+  # Mesh files are parsed on a pool of workers threads. With a meshCache
+  # (Auto3dgmLib.meshcache.MeshArrayCache) the centered and scaled arrays of
+  # files whose size and mtime are unchanged are memory mapped from the cache
+  # instead of being parsed again.
+  # With stream set only the file list is read; meshes are loaded when used
+  # and released again, at most about prefetch + 2 of them at a time, and
+  # the mesh cache index is written whenever a pass over them ends.
+  def createDataset(inputdirectory, stream = False, prefetch = 2, workers = None, meshCache = None, instrumentation = None):
+    with stage(instrumentation, 'load', stream=bool(stream)) as record:
+      files = meshFiles(inputdirectory)
+      if stream:
+        meshes = StreamedMeshes(files, lambda meshFile: Auto3dgmLogic.loadMeshFile(meshFile, meshCache), prefetch,
+                                finish=meshCache.flush if meshCache is not None else None)
+      else:
+        arrays = loadMeshArrays(files, Auto3dgmLogic.parseMeshFile, meshCache, workers)
+        meshes = [Auto3dgmLogic.meshFromArrays(f, vertices, faces) for f, (vertices, faces) in zip(files, arrays)]
+        if meshCache is not None:
+          meshCache.flush()
+          logging.info("Mesh cache: " + str(meshCache.report()))
+          record.count(mesh_cache_hits=meshCache.hits, mesh_cache_misses=meshCache.misses)
+      record.count(meshes=len(files))
+    return Auto3dgmLogic.createDatasetCollection(meshes, os.path.basename(os.path.normpath(inputdirectory)))
+
+  def parseMeshFile(meshFile):
+    mesh = MeshFactory.mesh_from_file(meshFile.path, center_scale=True)
+    return np.array(mesh.vertices), np.array(mesh.faces)
+
+  def meshFromArrays(meshFile, vertices, faces):
+    # Arrays are already centered and scaled
+    return MeshFactory.mesh_from_data(vertices, faces=faces, name=meshFile.name, center_scale=False)
+
+  def loadMeshFile(meshFile, meshCache = None):
+    vertices, faces = cachedArrays(meshFile, Auto3dgmLogic.parseMeshFile, meshCache)
+    return Auto3dgmLogic.meshFromArrays(meshFile, vertices, faces)
 
   # Logic service function AL002.1 Subsample
 
   # In: List of points, possibly just one
   # list of meshes
-  def subsample(Auto3dgmData,list_of_pts, meshes):
-    print(list_of_pts)
-    for mesh in meshes:
-        print(len(mesh.vertices))
-    ss = Subsample(pointNumber=list_of_pts, meshes=meshes, seed={},center_scale=True)
-    for point in list_of_pts:
-      names = []
-      meshes = []
-      for key in ss.ret[point]['output']['output']:
-        mesh = ss.ret[point]['output']['output'][key]
-        meshes.append(mesh)
-      dataset = {}
-      dataset[point] = meshes
-      Auto3dgmData.datasetCollection.add_dataset(dataset,point)
+  # Meshes are subsampled as they come so progress(done, total) can be
+  # reported (and the run cancelled) between meshes. With a subsample cache
+  # set on Auto3dgmData and an FPS seed, only point numbers not cached for a
+  # mesh's geometry, method and seed are computed; unseeded runs start from a
+  # new random vertex every time and are not cached. Streamed meshes are read
+  # ahead from disk and released after their subsamples are taken.
+  # FPS runs on Auto3dgmLib.fps, starting from a random vertex drawn with fpsSeed,
+  # on up to workers meshes at a time; the other methods go through
+  # auto3dgm_nazar's Subsample one mesh at a time. Either way each mesh is
+  # sampled once at the largest missing point number and the smaller ones are
+  # its prefixes, so the phases' point sets are nested.
+  def subsample(Auto3dgmData,list_of_pts, meshes, progress = None, workers = None):
+    with stage(Auto3dgmData.instrumentation, 'subsample', meshes=len(meshes), points=list(list_of_pts)) as record:
+      cache = Auto3dgmData.subsampleCache if Auto3dgmData.fpsSeed is not None else None
+      Auto3dgmData.subsampleCacheReport = None
+      if cache is not None:
+        cache.resetCounts()
+      method = Auto3dgmData.subsampleMethod
+      cacheMethod = Auto3dgmLogic.subsampleCacheMethod(Auto3dgmData)
+      def subsampleMesh(mesh):
+        results = {}
+        keys = {}
+        if cache is not None:
+          digest = meshDigest(mesh.vertices, mesh.faces)
+          for point in list_of_pts:
+            keys[point] = subsampleKey(digest, cacheMethod, point, Auto3dgmData.fpsSeed)
+            vertices = cache.get(keys[point])
+            if vertices is not None:
+              results[point] = MeshFactory.mesh_from_data(vertices, name=mesh.name)
+        missing = [point for point in list_of_pts if point not in results]
+        if missing:
+          vertices = np.asarray(mesh.vertices)
+          if method == 'FPS':
+            indices = furthestPointIndices(vertices, max(missing), Auto3dgmData.fpsSeed, Auto3dgmData.fpsMethod)
+          else:
+            ss = Subsample(pointNumber=[max(missing)], meshes=[mesh], seed={}, center_scale=False,
+                           **Auto3dgmLogic.librarySubsampleOptions(Auto3dgmData))
+            for key in ss.ret[max(missing)]['output']['output']:
+              indices = sampledIndices(vertices, ss.ret[max(missing)]['output']['output'][key].vertices)
+          for point, sampled in nestedSubsamples(vertices, indices, missing).items():
+            results[point] = MeshFactory.mesh_from_data(sampled, name=mesh.name, center_scale=True)
+        if cache is not None:
+          for point in missing:
+            cache.put(keys[point], np.asarray(results[point].vertices))
+        return results, len(missing) > 0
+      subsampled = {}
+      for point in list_of_pts:
+        subsampled[point] = []
+      workers = workers if method == 'FPS' else 1
+      samplings = 0
+      for idx, (results, sampled) in enumerate(mapOrdered(subsampleMesh, meshes, workers)):
+        samplings += sampled
+        for point in list_of_pts:
+          subsampled[point].append(results[point])
+        if progress:
+          progress(idx + 1, len(meshes))
+      for point in list_of_pts:
+        dataset = {}
+        dataset[point] = subsampled[point]
+        Auto3dgmData.datasetCollection.add_dataset(dataset,point)
+      record.count(samplings=samplings)
+      if cache is not None:
+        Auto3dgmData.subsampleCacheReport = cache.report()
+        logging.info("Subsample cache: " + str(Auto3dgmData.subsampleCacheReport))
+        record.count(cache_hits=Auto3dgmData.subsampleCacheReport['hits'], cache_misses=Auto3dgmData.subsampleCacheReport['misses'])
     return(Auto3dgmData)
 
+  # GPL and the FPS/GPL hybrid run in auto3dgm_nazar's Subsample.
+  def librarySubsampleOptions(Auto3dgmData):
+    options = {'subsample_method': Auto3dgmData.subsampleMethod}
+    if Auto3dgmData.subsampleMethod == 'Hybrid' and Auto3dgmData.hybridPoints is not None:
+      options['hybrid_points'] = Auto3dgmData.hybridPoints
+    return options
+
+  # Method part of subsample cache keys. Library samples used to be stored as
+  # '<method>/nested' while the method was not passed on, so those entries
+  # are not reused.
+  def subsampleCacheMethod(Auto3dgmData):
+    method = Auto3dgmData.subsampleMethod
+    if method == 'FPS':
+      return 'FPS/%d' % FPS_ENGINE_VERSION
+    if method == 'Hybrid':
+      return 'Hybrid/%s/library' % Auto3dgmData.hybridPoints
+    return method + '/library'
+
+  def cacheFolder(name):
+    try:
+      return os.path.join(slicer.app.cachePath, 'Auto3dgm', name)
+    except AttributeError:
+      return os.path.join(os.path.expanduser('~'), '.cache', 'auto3dgm', name)
+
+  # Logic service function: projects
+  # A project (Auto3dgmLib.project) holds the subsamples, correspondence
+  # results and parameters of an analysis. Opening one reads its manifest and
+  # subsamples; pairwise tables are memory mapped and read on demand and the
+  # original meshes are streamed from their files when exported.
+  def saveProject(Auto3dgmData, folder, parameters = {}):
+    collection = Auto3dgmData.datasetCollection
+    files = getattr(collection.datasets[0], 'files', None)
+    if files is None and Auto3dgmData.inputFolder:
+      files = meshFiles(Auto3dgmData.inputFolder)
+    if files is not None:
+      specimens = [{'name': f.name, 'path': os.path.abspath(f.path)} for f in files]
+    else:
+      specimens = [{'name': mesh.name, 'path': None} for mesh in collection.datasets[0]]
+    subsamples = {}
+    for points in set(Auto3dgmLogic.phasePointNumbers(Auto3dgmData)):
+      try:
+        subsamples[points] = [mesh.vertices for mesh in collection.datasets[points][points]]
+      except (KeyError, IndexError, TypeError):
+        pass
+    phases = {}
+    for phase in Auto3dgmLogic.phaseNumbers(Auto3dgmData):
+      if "Phase %d" % phase in collection.analysis_sets:
+        phases[phase] = collection.analysis_sets["Phase %d" % phase]
+    runParameters = dict(Auto3dgmData.runParameters, **parameters)
+    for key in Auto3dgmLogic.projectKeys:
+      runParameters[key] = getattr(Auto3dgmData, key)
+    with stage(Auto3dgmData.instrumentation, 'save project', meshes=len(specimens), phases=sorted(phases)):
+      writeProject(folder, runParameters, specimens, subsamples, phases)
+    logging.info("Project saved to " + folder)
+
+  def loadProject(folder, meshCache = None, prefetch = 2, instrumentation = None):
+    with stage(instrumentation, 'open project') as record:
+      project = Project(folder)
+      data = Auto3dgmData()
+      data.runParameters = dict(project.parameters)
+      for key in Auto3dgmLogic.projectKeys:
+        if key in project.parameters:
+          setattr(data, key, project.parameters[key])
+      files = []
+      for specimen in project.specimens:
+        path = specimen['path']
+        if path and os.path.exists(path):
+          stat = os.stat(path)
+          files.append(MeshFile(path, specimen['name'], stat.st_size, stat.st_mtime))
+        else:
+          files.append(MeshFile(path, specimen['name'], None, None))
+      meshes = StreamedMeshes(files, lambda meshFile: Auto3dgmLogic.loadMeshFile(meshFile, meshCache), prefetch,
+                              finish=meshCache.flush if meshCache is not None else None)
+      data.datasetCollection = Auto3dgmLogic.createDatasetCollection(meshes, os.path.basename(os.path.normpath(data.inputFolder or folder)))
+      for points in project.subsamplePoints:
+        arrays = project.subsample(points)
+        subsampled = [MeshFactory.mesh_from_data(np.array(vertices), name=f.name) for vertices, f in zip(arrays, files)]
+        data.datasetCollection.add_dataset({points: subsampled}, points)
+      for phase in sorted(project.phases):
+        data.datasetCollection.add_analysis_set(project.correspondence(phase), "Phase %d" % phase)
+      record.count(meshes=len(files), phases=sorted(project.phases))
+    data.instrumentation = instrumentation
+    logging.info("Project opened from " + folder)
+    return data
+
+  # Auto3dgmData attributes saved with a project
+  projectKeys = ['phase1SampledPoints', 'phase2SampledPoints', 'refinementPoints', 'progressive', 'neighbors',
+                 'maxIterations', 'convergenceTolerance', 'exhaustiveMirror', 'alignmentKernel',
+                 'fpsSeed', 'fpsMethod', 'subsampleMethod', 'hybridPoints', 'landmarkFormat', 'meshFormat', 'inputFolder']
+
+  def subsampleCacheFolder():
+    return Auto3dgmLogic.cacheFolder('subsample')
+
   def createDatasetCollection(dataset, name):
     datasetCollection=auto3dgm_nazar.dataset.datasetcollection.DatasetCollection(datasets = [dataset],dataset_names = [name])
     return datasetCollection
 
-  def correspondence(Auto3dgmData, mirror, phase = 1):
-    if phase == 1:
-      npoints = Auto3dgmData.phase1SampledPoints
-    else:
-      npoints = Auto3dgmData.phase2SampledPoints
-    meshes = Auto3dgmData.datasetCollection.datasets[npoints][npoints]
-    corr = Correspondence(meshes=meshes, mirror=mirror)
-    print("Correspondence compute for Phase " + str(phase))
+  # Pairs are aligned by Auto3dgmLib.correspondence rather than in one opaque
+  # Correspondence call, so progress(done, total) is reported per pair.
+  # processing is 'single', 'multicore' or 'cluster'; all give identical
+  # results. 'cluster' writes job specs to clusterFolder (a temporary folder if
+  # None) and runs them through the spool directory scheduler.
+  # With Auto3dgmData.pairStoreFolder set, pairs whose two point sets were
+  # aligned before with the same parameters are read back instead of being
+  # recomputed; the spanning tree and globalization are always redone.
+  # With Auto3dgmData.checkpointFolder set, finished pairs are checkpointed so
+  # an interrupted run with the same inputs resumes where it stopped.
+  # With Auto3dgmData.progressive set, phases after the first start from the
+  # previous phase's pairwise rotations and only refine them locally, so the
+  # expensive search over initial alignments runs at the lowest resolution.
+  # With Auto3dgmData.neighbors set, only candidate pairs of similar shape
+  # descriptors are aligned (Auto3dgmLib.neighbors); the others keep an
+  # infinite distance and are never used by the spanning tree.
+  def correspondence(Auto3dgmData, mirror, phase = 1, progress = None, processing = 'single', workers = None, clusterFolder = None):
+    points = Auto3dgmLogic.phasePoints(Auto3dgmData, phase)
+    seeds, seedKeys = Auto3dgmLogic.phaseSeeds(Auto3dgmData, phase)
+    instrumentation = Auto3dgmData.instrumentation
+    candidates = candidatePairs(points, Auto3dgmData.neighbors) if Auto3dgmData.neighbors else None
+    pairCount = len(candidates) if candidates is not None else len(points) * (len(points) - 1) // 2
+    with stage(instrumentation, 'phase%d align' % phase, meshes=len(points), points=len(points[0]) if points else 0,
+               pairs=pairCount, processing=processing, seeded=seeds is not None, neighbors=Auto3dgmData.neighbors) as record:
+      pairTimes = {} if Auto3dgmData.pairTimings else None
+      pairIterations = {}
+      counts = {}
+      results = alignAllPairs(points, mirror, processing, workers, progress, Auto3dgmLogic.workerExecutable(),
+        clusterFolder=clusterFolder, pairStoreFolder=Auto3dgmData.pairStoreFolder,
+        checkpointFolder=Auto3dgmLogic.phaseCheckpointFolder(Auto3dgmData, phase), resume=Auto3dgmData.resume,
+        pairTimes=pairTimes, counts=counts, seeds=seeds, seedKeys=seedKeys, candidates=candidates,
+        maxIter=Auto3dgmData.maxIterations, tolerance=Auto3dgmData.convergenceTolerance, pairIterations=pairIterations,
+        exhaustive=Auto3dgmData.exhaustiveMirror, kernel=Auto3dgmData.alignmentKernel)
+      record.count(**counts)
+      if pairTimes:
+        record.histogram('pair_seconds', list(pairTimes.values()))
+      Auto3dgmData.convergence[phase] = convergenceStats(pairIterations, results, Auto3dgmData.maxIterations)
+      if pairIterations:
+        record.count(mean_iterations=round(Auto3dgmData.convergence[phase]['mean_iterations'], 2),
+                     at_iteration_limit=Auto3dgmData.convergence[phase]['at_iteration_limit'])
+        record.histogram('pair_iterations', list(pairIterations.values()))
+        record.histogram('pair_residuals', [results[pair][0] for pair in pairIterations])
+    with stage(instrumentation, 'phase%d globalize' % phase, meshes=len(points)):
+      corr = correspondenceFromPairs(len(points), results)
+    logging.info("Correspondence computed for Phase " + str(phase))
     return(corr)
   
+  # Phases 1 and 2 have their own point numbers, phases 3, 4, ... take theirs
+  # from Auto3dgmData.refinementPoints.
+  def phasePointNumbers(Auto3dgmData):
+    return [Auto3dgmData.phase1SampledPoints, Auto3dgmData.phase2SampledPoints] + list(Auto3dgmData.refinementPoints or [])
+
+  def phaseNumbers(Auto3dgmData):
+    return list(range(1, len(Auto3dgmLogic.phasePointNumbers(Auto3dgmData)) + 1))
+
+  def phasePointNumber(Auto3dgmData, phase):
+    if phase not in Auto3dgmLogic.phaseNumbers(Auto3dgmData):
+      raise ValueError('Unaccepted phase number: ' + str(phase))
+    return Auto3dgmLogic.phasePointNumbers(Auto3dgmData)[phase - 1]
+
+  def phasePoints(Auto3dgmData, phase):
+    npoints = Auto3dgmLogic.phasePointNumber(Auto3dgmData, phase)
+    meshes = Auto3dgmData.datasetCollection.datasets[npoints][npoints]
+    return [np.asarray(mesh.vertices, dtype=float) for mesh in meshes]
+
+  # Returns ({(i, j): rotation}, per mesh seed keys) from the previous phase's
+  # pairwise alignment for progressive runs, or (None, None) when the phase
+  # is searched from scratch. A seed key names the point sets of all earlier
+  # phases of a mesh, which is what its seeded pair results depend on.
+  def phaseSeeds(Auto3dgmData, phase):
+    label = "Phase %d" % (phase - 1)
+    if not Auto3dgmData.progressive or phase < 2 or label not in Auto3dgmData.datasetCollection.analysis_sets:
+      return None, None
+    pairwise = Auto3dgmData.datasetCollection.analysis_sets[label].pairwise_alignment
+    distances = np.asarray(pairwise['d'])
+    n = len(distances)
+    # Pairs skipped by candidate selection have no rotation to start from
+    seeds = dict(((i, j), np.asarray(pairwise['r'][i][j])) for i in range(n) for j in range(i + 1, n) if np.isfinite(distances[i, j]))
+    digests = [[pointsDigest(p) for p in Auto3dgmLogic.phasePoints(Auto3dgmData, earlier)] for earlier in range(1, phase)]
+    seedKeys = ['+'.join(meshDigests) for meshDigests in zip(*digests)]
+    return seeds, seedKeys
+
+  def phaseCheckpointFolder(Auto3dgmData, phase):
+    if not Auto3dgmData.checkpointFolder:
+      return None
+    return os.path.join(Auto3dgmData.checkpointFolder, 'phase' + str(phase))
+
+  # Returns ('fresh' | 'resume' | 'stale', finished pairs, total pairs) for the
+  # phase's checkpoint, or None when the phase has not been subsampled yet.
+  def checkpointStatus(Auto3dgmData, phase, mirror):
+    folder = Auto3dgmLogic.phaseCheckpointFolder(Auto3dgmData, phase)
+    try:
+      points = Auto3dgmLogic.phasePoints(Auto3dgmData, phase)
+    except (AttributeError, KeyError, IndexError, TypeError):
+      return None
+    if folder is None:
+      return None
+    seeds, seedKeys = Auto3dgmLogic.phaseSeeds(Auto3dgmData, phase)
+    state, count = checkpointStatus(points, mirror, folder, seedKeys, Auto3dgmData.maxIterations, Auto3dgmData.convergenceTolerance,
+                                    Auto3dgmData.exhaustiveMirror, Auto3dgmData.alignmentKernel)
+    total = len(candidatePairs(points, Auto3dgmData.neighbors)) if Auto3dgmData.neighbors else len(points) * (len(points) - 1) // 2
+    return state, count, total
+
+  def workerExecutable():
+    # Inside Slicer sys.executable is the application, worker processes must be
+    # started with the bundled PythonSlicer interpreter instead.
+    try:
+      return shutil.which('PythonSlicer', path=os.path.join(slicer.app.slicerHome, 'bin'))
+    except AttributeError:
+      return None
+
   def landmarksFromPseudoLandmarks(subsampledMeshes,permutations,rotations):
     meshes = []
     for i in range(len(subsampledMeshes)):
       mesh = subsampledMeshes[i]
       perm = permutations[i]
       rot = rotations[i]
-      print(perm.shape)
-      print(mesh.vertices.shape)
       mesh.rotate(rot)
       landmarks = perm*mesh.vertices
       mesh = auto3dgm_nazar.mesh.meshfactory.MeshFactory.mesh_from_data(vertices=landmarks,name=mesh.name)
@@ -525,42 +1327,64 @@ class Auto3dgmLogic(ScriptedLoadableModuleLogic):
     return(meshes)
 
   def saveNumpyArrayToCsv(array,filename):
-    print(array)
-    print(filename)
     np.savetxt(filename+".csv",array,delimiter = ",",fmt = "%s")
-    print(str(array) + " saved to file " + str(filename))
+    logging.info("Saved " + str(filename) + ".csv")
+
+  def computedPhases(Auto3dgmData):
+    if Auto3dgmData.datasetCollection is None:
+      return []
+    return [p for p in Auto3dgmLogic.phaseNumbers(Auto3dgmData) if "Phase %d" % p in Auto3dgmData.datasetCollection.analysis_sets]
+
+  # Shows the loaded meshes as model nodes (Auto3dgmLib.display) rotated by
+  # the phase's globalized alignment. The nodes wrap the mesh arrays and are
+  # made once per dataset; later calls only set their transforms. Streamed
+  # meshes are read once and shown decimated to DEFAULT_VIEWER_FACES faces,
+  # so the full resolution dataset is never held in memory.
+  def showAlignedMeshes(Auto3dgmData, phase):
+    meshes = Auto3dgmData.datasetCollection.datasets[0]
+    display = Auto3dgmData.meshDisplay
+    if display is None or display.source is not meshes:
+      if display is not None:
+        display.remove()
+      faces = DEFAULT_VIEWER_FACES if isinstance(meshes, StreamedMeshes) else 0
+      display = Auto3dgmData.meshDisplay = AlignedMeshDisplay(meshes, faces=faces)
+    display.showRotations(Auto3dgmData.datasetCollection.analysis_sets["Phase %d" % phase].globalized_alignment['r'])
+    return display
 
   def alignOriginalMeshes(Auto3dgmData, phase = 2):
-    if 'Phase 2' in Auto3dgmData.datasetCollection.analysis_sets:
-      corr = Auto3dgmData.datasetCollection.analysis_sets['Phase 2']
-    elif 'Phase 1' in Auto3dgmData.datasetCollection.analysis_sets:
-      corr = Auto3dgmData.datasetCollection.analysis_sets['Phase 1']
-      print("Phase 2 results do not exist, computing with Phase 1")
-    else:
-      print("No alignment has been computed")
+    computed = Auto3dgmLogic.computedPhases(Auto3dgmData)
+    if not computed:
+      logging.warning("No alignment has been computed")
       return(0)
+    if phase not in computed:
+      logging.warning("Phase %d results do not exist, computing with Phase %d" % (phase, computed[-1]))
+      phase = computed[-1]
+    corr = Auto3dgmData.datasetCollection.analysis_sets["Phase %d" % phase]
     meshes = Auto3dgmData.datasetCollection.datasets[0]
-    Auto3dgmData.aligned_meshes = []
-    for t in range(len(meshes)):
+    def align(t, mesh):
       R = corr.globalized_alignment['r'][t]
-      verts=meshes[t].vertices
-      faces=meshes[t].faces
-      name=meshes[t].name
-      vertices=np.transpose(np.matmul(R,np.transpose(verts)))
-      faces=faces.astype('int64')
-      aligned_mesh=auto3dgm_nazar.mesh.meshfactory.MeshFactory.mesh_from_data(vertices, faces=faces, name=name, center_scale=True, deep=True)
-      Auto3dgmData.aligned_meshes.append(aligned_mesh)
+      vertices=np.asarray(mesh.vertices) @ np.asarray(R).T
+      faces=mesh.faces.astype('int64')
+      return auto3dgm_nazar.mesh.meshfactory.MeshFactory.mesh_from_data(vertices, faces=faces, name=mesh.name, center_scale=True, deep=True)
+    if isinstance(meshes, StreamedMeshes):
+      # Aligned lazily while saveAlignedMeshes writes them
+      Auto3dgmData.aligned_meshes = meshes.map(align)
+    else:
+      Auto3dgmData.aligned_meshes = [align(t, mesh) for t, mesh in enumerate(meshes)]
     return(Auto3dgmData)
 
   def saveAlignedMeshes(Auto3dgmData,outputFolder):
     if not os.path.exists(outputFolder):
       os.makedirs(outputFolder)
     for mesh in Auto3dgmData.aligned_meshes:
-      print(os.path.join(outputFolder, mesh.name))
+      logging.info("Saving " + os.path.join(outputFolder, mesh.name))
       MeshExport.writeToFile(outputFolder, mesh, format='ply')
 
-  def exportData(Auto3dgmData, outputFolder, phases=[1, 2]):
-    acceptable_phases = [1, 2]
+  # Export is batched: meshes are rotated once without re-centering or deep
+  # copies, landmarks are gathered by index and files are written on a pool
+  # of workers threads while the next ones are prepared.
+  def exportData(Auto3dgmData, outputFolder, phases=[1, 2], progress = None, workers = None):
+    acceptable_phases = Auto3dgmLogic.phaseNumbers(Auto3dgmData)
     for p in phases:
       if p not in acceptable_phases:
         raise ValueError('Unacceptable phase number passed to Auto3dgmLogic.exportData')
@@ -569,43 +1393,38 @@ class Auto3dgmLogic(ScriptedLoadableModuleLogic):
       subDirs = ['aligned_meshes', 'aligned_landmarks']
 
       Auto3dgmLogic.prepareDirs(exportFolder, subDirs)
-      Auto3dgmLogic.exportAlignedMeshes(Auto3dgmData, os.path.join(exportFolder, subDirs[0]), p)
-      Auto3dgmLogic.exportAlignedLandmarks(Auto3dgmData, os.path.join(exportFolder, subDirs[1]), p)
-
-  def exportAlignedMeshes(Auto3dgmData, exportFolder, phase = 2):
-    if phase == 1:
-      label = "Phase 1"
-    elif phase == 2:
-      label = "Phase 2"
-    else:
+      with stage(Auto3dgmData.instrumentation, 'phase%d export' % p, meshes=len(Auto3dgmData.datasetCollection.datasets[0]),
+                 landmarks=Auto3dgmData.landmarkFormat):
+        Auto3dgmLogic.exportAlignedMeshes(Auto3dgmData, os.path.join(exportFolder, subDirs[0]), p, progress, workers)
+        Auto3dgmLogic.exportAlignedLandmarks(Auto3dgmData, os.path.join(exportFolder, subDirs[1]), p, workers)
+
+  def exportAlignedMeshes(Auto3dgmData, exportFolder, phase = 2, progress = None, workers = None):
+    if phase not in Auto3dgmLogic.phaseNumbers(Auto3dgmData):
       raise ValueError('Unaccepted phase number passed to Auto3dgmLogic.exportAlignedMeshes')
+    label = "Phase %d" % phase
 
     m = Auto3dgmData.datasetCollection.datasets[0]
     r = Auto3dgmData.datasetCollection.analysis_sets[label].globalized_alignment['r']
 
-    for idx, mesh in enumerate(m):
-      new_vertices = np.transpose(r[idx] @ np.transpose(mesh.vertices))
-      new_faces = mesh.faces.astype('int64')
-      new_mesh = MeshFactory.mesh_from_data(new_vertices, faces=new_faces, name=mesh.name, center_scale=True, deep=True)
-      MeshExport.writeToFile(exportFolder, new_mesh, format='ply')
-
-  def exportAlignedLandmarks(Auto3dgmData, exportFolder, phase = 2):
-    if phase == 1:
-      n = Auto3dgmData.phase1SampledPoints
-      label = "Phase 1"
-    elif phase == 2:
-      n = Auto3dgmData.phase2SampledPoints
-      label = "Phase 2"
-    else:
+    exportMeshes(m, r, exportFolder, workers, progress, Auto3dgmData.meshFormat)
+
+  def exportAlignedLandmarks(Auto3dgmData, exportFolder, phase = 2, workers = None):
+    if phase not in Auto3dgmLogic.phaseNumbers(Auto3dgmData):
       raise ValueError('Unaccepted phase number passed to Auto3dgmLogic.exportAlignedLandmarks')
+    n = Auto3dgmLogic.phasePointNumber(Auto3dgmData, phase)
+    label = "Phase %d" % phase
 
     m = Auto3dgmData.datasetCollection.datasets[n][n]
     r = Auto3dgmData.datasetCollection.analysis_sets[label].globalized_alignment['r']
     p = Auto3dgmData.datasetCollection.analysis_sets[label].globalized_alignment['p']
-    landmarks = Auto3dgmLogic.landmarksFromPseudoLandmarks(m, p, r)
-
-    for l in landmarks:
-      Auto3dgmLogic.saveNumpyArrayToCsv(l.vertices, os.path.join(exportFolder, l.name))
+    landmarks = alignedLandmarks([mesh.vertices for mesh in m], r, p)
+    names = [mesh.name for mesh in m]
+    if Auto3dgmData.landmarkFormat == 'csv':
+      exportLandmarks(names, landmarks, exportFolder, workers)
+    else:
+      # One array for the phase, with rotations and landmark indices next to it
+      path = writeLandmarkArchive(exportFolder, names, landmarks, r, p, format=Auto3dgmData.landmarkFormat)
+      logging.info("Saved " + path)
 
   def prepareDirs(exportFolder, subDirs=[]):
     if not os.path.exists(exportFolder):
@@ -619,21 +1438,16 @@ class Auto3dgmLogic(ScriptedLoadableModuleLogic):
     if os.path.exists(trashFolder):
       shutil.rmtree(trashFolder)
 
-  def copyAlignedMeshes(targetFolder, outputFolder, phase = 2):
-    if phase not in [1, 2]:
-      raise ValueError('Unaccepted phase number passed to Auto3dgmLogic.copyAlignedMeshes')
-
-    for item in os.listdir(targetFolder):
-      s = os.path.join(targetFolder, item)
-      if os.path.isfile(s):
-        os.unlink(s)
-
+  # The viewer shows decimated copies of the exported aligned meshes
+  # (Auto3dgmLib.viewer), made once per phase in <outputFolder>/viewer and
+  # remade only for meshes exported again. Showing a phase links its copies
+  # into the served folder, so switching phases does not copy meshes.
+  def showViewerPhase(targetFolder, outputFolder, phase = 2, faces = DEFAULT_VIEWER_FACES, workers = None):
     srcFolder = os.path.join(outputFolder, 'phase' + str(phase), 'aligned_meshes')
-    for item in os.listdir(srcFolder):
-      s = os.path.join(srcFolder, item)
-      d = os.path.join(targetFolder, item)
-      if os.path.isfile(s):
-        shutil.copy2(s, d)
+    assetFolder = os.path.join(outputFolder, 'viewer', 'phase' + str(phase))
+    made = buildViewerAssets(srcFolder, assetFolder, faces, workers)
+    logging.info("Viewer meshes of phase %d: %d made, the others reused" % (phase, made))
+    showViewerAssets(assetFolder, targetFolder)
 
   def serveWebViewer(viewFolder):
     parameters = { 'MeshDirectory': viewFolder }
@@ -665,31 +1479,114 @@ class Auto3dgmTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_Auto3dgm1()
+    self.test_Auto3dgmViewerPhase()
+    self.test_Auto3dgmSlicerDisplay()
+    self.test_Auto3dgmSweep()
 
   def test_Auto3dgm1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    """ Synthetic meshes must go through load, subsample, both phases and
+    export, with a throughput recorded for every stage, and a halved stage
+    throughput must be reported as a regression.
     """
 
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import SampleData
-    SampleData.downloadFromURL(
-      nodeNames='FA',
-      fileNames='FA.nrrd',
-      uris='http://slicer.kitware.com/midas3/download?items=5767')
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
-    logic = Auto3dgmLogic()
-    self.assertIsNotNone( logic.hasImageData(volumeNode) )
+    self.delayDisplay("Starting the synthetic pipeline test")
+    from Auto3dgmLib.benchmark import benchmarkPipeline, compareBaseline
+    folder = tempfile.mkdtemp()
+    result = benchmarkPipeline(meshes=4, vertices=800, phase1Points=30, phase2Points=60, folder=folder)
+    for name in ['load', 'subsample', 'phase1 align', 'phase2 align', 'phase1 export', 'phase2 export']:
+      self.assertGreater(result['stages'][name]['throughput'], 0)
+    for phase in [1, 2]:
+      exported = os.listdir(os.path.join(folder, 'output', 'phase%d' % phase, 'aligned_meshes'))
+      self.assertEqual(sorted(exported), ['specimen_%04d.ply' % i for i in range(4)])
+    self.assertEqual(compareBaseline(result, result), [])
+    slower = json.loads(json.dumps(result))
+    slower['stages']['phase2 align']['throughput'] *= 0.5
+    self.assertEqual(len(compareBaseline(slower, result)), 1)
+    shutil.rmtree(folder)
+    self.delayDisplay('Test passed!')
+
+  def test_Auto3dgmViewerPhase(self):
+    """ Showing a phase must fill the viewer folder with decimated copies of
+    its exported meshes, kept under the output folder for the next time.
+    """
+    from Auto3dgmLib.benchmark import syntheticSpecimens
+    from Auto3dgmLib.export import readPly, writePly
+    self.delayDisplay("Starting the viewer phase test")
+    outputFolder = tempfile.mkdtemp(prefix='auto3dgm_test_')
+    viewerFolder = os.path.join(outputFolder, 'viewer_tmp')
+    alignedFolder = os.path.join(outputFolder, 'phase1', 'aligned_meshes')
+    os.makedirs(viewerFolder)
+    os.makedirs(alignedFolder)
+    try:
+      for mesh in syntheticSpecimens(3, 5000):
+        writePly(os.path.join(alignedFolder, mesh.name + '.ply'), mesh.vertices, mesh.faces)
+      Auto3dgmLogic.showViewerPhase(viewerFolder, outputFolder, phase=1, faces=1000)
+      shown = sorted(os.listdir(viewerFolder))
+      self.assertEqual(shown, sorted(os.listdir(alignedFolder)))
+      for name in shown:
+        vertices, faces = readPly(os.path.join(viewerFolder, name))
+        self.assertTrue(0 < len(faces) <= 1000)
+      self.assertEqual(buildViewerAssets(alignedFolder, os.path.join(outputFolder, 'viewer', 'phase1'), 1000), 0)
+    finally:
+      shutil.rmtree(outputFolder)
+    self.delayDisplay('Test passed!')
+
+  def test_Auto3dgmSlicerDisplay(self):
+    """ Model nodes must show the mesh arrays without copying them, and a
+    new set of rotations must only change the transforms.
+    """
+    from vtk.util import numpy_support
+    from Auto3dgmLib.benchmark import syntheticSpecimens
+    self.delayDisplay("Starting the Slicer display test")
+    meshes = syntheticSpecimens(3, 500)
+    display = AlignedMeshDisplay(meshes)
+    try:
+      for mesh, node in zip(meshes, display.modelNodes):
+        points = numpy_support.vtk_to_numpy(node.GetPolyData().GetPoints().GetData())
+        self.assertTrue(np.shares_memory(points, mesh.vertices))
+        self.assertEqual(node.GetPolyData().GetNumberOfCells(), len(mesh.faces))
+      polyData = display.modelNodes[1].GetPolyData()
+      r = np.linalg.qr(np.random.RandomState(7).normal(size=(3, 3)))[0]
+      display.showRotations([r] * 3)
+      matrix = vtk.vtkMatrix4x4()
+      display.transformNodes[1].GetMatrixTransformToParent(matrix)
+      self.assertTrue(np.allclose([[matrix.GetElement(i, j) for j in range(3)] for i in range(3)], r))
+      self.assertIs(display.modelNodes[1].GetPolyData(), polyData)
+    finally:
+      display.remove()
+    # Decimated copies, made while the meshes are iterated
+    display = AlignedMeshDisplay(iter(meshes), faces=200)
+    try:
+      self.assertEqual(len(display.modelNodes), 3)
+      for node in display.modelNodes:
+        self.assertTrue(0 < node.GetPolyData().GetNumberOfCells() <= 200)
+    finally:
+      display.remove()
+    self.delayDisplay('Test passed!')
+
+  def test_Auto3dgmSweep(self):
+    """ A sweep must subsample once per seed and align each distinct phase
+    once, and configurations sharing an alignment must report the same
+    quality.
+    """
+    from Auto3dgmLib import sweep
+    from Auto3dgmLib.benchmark import syntheticSpecimens, writeSyntheticMeshes
+    self.delayDisplay("Starting the parameter sweep test")
+    folder = tempfile.mkdtemp()
+    writeSyntheticMeshes(os.path.join(folder, 'meshes'), syntheticSpecimens(4, 600))
+    status = sweep.main(['--input', os.path.join(folder, 'meshes'), '--output', os.path.join(folder, 'sweep'),
+                         '--phase1-points', '20', '30', '--phase2-points', '50', '--fps-seeds', 'none', '3',
+                         '--cpus', '2', '--no-subsample-cache', '--no-mesh-cache'])
+    self.assertEqual(status, 0)
+    with open(os.path.join(folder, 'sweep', 'sweep.json')) as f:
+      summary = json.load(f)
+    self.assertEqual(summary['tasks'], {'configurations': 4, 'subsamplings': 2, 'alignments': 6})
+    rows = dict((row['configuration'], row) for row in summary['configurations'])
+    for seed in ['none', '3']:
+      first, second = rows['FPS_seed%s_20_50' % seed], rows['FPS_seed%s_30_50' % seed]
+      self.assertEqual(first['phase2_mean_distance'], second['phase2_mean_distance'])
+      self.assertEqual(first['shared_alignments'], 1)
+    self.assertLess(rows['FPS_seednone_30_50']['angle_to_reference_deg'], 1e-3)
+    self.assertTrue(os.path.exists(os.path.join(folder, 'sweep', 'sweep.csv')))
+    shutil.rmtree(folder)
     self.delayDisplay('Test passed!')
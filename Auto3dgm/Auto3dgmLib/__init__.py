@@ -0,0 +1,2 @@
+"""Computation helpers for the Auto3dgm module that do not depend on the Slicer
+GUI, so they can be driven from worker threads, processes and batch scripts."""
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Headless runner for the full Auto3dgm pipeline.
+
+Runs load -> subsample -> phase 1 -> phase 2 -> export through Auto3dgmLogic
+without the module GUI, for example in nightly batches on servers without a
+display:
+
+  Slicer --no-main-window --python-script /path/to/Auto3dgmLib/batch.py \\
+    --input meshes/ --output results/ --phase1-points 200 --phase2-points 1000
+
+A machine readable summary with parameters, per stage timings and the error,
+if any, is written to <output>/run_summary.json. The exit status is nonzero
+when any stage fails.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+
+SUBSAMPLE_METHODS = ['FPS', 'GPL', 'Hybrid']
+FPS_METHODS = ['dense', 'kdtree']
+KERNELS = ['library', 'native']
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description="Run the Auto3dgm pipeline without the GUI")
+  parser.add_argument('--input', required=True, help="Folder of input meshes")
+  parser.add_argument('--output', required=True, help="Folder for aligned meshes, landmarks and the run summary")
+  parser.add_argument('--max-iterations', type=int, default=1000, help="Maximum iterations for pairwise alignment")
+  parser.add_argument('--tolerance', type=float, default=0.0, help="Stop a pair once an iteration improves its distance by less than this fraction, 0 to iterate until the matching is stable")
+  parser.add_argument('--reflection', action='store_true', help="Allow meshes to be reflected")
+  parser.add_argument('--prune-reflection', action='store_true', help="Drop a clearly worse handedness after a few iterations instead of refining both fully")
+  parser.add_argument('--kernel', choices=KERNELS, default='library', help="Pair alignment kernel: auto3dgm_nazar's Correspondence or the faster native one, which --progressive needs")
+  parser.add_argument('--subsample-method', choices=SUBSAMPLE_METHODS, default='FPS', help="Subsampling method")
+  parser.add_argument('--fps-seed', type=int, default=None, help="Optional FPS seed")
+  parser.add_argument('--fps-method', choices=FPS_METHODS, default='kdtree', help="Furthest point sampling engine, both give the same samples")
+  parser.add_argument('--hybrid-points', type=int, default=None, help="GPL points of the FPS/GPL hybrid")
+  parser.add_argument('--phases', type=int, default=None, help="Number of alignment phases to run, all by default")
+  parser.add_argument('--phase1-points', type=int, default=200, help="Phase 1 points")
+  parser.add_argument('--phase2-points', type=int, default=1000, help="Phase 2 points")
+  parser.add_argument('--refinement-points', type=int, nargs='*', default=[], help="Points of further phases after phase 2, e.g. 4000 16000")
+  parser.add_argument('--progressive', action='store_true', help="Refine every phase after the first from the previous phase's rotations")
+  parser.add_argument('--neighbors', type=int, default=0, help="Align each mesh only with this many nearest meshes by shape descriptor, 0 for all pairs")
+  parser.add_argument('--processing', choices=['single', 'multicore', 'cluster'], default='single', help="Pairwise alignment engine")
+  parser.add_argument('--workers', type=int, default=None, help="Worker processes for multicore and cluster processing")
+  parser.add_argument('--landmark-format', choices=['csv', 'npy', 'hdf5'], default='csv', help="Aligned landmarks as CSV per specimen or one NPY/HDF5 array per phase")
+  parser.add_argument('--mesh-format', choices=['ascii', 'binary'], default='ascii', help="Aligned meshes as full precision ASCII PLY or float32 binary PLY")
+  parser.add_argument('--stream', action='store_true', help="Load meshes from disk when used instead of all at once")
+  parser.add_argument('--no-mesh-cache', action='store_true', help="Parse every mesh file instead of reading unchanged ones from the mesh cache")
+  parser.add_argument('--no-subsample-cache', action='store_true', help="Do not reuse cached subsamples (runs without an FPS seed never do)")
+  parser.add_argument('--no-pair-store', action='store_true', help="Do not reuse stored pairwise alignments")
+  parser.add_argument('--pair-timings', action='store_true', help="Log a histogram of pair alignment times")
+  parser.add_argument('--profile-stage', default=None, help="Run this stage (e.g. 'phase2 align') under cProfile")
+  parser.add_argument('--no-resume', action='store_true', help="Discard checkpoints of interrupted runs")
+  return parser.parse_args(argv)
+
+class StageTimer():
+  """Records wall clock seconds of named pipeline stages."""
+  def __init__(self):
+    self.stages = []
+
+  def run(self, name, function, *args, **kwargs):
+    print("Auto3dgm batch: " + name)
+    start = time.time()
+    stage = {'name': name, 'status': 'failed'}
+    self.stages.append(stage)
+    try:
+      result = function(*args, **kwargs)
+      stage['status'] = 'ok'
+      return result
+    finally:
+      stage['seconds'] = time.time() - start
+
+def runPipeline(args, timer):
+  from Auto3dgm import Auto3dgmData, Auto3dgmLogic
+  from Auto3dgmLib.cache import SubsampleCache
+  from Auto3dgmLib.instrument import Instrumentation
+  from Auto3dgmLib.meshcache import MeshArrayCache
+
+  data = Auto3dgmData()
+  data.inputFolder = args.input
+  data.instrumentation = Instrumentation(os.path.join(args.output, 'instrumentation.jsonl'), args.profile_stage)
+  data.pairTimings = args.pair_timings
+  data.phase1SampledPoints = args.phase1_points
+  data.phase2SampledPoints = args.phase2_points
+  data.refinementPoints = args.refinement_points
+  data.progressive = args.progressive
+  data.neighbors = args.neighbors
+  data.maxIterations = args.max_iterations
+  data.convergenceTolerance = args.tolerance
+  data.exhaustiveMirror = not args.prune_reflection
+  data.alignmentKernel = args.kernel
+  data.fpsSeed = args.fps_seed
+  data.subsampleMethod = args.subsample_method
+  data.hybridPoints = args.hybrid_points
+  data.fpsMethod = args.fps_method
+  if not args.no_subsample_cache:
+    data.subsampleCache = SubsampleCache(Auto3dgmLogic.subsampleCacheFolder())
+  if not args.no_pair_store:
+    data.pairStoreFolder = os.path.join(args.output, 'pairwise')
+  data.checkpointFolder = os.path.join(args.output, 'checkpoint')
+  data.resume = not args.no_resume
+  data.landmarkFormat = args.landmark_format
+  data.meshFormat = args.mesh_format
+
+  phases = Auto3dgmLogic.phaseNumbers(data)[:args.phases]
+  pointNumbers = Auto3dgmLogic.phasePointNumbers(data)[:len(phases)]
+  meshCache = None if args.no_mesh_cache else MeshArrayCache(Auto3dgmLogic.cacheFolder('meshes'))
+  data.datasetCollection = timer.run('load', Auto3dgmLogic.createDataset, args.input,
+    stream=args.stream, prefetch=args.workers or 2, workers=args.workers, meshCache=meshCache,
+    instrumentation=data.instrumentation)
+  timer.run('subsample', Auto3dgmLogic.subsample, data, pointNumbers, data.datasetCollection.datasets[0], workers=args.workers)
+  for phase in phases:
+    corr = timer.run('phase%d' % phase, Auto3dgmLogic.correspondence, data, args.reflection, phase=phase,
+      processing=args.processing, workers=args.workers, clusterFolder=os.path.join(args.output, 'cluster', 'phase%d' % phase))
+    data.datasetCollection.add_analysis_set(corr, "Phase %d" % phase)
+  timer.run('export', Auto3dgmLogic.exportData, data, args.output, phases=phases, workers=args.workers)
+  timer.run('project', Auto3dgmLogic.saveProject, data, os.path.join(args.output, 'project'),
+    {'mirror': args.reflection})
+  return data
+
+def writeSummary(path, summary):
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(summary, f, indent=2, sort_keys=True)
+  os.replace(tmp, path)
+
+def main(argv=None):
+  args = parseArguments(sys.argv[1:] if argv is None else argv)
+  if not os.path.exists(args.output):
+    os.makedirs(args.output)
+  timer = StageTimer()
+  summary = {'parameters': vars(args), 'stages': timer.stages, 'status': 'failed', 'error': None}
+  start = time.time()
+  try:
+    data = runPipeline(args, timer)
+    summary['convergence'] = dict(('phase%d' % phase, stats) for phase, stats in sorted(data.convergence.items()))
+    summary['status'] = 'ok'
+  except Exception as e:
+    summary['error'] = str(e)
+    summary['traceback'] = traceback.format_exc()
+    print(summary['traceback'], file=sys.stderr)
+  summary['seconds'] = time.time() - start
+  writeSummary(os.path.join(args.output, 'run_summary.json'), summary)
+  return 0 if summary['status'] == 'ok' else 1
+
+if __name__ == '__main__':
+  # Run as a script, the folder holding Auto3dgm.py is not on the path yet
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  status = main()
+  try:
+    import slicer
+    slicer.util.exit(status)
+  except (ImportError, AttributeError):
+    sys.exit(status)
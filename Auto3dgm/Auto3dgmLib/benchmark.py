@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""Benchmarks of Auto3dgm stages on synthetic data.
+
+  python -m Auto3dgmLib.benchmark export --meshes 500
+  Slicer --no-main-window --python-script /path/to/Auto3dgmLib/benchmark.py \\
+    pipeline --meshes 20 --vertices 5000 --baseline baseline.json
+
+export runs without Slicer and compares the batched export of
+Auto3dgmLib.export with the previous per mesh loop (rotate, deep copy and
+re-center every mesh, landmarks through a sparse permutation product, files
+written one after another).
+
+pipeline writes perturbed, rotated and optionally mirrored copies of a base
+shape as PLY files and runs them through Auto3dgmLogic (createDataset ->
+subsample -> correspondence -> exportData), so it needs Slicer's Python but
+not its GUI. Throughput and memory of every stage (stage_rss_mb, how far
+the resident set grew above where the stage started) are compared with a
+stored baseline and the exit status is nonzero on a regression.
+
+neighbors runs without Slicer and validates candidate pair selection: it
+aligns point sets of varied synthetic shapes once on all pairs and once on
+descriptor nearest neighbor pairs, and reports how far the spanning trees
+differ.
+
+fps runs without Slicer and times furthest point sampling of large synthetic
+meshes with a plain loop over all vertices and with the engines of
+Auto3dgmLib.fps, which must pick the same vertices.
+
+permutations runs without Slicer and measures the peak memory of the
+pairwise tables of one phase with permutations stored as sparse matrices
+and as int32 index arrays.
+
+pairs runs without Slicer and compares pairs per second of pairwise
+alignment one pair at a time and in batches, which must give the same
+results, and Procrustes problems per second solved one by one and stacked.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.sparse
+
+from Auto3dgmLib.export import alignedLandmarks, exportLandmarks, exportMeshes, writePly
+from Auto3dgmLib.instrument import Instrumentation
+
+class SyntheticMesh():
+  def __init__(self, name, vertices, faces):
+    self.name = name
+    self.vertices = vertices
+    self.faces = faces
+
+def syntheticMeshes(count, vertices, seed=0):
+  """count random meshes sharing one triangle list, as after center/scale."""
+  rng = np.random.RandomState(seed)
+  faces = rng.randint(0, vertices, size=(2 * vertices, 3))
+  meshes = []
+  for i in range(count):
+    v = rng.normal(size=(vertices, 3))
+    v -= v.mean(axis=0)
+    v /= np.linalg.norm(v)
+    meshes.append(SyntheticMesh('specimen_%04d' % i, v, faces))
+  return meshes
+
+def syntheticAlignment(count, vertices, landmarks, seed=1):
+  rng = np.random.RandomState(seed)
+  rotations = [np.linalg.qr(rng.normal(size=(3, 3)))[0] for i in range(count)]
+  permutations = []
+  for i in range(count):
+    columns = rng.choice(vertices, landmarks, replace=False)
+    permutations.append(scipy.sparse.csr_matrix((np.ones(landmarks), (np.arange(landmarks), columns)), shape=(landmarks, vertices)))
+  return rotations, permutations
+
+def baseShape(vertices):
+  """Vertices and triangles of a closed bumpy ellipsoid with about the given
+  number of vertices. The bump breaks every symmetry of the ellipsoid so each
+  copy has one correct alignment, and mirrored copies differ."""
+  rings = max(3, int(np.sqrt(vertices / 2.0)))
+  segments = 2 * rings
+  theta, phi = np.meshgrid(np.linspace(0, np.pi, rings + 2)[1:-1], np.linspace(0, 2 * np.pi, segments, endpoint=False), indexing='ij')
+  unit = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)], axis=-1).reshape(-1, 3)
+  unit = np.vstack([unit, [[0, 0, 1], [0, 0, -1]]])
+  radius = 1 + 0.4 * np.exp(-4 * ((unit - [0.6, 0.5, 0.6]) ** 2).sum(axis=1))
+  v = unit * radius[:, None] * [3.0, 2.0, 1.0]
+
+  ring, segment = np.meshgrid(np.arange(rings - 1), np.arange(segments), indexing='ij')
+  a = (ring * segments + segment).ravel()
+  b = (ring * segments + (segment + 1) % segments).ravel()
+  c, d = a + segments, b + segments
+  north, south = rings * segments, rings * segments + 1
+  first = np.arange(segments)
+  last = (rings - 1) * segments + first
+  faces = np.vstack([
+    np.stack([a, c, b], axis=1),
+    np.stack([b, c, d], axis=1),
+    np.stack([np.full(segments, north), first, (first + 1) % segments], axis=1),
+    np.stack([np.full(segments, south), last[(first + 1) % segments], last], axis=1),
+  ])
+  return v, faces
+
+def syntheticSpecimens(count, vertices, noise=0.01, mirror=False, seed=0, variation=0.0):
+  """count copies of baseShape, each perturbed, rotated, scaled and moved at
+  random. With mirror every second copy is also reflected. variation
+  stretches each copy's axes by up to that fraction, so the copies differ in
+  shape and not only by noise."""
+  rng = np.random.RandomState(seed)
+  base, faces = baseShape(vertices)
+  meshes = []
+  for i in range(count):
+    v = base * rng.uniform(1 - variation, 1 + variation, size=3) + rng.normal(scale=noise, size=base.shape)
+    f = faces
+    if mirror and i % 2:
+      v = v * [-1, 1, 1]
+      f = faces[:, ::-1]
+    q = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+    q = q * np.sign(np.linalg.det(q))
+    v = rng.uniform(0.5, 2.0) * (v @ q.T) + rng.normal(size=3)
+    meshes.append(SyntheticMesh('specimen_%04d' % i, v, f))
+  return meshes
+
+def writeSyntheticMeshes(folder, meshes):
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  for mesh in meshes:
+    writePly(os.path.join(folder, mesh.name + '.ply'), mesh.vertices, mesh.faces, format='binary')
+
+def centerScale(vertices):
+  vertices = vertices - vertices.mean(axis=0)
+  return vertices / np.linalg.norm(vertices)
+
+def exportPerMesh(meshes, rotations, permutations, meshFolder, landmarkFolder):
+  """The export loop before batching, with MeshFactory's deep copy and
+  center/scale replaced by their numpy equivalents."""
+  for mesh, r in zip(meshes, rotations):
+    vertices = np.transpose(r @ np.transpose(mesh.vertices))
+    vertices = centerScale(np.array(vertices, copy=True))
+    faces = np.array(mesh.faces.astype('int64'), copy=True)
+    writePly(os.path.join(meshFolder, mesh.name + '.ply'), vertices, faces)
+  for mesh, r, p in zip(meshes, rotations, permutations):
+    rotated = np.array(mesh.vertices, copy=True) @ r.T
+    np.savetxt(os.path.join(landmarkFolder, mesh.name + '.csv'), p * rotated, delimiter=',', fmt='%s')
+
+def exportBatched(meshes, rotations, permutations, meshFolder, landmarkFolder, workers=None):
+  exportMeshes(meshes, rotations, meshFolder, workers)
+  landmarks = alignedLandmarks([mesh.vertices for mesh in meshes], rotations, permutations)
+  exportLandmarks([mesh.name for mesh in meshes], landmarks, landmarkFolder, workers)
+
+def timeExport(function, meshes, rotations, permutations, **kwargs):
+  folder = tempfile.mkdtemp(prefix='auto3dgm_benchmark_')
+  meshFolder = os.path.join(folder, 'aligned_meshes')
+  landmarkFolder = os.path.join(folder, 'aligned_landmarks')
+  os.makedirs(meshFolder)
+  os.makedirs(landmarkFolder)
+  try:
+    start = time.time()
+    function(meshes, rotations, permutations, meshFolder, landmarkFolder, **kwargs)
+    return time.time() - start
+  finally:
+    shutil.rmtree(folder)
+
+def benchmarkExport(meshes=500, vertices=20000, landmarks=1000, workers=None, repeat=1):
+  """Seconds taken by the per mesh and the batched export, best of repeat."""
+  data = syntheticMeshes(meshes, vertices)
+  rotations, permutations = syntheticAlignment(meshes, vertices, landmarks)
+  result = {'meshes': meshes, 'vertices': vertices, 'landmarks': landmarks, 'workers': workers}
+  result['per_mesh'] = min(timeExport(exportPerMesh, data, rotations, permutations) for i in range(repeat))
+  result['batched'] = min(timeExport(exportBatched, data, rotations, permutations, workers=workers) for i in range(repeat))
+  result['speedup'] = result['per_mesh'] / result['batched']
+  return result
+
+# What the throughput of each pipeline stage is counted in
+THROUGHPUT_UNITS = {'load': 'meshes', 'subsample': 'meshes', 'align': 'pairs', 'globalize': 'meshes', 'export': 'meshes'}
+
+def stageThroughput(record):
+  """(items per second, unit) of an instrumentation record."""
+  unit = THROUGHPUT_UNITS.get(record['stage'].split()[-1])
+  if unit is None:
+    return None, None
+  items = record['counts'].get('computed', record['counts'].get(unit)) if unit == 'pairs' else record['counts'].get(unit)
+  if not items or not record['wall_s']:
+    return None, unit
+  return items / record['wall_s'], unit
+
+def benchmarkPipeline(meshes=20, vertices=5000, phase1Points=100, phase2Points=300, mirror=False, noise=0.01,
+                      processing='single', workers=None, folder=None):
+  """Runs synthetic meshes through Auto3dgmLogic and returns the parameters
+  and {stage: {wall_s, cpu_s, stage_rss_mb, throughput, unit}}. Caches, the
+  pair store and checkpoints are off so every stage does its full work."""
+  from Auto3dgm import Auto3dgmData, Auto3dgmLogic
+
+  parameters = {'meshes': meshes, 'vertices': vertices, 'phase1_points': phase1Points, 'phase2_points': phase2Points,
+                'mirror': mirror, 'noise': noise, 'processing': processing, 'workers': workers}
+  keep = folder is not None
+  folder = folder or tempfile.mkdtemp(prefix='auto3dgm_benchmark_')
+  inputFolder = os.path.join(folder, 'meshes')
+  try:
+    writeSyntheticMeshes(inputFolder, syntheticSpecimens(meshes, vertices, noise, mirror))
+    data = Auto3dgmData()
+    data.inputFolder = inputFolder
+    data.instrumentation = Instrumentation(os.path.join(folder, 'instrumentation.jsonl'))
+    data.phase1SampledPoints = phase1Points
+    data.phase2SampledPoints = phase2Points
+    data.datasetCollection = Auto3dgmLogic.createDataset(inputFolder, workers=workers, instrumentation=data.instrumentation)
+    Auto3dgmLogic.subsample(data, [phase1Points, phase2Points], data.datasetCollection.datasets[0], workers=workers)
+    for phase in [1, 2]:
+      corr = Auto3dgmLogic.correspondence(data, mirror, phase=phase, processing=processing, workers=workers)
+      data.datasetCollection.add_analysis_set(corr, "Phase %d" % phase)
+    Auto3dgmLogic.exportData(data, os.path.join(folder, 'output'), phases=[1, 2], workers=workers)
+  finally:
+    if not keep:
+      shutil.rmtree(folder, ignore_errors=True)
+
+  stages = {}
+  for record in data.instrumentation.records:
+    throughput, unit = stageThroughput(record)
+    stages[record['stage']] = {'wall_s': record['wall_s'], 'cpu_s': record['cpu_s'], 'stage_rss_mb': record['stage_rss_mb'],
+                               'throughput': throughput, 'unit': unit}
+  return {'parameters': parameters, 'stages': stages}
+
+def compareBaseline(result, baseline, tolerance=0.25):
+  """Messages for every stage whose throughput fell, or whose own memory
+  growth rose, by more than tolerance relative to the baseline. Baselines are only
+  comparable when taken with the same parameters on the same machine."""
+  regressions = []
+  if result['parameters'] != baseline['parameters']:
+    regressions.append('parameters differ from the baseline: %s' % json.dumps(baseline['parameters'], sort_keys=True))
+    return regressions
+  for name, old in sorted(baseline['stages'].items()):
+    new = result['stages'].get(name)
+    if new is None:
+      regressions.append('%s: stage missing' % name)
+      continue
+    if old['throughput'] and new['throughput'] is not None and new['throughput'] < old['throughput'] * (1 - tolerance):
+      regressions.append('%s: %.3g %s/s, baseline %.3g' % (name, new['throughput'], new['unit'], old['throughput']))
+    if old.get('stage_rss_mb') and new['stage_rss_mb'] is not None and new['stage_rss_mb'] > old['stage_rss_mb'] * (1 + tolerance):
+      regressions.append('%s: stage memory %.0f MB, baseline %.0f MB' % (name, new['stage_rss_mb'], old['stage_rss_mb']))
+  return regressions
+
+def printPipeline(result):
+  print("%-18s %9s %9s %14s %10s" % ('stage', 'wall s', 'cpu s', 'throughput', 'stage MB'))
+  for name, stage in result['stages'].items():
+    throughput = '-' if stage['throughput'] is None else '%.3g %s/s' % (stage['throughput'], stage['unit'])
+    rss = '-' if stage['stage_rss_mb'] is None else '%.0f' % stage['stage_rss_mb']
+    print("%-18s %9.2f %9.2f %14s %10s" % (name, stage['wall_s'], stage['cpu_s'], throughput, rss))
+
+def benchmarkNeighbors(meshes=40, points=100, neighbors=5, variation=0.3, mirror=False):
+  """Seconds, aligned pairs and spanning tree agreement of candidate pair
+  selection against the exhaustive run on the same point sets, aligned with
+  the native kernel so that it runs without auto3dgm_nazar."""
+  from Auto3dgmLib.correspondence import correspondenceFromPairs
+  from Auto3dgmLib.engine import alignAllPairs
+  from Auto3dgmLib.neighbors import candidatePairs, compareMst
+
+  rng = np.random.RandomState(2)
+  sets = []
+  for mesh in syntheticSpecimens(meshes, 4 * points, mirror=mirror, variation=variation):
+    sets.append(centerScale(mesh.vertices[rng.choice(len(mesh.vertices), points, replace=False)]))
+  result = {'meshes': meshes, 'points': points, 'neighbors': neighbors, 'variation': variation, 'mirror': mirror}
+
+  start = time.time()
+  exhaustive = correspondenceFromPairs(meshes, alignAllPairs(sets, mirror, kernel='native'))
+  result['exhaustive_seconds'] = time.time() - start
+  result['exhaustive_pairs'] = meshes * (meshes - 1) // 2
+
+  start = time.time()
+  candidates = candidatePairs(sets, neighbors)
+  sparse = correspondenceFromPairs(meshes, alignAllPairs(sets, mirror, candidates=candidates, kernel='native'))
+  result['sparse_seconds'] = time.time() - start
+  result['sparse_pairs'] = len(candidates)
+  result.update(compareMst(sparse.mst_matrix, exhaustive.mst_matrix, exhaustive.pairwise_alignment['d']))
+  return result
+
+def benchmarkFps(vertices=200000, points=1000, meshes=4, workers=None):
+  """Seconds to furthest point sample synthetic meshes with a plain loop over
+  all vertices and with each engine, one mesh at a time and then on workers
+  threads. Every engine must pick the vertices of the plain loop."""
+  from Auto3dgmLib.fps import FPS_METHODS, furthestPointIndices, mapOrdered, startIndex
+
+  def loop(vertices, start):
+    indices = [start]
+    nearest = ((vertices - vertices[indices[0]]) ** 2).sum(axis=1)
+    while len(indices) < points:
+      indices.append(int(np.argmax(nearest)))
+      nearest = np.minimum(nearest, ((vertices - vertices[indices[-1]]) ** 2).sum(axis=1))
+    return np.array(indices)
+
+  specimens = [mesh.vertices for mesh in syntheticSpecimens(meshes, vertices)]
+  starts = [startIndex(v) for v in specimens]
+  result = {'vertices': vertices, 'points': points, 'meshes': meshes, 'workers': workers}
+  start = time.time()
+  expected = [loop(v, s) for v, s in zip(specimens, starts)]
+  result['loop'] = time.time() - start
+  for method in FPS_METHODS:
+    start = time.time()
+    indices = [furthestPointIndices(v, points, method=method, start=s) for v, s in zip(specimens, starts)]
+    result[method] = time.time() - start
+    result[method + '_matches'] = all(np.array_equal(a, b) for a, b in zip(indices, expected))
+  start = time.time()
+  list(mapOrdered(lambda v: furthestPointIndices(v, points, method='kdtree'), specimens, workers))
+  result['kdtree_threads'] = time.time() - start
+  return result
+
+def benchmarkPermutations(meshes=300, points=1000, seed=3):
+  """Peak traced memory and seconds of assembling and globalizing a phase of
+  random pair results with permutations as sparse matrices, as before, and as
+  index arrays."""
+  from Auto3dgmLib.correspondence import assemblePairwise, findMst, globalize, pairList, permutationMatrix
+
+  rng = np.random.RandomState(seed)
+  pairs = pairList(meshes)
+  results = dict((pair, (rng.uniform(), np.eye(3), rng.permutation(points))) for pair in pairs)
+  result = {'meshes': meshes, 'points': points, 'pairs': len(pairs)}
+  for name in ['matrix', 'index']:
+    tracemalloc.start()
+    start = time.time()
+    pairwise = assemblePairwise(meshes, results)
+    if name == 'matrix':
+      for i, j in pairs:
+        pairwise['p'][i][j] = permutationMatrix(pairwise['p'][i][j].indices)
+        pairwise['p'][j][i] = pairwise['p'][i][j].T
+    globalize(pairwise, findMst(pairwise['d']))
+    result[name + '_seconds'] = time.time() - start
+    result[name + '_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024.0 ** 2
+    tracemalloc.stop()
+    del pairwise
+  return result
+
+def benchmarkPairAlignment(meshes=16, points=100, mirror=False, batch=None, problems=20000, seed=4):
+  """Pairs per second of alignPairs with batches of one pair and of batch
+  pairs on perturbed copies of a random point set, whether both give the
+  same results, and Procrustes rotations per second solved one problem at a
+  time and with one procrustesRotations call."""
+  from Auto3dgmLib.correspondence import BATCH_PAIRS, alignPairs, pairList, procrustesRotation, procrustesRotations
+
+  batch = batch or BATCH_PAIRS
+  rng = np.random.RandomState(seed)
+  base = rng.normal(size=(points, 3)) * [3.0, 2.0, 1.0]
+  sets = []
+  for i in range(meshes):
+    p = base + rng.normal(scale=0.3, size=base.shape)
+    if mirror and i % 2:
+      p = p * [-1, 1, 1]
+    sets.append(p @ np.linalg.qr(rng.normal(size=(3, 3)))[0].T)
+  pairs = pairList(meshes)
+  result = {'meshes': meshes, 'points': points, 'pairs': len(pairs), 'mirror': mirror, 'batch': batch, 'problems': problems}
+  aligned = {}
+  for name, size in [('per_pair', 1), ('batched', batch)]:
+    start = time.time()
+    aligned[name] = alignPairs(sets, pairs, mirror, chunkSize=size, kernel='native')
+    result[name + '_pairs_per_second'] = len(pairs) / (time.time() - start)
+  result['same_results'] = all(aligned['per_pair'][pair][0] == aligned['batched'][pair][0]
+                               and np.array_equal(aligned['per_pair'][pair][2], aligned['batched'][pair][2]) for pair in pairs)
+  X = rng.normal(size=(problems, points, 3))
+  Z = rng.normal(size=(problems, points, 3))
+  reflect = np.zeros(problems, dtype=bool)
+  start = time.time()
+  for k in range(problems):
+    procrustesRotation(X[k], Z[k])
+  result['procrustes_per_second'] = problems / (time.time() - start)
+  start = time.time()
+  procrustesRotations(X, Z, reflect)
+  result['stacked_procrustes_per_second'] = problems / (time.time() - start)
+  return result
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description="Auto3dgm benchmarks on synthetic data")
+  benchmarks = parser.add_subparsers(dest='benchmark')
+  benchmarks.required = True
+
+  export = benchmarks.add_parser('export', help="Batched against per mesh export, without Slicer")
+  export.add_argument('--meshes', type=int, default=500, help="Number of synthetic meshes")
+  export.add_argument('--vertices', type=int, default=20000, help="Vertices per mesh")
+  export.add_argument('--landmarks', type=int, default=1000, help="Landmarks per mesh")
+  export.add_argument('--workers', type=int, default=None, help="Writer threads of the batched export")
+  export.add_argument('--repeat', type=int, default=1, help="Report the best of this many runs")
+
+  neighbors = benchmarks.add_parser('neighbors', help="Spanning tree of candidate pairs against all pairs, without Slicer")
+  neighbors.add_argument('--meshes', type=int, default=40, help="Number of synthetic shapes")
+  neighbors.add_argument('--points', type=int, default=100, help="Points per shape")
+  neighbors.add_argument('--neighbors', type=int, default=5, help="Nearest neighbors per mesh")
+  neighbors.add_argument('--variation', type=float, default=0.3, help="Largest fractional stretch of each shape's axes")
+  neighbors.add_argument('--mirror', action='store_true', help="Reflect every second shape and allow reflection when aligning")
+
+  fps = benchmarks.add_parser('fps', help="Furthest point sampling engines against a plain loop, without Slicer")
+  fps.add_argument('--vertices', type=int, default=200000, help="Vertices per mesh")
+  fps.add_argument('--points', type=int, default=1000, help="Points to sample")
+  fps.add_argument('--meshes', type=int, default=4, help="Number of synthetic meshes")
+  fps.add_argument('--workers', type=int, default=None, help="Sampling threads")
+
+  permutations = benchmarks.add_parser('permutations', help="Memory of pairwise permutations as matrices and as indices, without Slicer")
+  permutations.add_argument('--meshes', type=int, default=300, help="Number of specimens")
+  permutations.add_argument('--points', type=int, default=1000, help="Points per specimen")
+
+  pairs = benchmarks.add_parser('pairs', help="Pairwise alignment one pair at a time against batched, without Slicer")
+  pairs.add_argument('--meshes', type=int, default=16, help="Number of point sets")
+  pairs.add_argument('--points', type=int, default=100, help="Points per set")
+  pairs.add_argument('--mirror', action='store_true', help="Reflect every second set and allow reflection when aligning")
+  pairs.add_argument('--batch', type=int, default=None, help="Pairs per batch, by default the engines' batch size")
+  pairs.add_argument('--problems', type=int, default=20000, help="Procrustes problems to solve")
+
+  pipeline = benchmarks.add_parser('pipeline', help="Load, subsample, align and export through Auto3dgmLogic")
+  pipeline.add_argument('--meshes', type=int, default=20, help="Number of synthetic meshes")
+  pipeline.add_argument('--vertices', type=int, default=5000, help="Vertices per mesh")
+  pipeline.add_argument('--phase1-points', type=int, default=100, help="Phase 1 points")
+  pipeline.add_argument('--phase2-points', type=int, default=300, help="Phase 2 points")
+  pipeline.add_argument('--mirror', action='store_true', help="Reflect every second mesh and allow reflection when aligning")
+  pipeline.add_argument('--noise', type=float, default=0.01, help="Standard deviation of the vertex perturbation")
+  pipeline.add_argument('--processing', choices=['single', 'multicore', 'cluster'], default='single', help="Pairwise alignment engine")
+  pipeline.add_argument('--workers', type=int, default=None, help="Worker threads and processes")
+  pipeline.add_argument('--folder', default=None, help="Keep the meshes, exports and instrumentation log in this folder")
+  pipeline.add_argument('--baseline', default=None, help="Fail when a stage regressed against this result file")
+  pipeline.add_argument('--tolerance', type=float, default=0.25, help="Allowed fractional loss of throughput or growth of memory")
+  pipeline.add_argument('--save', default=None, help="Write the result to this file, for use as a baseline")
+  return parser.parse_args(argv)
+
+def main(argv=None):
+  args = parseArguments(sys.argv[1:] if argv is None else argv)
+  if args.benchmark == 'export':
+    result = benchmarkExport(args.meshes, args.vertices, args.landmarks, args.workers, args.repeat)
+    print("%-10s %8.2f s" % ('per mesh', result['per_mesh']))
+    print("%-10s %8.2f s" % ('batched', result['batched']))
+    print(json.dumps(result, sort_keys=True))
+    return 0
+  if args.benchmark == 'neighbors':
+    result = benchmarkNeighbors(args.meshes, args.points, args.neighbors, args.variation, args.mirror)
+    print("%-12s %8.2f s %8d pairs" % ('all pairs', result['exhaustive_seconds'], result['exhaustive_pairs']))
+    print("%-12s %8.2f s %8d pairs" % ('neighbors', result['sparse_seconds'], result['sparse_pairs']))
+    print("%d of %d tree edges shared, tree weight %.4f times the exhaustive one" % (result['shared_edges'], result['edges'], result['weight_ratio']))
+    print(json.dumps(result, sort_keys=True))
+    return 0
+  if args.benchmark == 'fps':
+    result = benchmarkFps(args.vertices, args.points, args.meshes, args.workers)
+    for name in ['loop', 'dense', 'kdtree', 'kdtree_threads']:
+      print("%-15s %8.2f s" % (name, result[name]))
+    print(json.dumps(result, sort_keys=True))
+    return 0 if result['dense_matches'] and result['kdtree_matches'] else 1
+  if args.benchmark == 'permutations':
+    result = benchmarkPermutations(args.meshes, args.points)
+    for name in ['matrix', 'index']:
+      print("%-8s %8.2f s %10.1f MB" % (name, result[name + '_seconds'], result[name + '_peak_mb']))
+    print(json.dumps(result, sort_keys=True))
+    return 0
+  if args.benchmark == 'pairs':
+    result = benchmarkPairAlignment(args.meshes, args.points, args.mirror, args.batch, args.problems)
+    print("%-10s %10.1f pairs/s" % ('per pair', result['per_pair_pairs_per_second']))
+    print("%-10s %10.1f pairs/s" % ('batched', result['batched_pairs_per_second']))
+    print("%-10s %10.0f rotations/s" % ('one by one', result['procrustes_per_second']))
+    print("%-10s %10.0f rotations/s" % ('stacked', result['stacked_procrustes_per_second']))
+    print(json.dumps(result, sort_keys=True))
+    return 0 if result['same_results'] else 1
+
+  result = benchmarkPipeline(args.meshes, args.vertices, args.phase1_points, args.phase2_points, args.mirror, args.noise,
+                             args.processing, args.workers, args.folder)
+  printPipeline(result)
+  if args.save:
+    with open(args.save, 'w') as f:
+      json.dump(result, f, indent=2, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compareBaseline(result, json.load(f), args.tolerance)
+    for message in regressions:
+      print("Regression: " + message, file=sys.stderr)
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  # Run as a script, the folder holding Auto3dgm.py is not on the path yet
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  status = main()
+  try:
+    import slicer
+    slicer.util.exit(status)
+  except (ImportError, AttributeError):
+    sys.exit(status)
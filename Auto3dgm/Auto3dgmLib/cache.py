@@ -0,0 +1,126 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+#
+# Content addressed cache of subsampling results
+#
+
+def arrayDigest(hasher, array):
+  array = np.ascontiguousarray(array)
+  hasher.update(str((array.dtype.str, array.shape)).encode('utf-8'))
+  hasher.update(array.tobytes())
+
+def meshDigest(vertices, faces=None):
+  """Hash of the mesh geometry, independent of its name and file."""
+  hasher = hashlib.sha1()
+  arrayDigest(hasher, vertices)
+  if faces is not None:
+    arrayDigest(hasher, faces)
+  return hasher.hexdigest()
+
+def subsampleKey(digest, method, npoints, seed):
+  params = json.dumps({'mesh': digest, 'method': method, 'npoints': int(npoints), 'seed': seed}, sort_keys=True)
+  return hashlib.sha1(params.encode('utf-8')).hexdigest()
+
+class SubsampleCache():
+  """Directory of <key>.npy files with least recently used eviction.
+
+  File modification times record last use, so the recency order survives
+  Slicer restarts without a separate index file. Meshes subsampled on several
+  threads may share one cache. The folder is scanned once for its total size,
+  which puts then keep up to date, and again only when it is over maxBytes.
+  """
+  def __init__(self, folder, maxBytes=1024 ** 3):
+    self.folder = folder
+    self.maxBytes = maxBytes
+    self.lock = threading.Lock()
+    self.totalBytes = None
+    self.resetCounts()
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+
+  def path(self, key):
+    return os.path.join(self.folder, key + '.npy')
+
+  def resetCounts(self):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    path = self.path(key)
+    try:
+      array = np.load(path)
+      os.utime(path, None)
+    except (IOError, OSError, ValueError):
+      with self.lock:
+        self.misses += 1
+      return None
+    with self.lock:
+      self.hits += 1
+    return array
+
+  def put(self, key, array):
+    path = self.path(key)
+    tmp = '%s.%d.tmp.npy' % (path, threading.get_ident())
+    np.save(tmp, np.asarray(array))
+    size = os.path.getsize(tmp)
+    with self.lock:
+      if self.totalBytes is None:
+        self.totalBytes = sum(entry[1] for entry in self.entries())
+      try:
+        self.totalBytes -= os.path.getsize(path)
+      except OSError:
+        pass
+      os.replace(tmp, path)
+      self.totalBytes += size
+      if self.totalBytes > self.maxBytes:
+        self.evict()
+
+  def entries(self):
+    """(mtime, size, path) of every entry, least recently used first."""
+    entries = []
+    for path in glob.glob(os.path.join(self.folder, '*.npy')):
+      if path.endswith('.tmp.npy'):
+        continue
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, path))
+    return sorted(entries)
+
+  def evict(self):
+    entries = self.entries()
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+      if total <= self.maxBytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total -= size
+      self.evictions += 1
+    self.totalBytes = total
+
+  def clear(self):
+    for mtime, size, path in self.entries():
+      os.remove(path)
+    self.totalBytes = 0
+
+  def report(self):
+    entries = self.entries()
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'entries': len(entries),
+      'bytes': sum(size for mtime, size, path in entries),
+      'maxBytes': self.maxBytes,
+    }
@@ -0,0 +1,88 @@
+import glob
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+#
+# Checkpoints of partially finished pairwise alignment runs
+#
+
+CHECKPOINT_VERSION = 1
+
+class Checkpoint():
+  """Blocks of finished pairs of one alignment run, written atomically to a
+  folder next to a manifest of the run's inputs and parameters.
+
+  The manifest must match exactly for blocks to be reused; any difference in
+  point sets, point number or alignment parameters makes the checkpoint stale.
+  """
+  def __init__(self, folder, manifest):
+    self.folder = folder
+    self.manifest = dict(manifest, version=CHECKPOINT_VERSION)
+    self.manifestPath = os.path.join(folder, 'manifest.json')
+
+  def storedManifest(self):
+    try:
+      with open(self.manifestPath) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+
+  def blockPaths(self):
+    return sorted(glob.glob(os.path.join(self.folder, 'block_*.npz')))
+
+  def completedPairs(self):
+    count = 0
+    for path in self.blockPaths():
+      with np.load(path) as block:
+        count += len(block['pairs'])
+    return count
+
+  def status(self):
+    """('fresh' | 'resume' | 'stale', finished pair count)"""
+    stored = self.storedManifest()
+    if stored is None:
+      return 'fresh', 0
+    if stored != self.manifest:
+      return 'stale', 0
+    return 'resume', self.completedPairs()
+
+  def open(self, resume=True):
+    """Prepares the folder for a run and returns the results already finished,
+    {(i, j): (distance, rotation, permutation)}. Stale checkpoints, or any
+    checkpoint when resume is False, are discarded."""
+    state, count = self.status()
+    if state != 'resume' or not resume:
+      self.remove()
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+    tmp = self.manifestPath + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(self.manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, self.manifestPath)
+    results = {}
+    for path in self.blockPaths():
+      with np.load(path) as block:
+        for (i, j), d, r, p in zip(block['pairs'], block['d'], block['r'], block['p']):
+          results[(int(i), int(j))] = (float(d), r, p.astype(np.int64))
+    return results
+
+  def saveBlock(self, results):
+    """Writes one block of finished pairs; usable as an engine's onChunk."""
+    if not results:
+      return
+    pairs = list(results)
+    name = 'block_%d_%d_%d_%d' % (int(time.time() * 1000), os.getpid(), pairs[0][0], pairs[0][1])
+    path = os.path.join(self.folder, name + '.npz')
+    np.savez(path + '.tmp.npz',
+      pairs=np.array(pairs, dtype=np.int64).reshape(-1, 2),
+      d=np.array([results[pair][0] for pair in pairs]),
+      r=np.array([results[pair][1] for pair in pairs]).reshape(-1, 3, 3),
+      p=np.array([results[pair][2] for pair in pairs], dtype=np.int64))
+    os.replace(path + '.tmp.npz', path)
+
+  def remove(self):
+    shutil.rmtree(self.folder, ignore_errors=True)
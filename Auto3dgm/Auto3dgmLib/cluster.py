@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""Cluster/Grid execution of pairwise alignment through a spool directory.
+
+The work directory written by writeJobSpecs holds:
+
+  inputs/points_0000.npy ...   one subsampled point set per mesh
+  inputs/pairs.npy             (m, 2) array of mesh index pairs
+  inputs/seeds.npy             optional (m, 3, 3) starting rotations, NaN
+                               for pairs searched from scratch
+  spool/pending/chunk_0000.json ...
+  spool/running/, spool/done/, spool/failed/
+  results/chunk_0000.npz ...   written by workers
+
+Each job spec names a [start, stop) range into pairs.npy, the alignment
+parameters and the input array paths. A worker claims a spec by renaming it
+from pending/ to running/, which is atomic on a shared filesystem, so any
+number of workers on any number of nodes can consume the same spool:
+
+  python -m Auto3dgmLib.cluster worker <workdir>
+
+LocalSpoolScheduler starts such workers as local subprocesses; on a real
+cluster the same command is what a scheduler job script runs.
+"""
+
+from __future__ import print_function
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from Auto3dgmLib.correspondence import BATCH_PAIRS, alignPairs
+
+SPEC_VERSION = 1
+SPOOL_STATES = ['pending', 'running', 'done', 'failed']
+
+def spoolDir(workDir, state):
+  return os.path.join(workDir, 'spool', state)
+
+def atomicSave(path, **arrays):
+  """np.savez to a temporary name then rename, so readers never see a partial file."""
+  tmp = path + '.tmp.npz'
+  np.savez(tmp, **arrays)
+  os.replace(tmp, path)
+
+def writeJobSpecs(workDir, points, pairs, mirror=False, maxIter=1000, chunkSize=50, seeds=None, tolerance=0.0, exhaustive=True,
+                  timePairs=False, kernel='library'):
+  """Writes inputs and one pending job spec per chunk of pairs, returns the spec
+  paths. Inputs, specs and results of an earlier run in workDir are removed.
+  Pairs with a rotation in seeds, {pair: rotation}, are refined from it.
+  Chunks are aligned as one batch, or pair by pair with timePairs."""
+  for d in ['inputs', 'results', 'spool']:
+    shutil.rmtree(os.path.join(workDir, d), ignore_errors=True)
+  for d in ['inputs', 'results'] + [os.path.join('spool', s) for s in SPOOL_STATES]:
+    os.makedirs(os.path.join(workDir, d), exist_ok=True)
+  pointPaths = []
+  for idx, p in enumerate(points):
+    path = os.path.join(workDir, 'inputs', 'points_%04d.npy' % idx)
+    np.save(path, np.asarray(p, dtype=np.float64))
+    pointPaths.append(path)
+  pairsPath = os.path.join(workDir, 'inputs', 'pairs.npy')
+  np.save(pairsPath, np.asarray(pairs, dtype=np.int64).reshape(-1, 2))
+  seedsPath = None
+  if seeds is not None:
+    seedsPath = os.path.join(workDir, 'inputs', 'seeds.npy')
+    missing = np.full((3, 3), np.nan)
+    np.save(seedsPath, np.array([seeds.get(tuple(pair), missing) for pair in pairs], dtype=np.float64).reshape(-1, 3, 3))
+  specPaths = []
+  for chunk, start in enumerate(range(0, len(pairs), chunkSize)):
+    name = 'chunk_%04d' % chunk
+    spec = {
+      'version': SPEC_VERSION,
+      'name': name,
+      'pairs': pairsPath,
+      'pairRange': [start, min(start + chunkSize, len(pairs))],
+      'seeds': seedsPath,
+      'points': pointPaths,
+      'parameters': {'mirror': bool(mirror), 'maxIter': int(maxIter), 'tolerance': float(tolerance), 'exhaustive': bool(exhaustive),
+                     'timePairs': bool(timePairs), 'kernel': kernel},
+      'output': os.path.join(workDir, 'results', name + '.npz'),
+    }
+    path = os.path.join(spoolDir(workDir, 'pending'), name + '.json')
+    with open(path + '.tmp', 'w') as f:
+      json.dump(spec, f, indent=2)
+    os.replace(path + '.tmp', path)
+    specPaths.append(path)
+  return specPaths
+
+def runJobSpec(spec):
+  """Aligns the pairs of one spec and writes its result file."""
+  if spec.get('version') != SPEC_VERSION:
+    raise ValueError('Unsupported job spec version: ' + str(spec.get('version')))
+  start, stop = spec['pairRange']
+  pairs = np.load(spec['pairs'])[start:stop]
+  points = dict((int(i), np.load(spec['points'][i])) for i in np.unique(pairs))
+  seeds = np.load(spec['seeds'])[start:stop] if spec.get('seeds') else [None] * len(pairs)
+  params = spec['parameters']
+  keys = [(int(i), int(j)) for i, j in pairs]
+  seeded = dict((pair, seed) for pair, seed in zip(keys, seeds) if seed is not None and not np.isnan(seed).any())
+  pairTimes = {} if params.get('timePairs') else None
+  pairIterations = {}
+  results = alignPairs(points, keys, params['mirror'], params['maxIter'], chunkSize=max(1, len(keys)), pairTimes=pairTimes,
+                       seeds=seeded if spec.get('seeds') else None, tolerance=params.get('tolerance', 0.0),
+                       pairIterations=pairIterations, exhaustive=params.get('exhaustive', True), kernel=params.get('kernel', 'native'))
+  arrays = {
+    'pairs': pairs,
+    'd': np.array([results[pair][0] for pair in keys]),
+    'r': np.array([results[pair][1] for pair in keys]).reshape(-1, 3, 3),
+    'p': np.array([results[pair][2] for pair in keys], dtype=np.int64),
+  }
+  if pairIterations:
+    arrays['it'] = np.array([pairIterations[pair] for pair in keys], dtype=np.int64)
+  if pairTimes is not None:
+    arrays['t'] = np.array([pairTimes[pair] for pair in keys])
+  atomicSave(spec['output'], **arrays)
+
+def claimJobSpec(workDir):
+  """Moves one pending spec to running and returns its path, or None when the
+  spool is empty. Losing a rename race to another worker just moves on."""
+  for path in sorted(glob.glob(os.path.join(spoolDir(workDir, 'pending'), '*.json'))):
+    claimed = os.path.join(spoolDir(workDir, 'running'), os.path.basename(path))
+    try:
+      os.rename(path, claimed)
+    except OSError:
+      continue
+    return claimed
+  return None
+
+def runWorker(workDir):
+  """Consumes job specs until the spool is empty, returns the number run."""
+  count = 0
+  while True:
+    path = claimJobSpec(workDir)
+    if path is None:
+      return count
+    name = os.path.basename(path)
+    try:
+      with open(path) as f:
+        runJobSpec(json.load(f))
+      os.replace(path, os.path.join(spoolDir(workDir, 'done'), name))
+    except Exception:
+      failed = os.path.join(spoolDir(workDir, 'failed'), name)
+      with open(failed + '.log', 'w') as f:
+        f.write(traceback.format_exc())
+      os.replace(path, failed)
+    count += 1
+
+def spoolCounts(workDir):
+  return dict((s, len(glob.glob(os.path.join(spoolDir(workDir, s), '*.json')))) for s in SPOOL_STATES)
+
+def readChunkResult(path):
+  results = {}
+  with np.load(path) as chunk:
+    for (i, j), dist, R, perm in zip(chunk['pairs'], chunk['d'], chunk['r'], chunk['p']):
+      results[(int(i), int(j))] = (float(dist), R, perm)
+  return results
+
+def readChunkTimes(path):
+  """{(i, j): seconds} of a chunk result, empty for results without timings."""
+  with np.load(path) as chunk:
+    if 't' not in chunk.files:
+      return {}
+    return dict(((int(i), int(j)), float(t)) for (i, j), t in zip(chunk['pairs'], chunk['t']))
+
+def readChunkIterations(path):
+  """{(i, j): iterations} of a chunk result, empty for results without them."""
+  with np.load(path) as chunk:
+    if 'it' not in chunk.files:
+      return {}
+    return dict(((int(i), int(j)), int(it)) for (i, j), it in zip(chunk['pairs'], chunk['it']))
+
+def reduceResults(workDir):
+  """Collects all chunk results into {(i, j): (distance, rotation, permutation)}."""
+  results = {}
+  for path in sorted(glob.glob(os.path.join(workDir, 'results', '*.npz'))):
+    results.update(readChunkResult(path))
+  return results
+
+class LocalSpoolScheduler():
+  """Stand-in scheduler that runs spool workers as local subprocesses."""
+  def __init__(self, workDir, workers=1, executable=None):
+    self.workDir = workDir
+    self.workers = workers
+    self.executable = executable or sys.executable
+    self.processes = []
+    self.collected = set()
+
+  def workerCommand(self):
+    return [self.executable, '-m', 'Auto3dgmLib.cluster', 'worker', self.workDir]
+
+  def submit(self):
+    env = dict(os.environ)
+    libParent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([libParent] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    self.processes = [subprocess.Popen(self.workerCommand(), env=env) for i in range(self.workers)]
+
+  def cancel(self):
+    for process in self.processes:
+      if process.poll() is None:
+        process.terminate()
+    for process in self.processes:
+      process.wait()
+
+  def collectDone(self, onChunk):
+    """Passes the results of chunks finished since the last call to onChunk."""
+    for path in sorted(glob.glob(os.path.join(spoolDir(self.workDir, 'done'), '*.json'))):
+      name = os.path.splitext(os.path.basename(path))[0]
+      if name not in self.collected:
+        self.collected.add(name)
+        onChunk(readChunkResult(os.path.join(self.workDir, 'results', name + '.npz')))
+
+  def wait(self, progress=None, interval=0.5, onChunk=None):
+    """Blocks until the spool drains, reporting finished chunks via progress
+    and, when given, their results via onChunk."""
+    self.collected = set()
+    try:
+      while True:
+        counts = spoolCounts(self.workDir)
+        if onChunk:
+          self.collectDone(onChunk)
+        total = sum(counts.values())
+        if progress:
+          progress(counts['done'] + counts['failed'], total)
+        if counts['pending'] == counts['running'] == 0:
+          break
+        if all(process.poll() is not None for process in self.processes):
+          counts = spoolCounts(self.workDir)
+          if counts['pending'] == counts['running'] == 0:
+            break
+          raise RuntimeError('All spool workers exited with %d chunks unfinished in %s' % (counts['pending'] + counts['running'], self.workDir))
+        time.sleep(interval)
+    except BaseException:
+      self.cancel()
+      raise
+    for process in self.processes:
+      process.wait()
+    if onChunk:
+      self.collectDone(onChunk)
+    if counts['failed']:
+      raise RuntimeError('%d alignment chunks failed, see %s' % (counts['failed'], spoolDir(self.workDir, 'failed')))
+
+def alignPairsCluster(points, pairs, workDir, mirror=False, maxIter=1000, workers=1, progress=None, executable=None, chunkSize=None, onChunk=None, pairTimes=None, seeds=None,
+                      tolerance=0.0, pairIterations=None, exhaustive=True, kernel='library'):
+  """Same contract as correspondence.alignPairs, computed through the spool
+  directory by locally started workers. By default pairs are split into about
+  four chunks per worker, of at most BATCH_PAIRS pairs each."""
+  if chunkSize is None:
+    chunkSize = max(1, min(BATCH_PAIRS, int(np.ceil(len(pairs) / (4.0 * max(1, workers))))))
+  writeJobSpecs(workDir, points, pairs, mirror, maxIter, chunkSize, seeds, tolerance, exhaustive, pairTimes is not None, kernel)
+  scheduler = LocalSpoolScheduler(workDir, workers, executable)
+  scheduler.submit()
+  scheduler.wait(progress, onChunk=onChunk)
+  results = reduceResults(workDir)
+  for path in sorted(glob.glob(os.path.join(workDir, 'results', '*.npz'))):
+    if pairTimes is not None:
+      pairTimes.update(readChunkTimes(path))
+    if pairIterations is not None:
+      pairIterations.update(readChunkIterations(path))
+  return dict((tuple(pair), results[tuple(pair)]) for pair in pairs)
+
+def main():
+  parser = argparse.ArgumentParser(description="Auto3dgm pairwise alignment spool worker")
+  parser.add_argument('command', choices=['worker'], help="Action to run")
+  parser.add_argument('workdir', help="Work directory holding the spool")
+  args = parser.parse_args()
+  runWorker(args.workdir)
+
+if __name__ == '__main__':
+  main()
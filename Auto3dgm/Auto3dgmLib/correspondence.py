@@ -0,0 +1,503 @@
+import itertools
+import time
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+try:
+  from auto3dgm_nazar.analysis.correspondence import Correspondence
+  from auto3dgm_nazar.mesh.meshfactory import MeshFactory
+except ImportError:
+  Correspondence = None
+
+#
+# Pairwise correspondence engine
+#
+# Point sets are (n, 3) arrays with one point per row. The alignment of mesh j
+# onto mesh i is a rotation R and a permutation index array perm such that
+# points_i[k] corresponds to (R @ points_j[perm[k]]).
+#
+# Pairs are aligned by one of two kernels. 'library' runs auto3dgm_nazar's
+# Correspondence on each pair, so results are the library's. 'native' is the
+# batched implementation below; it is faster and supports iteration limits,
+# tolerances and seeded refinement, but its equality with the library is only
+# tested where auto3dgm_nazar is installed.
+#
+
+KERNELS = ['library', 'native']
+
+class CorrespondenceResult():
+  """Pairwise and globalized alignments of a list of subsampled meshes, laid out
+  like auto3dgm_nazar's Correspondence so it can be stored as an analysis set."""
+  def __init__(self, pairwise_alignment, mst_matrix, globalized_alignment, reference=0):
+    self.pairwise_alignment = pairwise_alignment
+    self.mst_matrix = mst_matrix
+    self.globalized_alignment = globalized_alignment
+    self.reference = reference
+
+def pairList(n):
+  """All unordered pairs (i, j), i < j, in the order the serial engine visits them."""
+  return list(itertools.combinations(range(n), 2))
+
+def principalAxes(points):
+  centered = points - points.mean(axis=0)
+  u, s, vt = np.linalg.svd(centered, full_matrices=False)
+  return vt.T
+
+# The sign flips of the principal axes in auto3dgm_nazar's order: the four
+# with an even number of flips, which are all it tries without reflection,
+# then the four odd ones.
+AXIS_SIGNS = np.array([[1, 1, 1], [1, -1, -1], [-1, -1, 1], [-1, 1, -1],
+                       [-1, 1, 1], [1, -1, 1], [1, 1, -1], [-1, -1, -1]], dtype=float)
+
+def candidateRotations(ux, uy):
+  """ux @ diag(signs) @ uy.T for every pair of principal axes of two (k, 3, 3)
+  stacks and every sign flip, as a (k, 8, 3, 3) array, with whether each
+  flips an even number of axes. Even and odd flips are of opposite
+  handedness, but which one is proper depends on the axes."""
+  rotations = (ux[:, None, :, :] * AXIS_SIGNS[None, :, None, :]) @ np.swapaxes(uy, 1, 2)[:, None, :, :]
+  even = np.broadcast_to(AXIS_SIGNS.prod(axis=1) > 0, rotations.shape[:2])
+  return rotations, even
+
+def pcaCandidates(X, Y, mirror=False):
+  """Rotations matching the principal axes of Y onto those of X under the sign
+  flips auto3dgm_nazar tries: the even ones, and the odd ones with mirror.
+  Without mirror they may still be improper; locgpd then only uses them for
+  the first matching."""
+  rotations, even = candidateRotations(principalAxes(X)[None], principalAxes(Y)[None])
+  return [R for R, keep in zip(rotations[0], even[0]) if mirror or keep]
+
+def matchPoints(X, Y, R):
+  """Optimal one-to-one matching of the rotated Y onto X."""
+  cost = cdist(X, Y @ R.T, 'sqeuclidean')
+  rows, cols = linear_sum_assignment(cost)
+  return cols[np.argsort(rows)]
+
+def procrustesRotations(X, Z, reflect):
+  """procrustesRotation of every X[k], Z[k] of two (k, n, 3) stacks, solved by
+  one SVD call over the (k, 3, 3) cross-covariances. reflect holds one flag
+  per entry."""
+  u, s, vt = np.linalg.svd(np.einsum('kni,knj->kij', X, Z))
+  d = np.ones((len(u), 3))
+  d[:, 2] = np.sign(np.linalg.det(u @ vt)) * np.where(reflect, -1.0, 1.0)
+  return (u * d[:, None, :]) @ vt
+
+def procrustesRotation(X, Z, reflect=False):
+  """Rotation R minimizing ||X - Z R^T||; reflect keeps an improper solution."""
+  return procrustesRotations(X[None], Z[None], [reflect])[0]
+
+def alignmentDistance(X, Y, R, perm):
+  return np.linalg.norm(X - Y[perm] @ R.T)
+
+def matchingLowerBounds(tree, Y, rotations):
+  """Distance from every point of Y under each of the (c, 3, 3) rotations to
+  its nearest point of the X in tree. No one-to-one matching of the rotated
+  Y onto X can be closer."""
+  rotated = np.einsum('nj,cij->cni', Y, rotations)
+  nearest = tree.query(rotated.reshape(-1, 3))[0].reshape(len(rotations), -1)
+  return np.sqrt((nearest ** 2).sum(axis=1))
+
+def locgpdBatch(X, Y, R, maxIter=1000, tolerance=0.0, reflect=None):
+  """locgpd of every X[k], Y[k] from the starting rotation R[k], run in
+  lockstep: each iteration solves the rotations of all unfinished runs of
+  the same point count with one procrustesRotations call. maxIter is a limit
+  for all runs or one per run. reflect holds per run whether the solved
+  rotations are improper, by default the handedness of R[k]. Returns the
+  (distance, rotation, permutation) results, the iterations and whether each
+  run stopped before its limit."""
+  count = len(X)
+  limits = np.broadcast_to(np.asarray(maxIter, dtype=np.int64), (count,))
+  rotations = [np.asarray(r, dtype=float) for r in R]
+  if reflect is None:
+    reflect = [np.linalg.det(r) < 0 for r in rotations]
+  reflect = np.array(reflect, dtype=bool)
+  perms = [matchPoints(X[k], Y[k], rotations[k]) for k in range(count)]
+  previous = [alignmentDistance(X[k], Y[k], rotations[k], perms[k]) for k in range(count)] if tolerance > 0 else None
+  iterations = np.zeros(count, dtype=np.int64)
+  converged = np.zeros(count, dtype=bool)
+  groups = {}
+  for k in range(count):
+    groups.setdefault(len(X[k]), []).append(k)
+  for members in groups.values():
+    active = [k for k in members if limits[k] > 0]
+    while active:
+      solved = procrustesRotations(np.stack([X[k] for k in active]), np.stack([Y[k][perms[k]] for k in active]), reflect[active])
+      running = []
+      for k, rotation in zip(active, solved):
+        iterations[k] += 1
+        rotations[k] = rotation
+        newPerm = matchPoints(X[k], Y[k], rotation)
+        if np.array_equal(newPerm, perms[k]):
+          converged[k] = True
+          continue
+        perms[k] = newPerm
+        if tolerance > 0:
+          distance = alignmentDistance(X[k], Y[k], rotation, newPerm)
+          if previous[k] - distance <= tolerance * previous[k]:
+            converged[k] = True
+            continue
+          previous[k] = distance
+        if iterations[k] < limits[k]:
+          running.append(k)
+      active = running
+  results = [(alignmentDistance(X[k], Y[k], rotations[k], perms[k]), rotations[k], perms[k]) for k in range(count)]
+  return results, iterations, converged
+
+def locgpd(X, Y, R, maxIter=1000, tolerance=0.0, info=None):
+  """Alternates matching and Procrustes from the starting rotation R until the
+  matching no longer changes, at most maxIter times. With a tolerance it also
+  stops once an iteration lowers the distance by no more than that fraction.
+  The handedness of R is preserved. info, if given, counts the iterations run
+  under 'iterations' and records under 'converged' whether it stopped before
+  running out of iterations."""
+  results, iterations, converged = locgpdBatch([X], [Y], [R], maxIter, tolerance)
+  if info is not None:
+    info['iterations'] = info.get('iterations', 0) + int(iterations[0])
+    info['converged'] = bool(converged[0])
+  return results[0]
+
+# With reflection allowed, the best start of each handedness is first refined
+# for MIRROR_PRUNE_ITERATIONS iterations only. A handedness whose distance is
+# then more than MIRROR_PRUNE_MARGIN times the other's is dropped, the other
+# continues where it stopped. On synthetic specimens of either handedness the
+# eventual winner was never more than about 9% behind after three iterations.
+MIRROR_PRUNE_ITERATIONS = 3
+MIRROR_PRUNE_MARGIN = 1.15
+
+class BatchCache():
+  """Principal axes and KD-trees of the point sets of a batch, each computed
+  once however many pairs it is part of."""
+  def __init__(self, points):
+    self.points = points
+    self.axes = {}
+    self.trees = {}
+
+  def principalAxes(self, i):
+    if i not in self.axes:
+      self.axes[i] = principalAxes(self.points[i])
+    return self.axes[i]
+
+  def tree(self, i):
+    if i not in self.trees:
+      self.trees[i] = cKDTree(self.points[i])
+    return self.trees[i]
+
+def selectStarts(X, Y, rotations, proper, tree=None):
+  """Best start of each handedness, even sign flips first, as [rotation].
+
+  Without a tree every candidate is matched. With the KD-tree of X,
+  candidates are matched in order of matchingLowerBounds and skipped once the
+  bound exceeds the best distance of their handedness, which selects the
+  same starts.
+  """
+  bounds = matchingLowerBounds(tree, Y, rotations) if tree is not None else None
+  best = {}
+  for index in (np.argsort(bounds, kind='stable') if bounds is not None else range(len(rotations))):
+    R = rotations[index]
+    key = bool(proper[index])
+    if bounds is not None and key in best and bounds[index] > best[key][0]:
+      continue
+    d = alignmentDistance(X, Y, R, matchPoints(X, Y, R))
+    if key not in best or (d, index) < (best[key][0], best[key][2]):
+      best[key] = (d, R, index)
+  return [best[key][1] for key in sorted(best, reverse=True)]
+
+def alignPairsBatch(points, pairs, mirror=False, maxIter=1000, seeds=None, tolerance=0.0, exhaustive=True):
+  """Aligns a batch of pairs with stacked kernels, returning a
+  (distance, rotation, permutation) result and an info dict with
+  'iterations' and 'pruned' per pair. seeds holds a starting rotation or
+  None per pair. Results do not depend on how pairs are batched.
+
+  A pair without a seed starts from the best principal axis alignment of
+  each allowed handedness (selectStarts; every candidate is matched when
+  exhaustive). Without mirror only the even sign flips are tried, as in
+  auto3dgm_nazar, and every solved rotation is proper whatever the handedness
+  of the start. With mirror, both handedness first run a few iterations and
+  a clearly worse one is dropped, unless exhaustive is set. All locgpd runs
+  of the batch then iterate together in locgpdBatch and the closer run of
+  each pair wins.
+  """
+  cache = BatchCache(points)
+  seeds = seeds if seeds is not None else [None] * len(pairs)
+  unseeded = [index for index, seed in enumerate(seeds) if seed is None]
+  candidates = {}
+  if unseeded:
+    ux = np.array([cache.principalAxes(pairs[index][0]) for index in unseeded])
+    uy = np.array([cache.principalAxes(pairs[index][1]) for index in unseeded])
+    rotations, proper = candidateRotations(ux, uy)
+    for index, r, p in zip(unseeded, rotations, proper):
+      keep = np.ones(len(p), dtype=bool) if mirror else np.asarray(p)
+      candidates[index] = (r[keep], p[keep])
+  # Runs are (pair index, starting rotation, iteration limit)
+  runs = []
+  pruning = []
+  for index, (i, j) in enumerate(pairs):
+    if seeds[index] is not None:
+      runs.append((index, np.asarray(seeds[index], dtype=float), maxIter))
+      continue
+    tree = cache.tree(i) if not exhaustive else None
+    starts = selectStarts(points[i], points[j], candidates[index][0], candidates[index][1], tree)
+    if len(starts) > 1 and not exhaustive:
+      pruning.extend((index, R, min(MIRROR_PRUNE_ITERATIONS, maxIter)) for R in starts)
+    else:
+      runs.extend((index, R, maxIter) for R in starts)
+  infos = [{'iterations': 0, 'pruned': 0} for pair in pairs]
+
+  def iterate(runs):
+    if not runs:
+      return []
+    results, iterations, converged = locgpdBatch([points[pairs[index][0]] for index, R, limit in runs],
+                                                 [points[pairs[index][1]] for index, R, limit in runs],
+                                                 [R for index, R, limit in runs], [limit for index, R, limit in runs], tolerance,
+                                                 [mirror and np.linalg.det(R) < 0 for index, R, limit in runs])
+    for (index, R, limit), used in zip(runs, iterations):
+      infos[index]['iterations'] += int(used)
+    return list(zip(results, iterations, converged))
+
+  # The handedness of a pair that remain within the margin after a few
+  # iterations continue from where they stopped, as locgpd would have
+  finished = list(zip([index for index, R, limit in runs], [result for result, used, done in iterate(runs)]))
+  partial = iterate(pruning)
+  closest = {}
+  for (index, R, limit), (result, used, done) in zip(pruning, partial):
+    closest[index] = min(closest.get(index, np.inf), result[0])
+  continued = []
+  for (index, R, limit), (result, used, done) in zip(pruning, partial):
+    if result[0] > MIRROR_PRUNE_MARGIN * closest[index]:
+      infos[index]['pruned'] += 1
+      finished.append((index, None))
+    elif done or used >= maxIter:
+      finished.append((index, result))
+    else:
+      continued.append((len(finished), (index, result[1], maxIter - int(used))))
+      finished.append((index, None))
+  for (position, run), (result, used, done) in zip(continued, iterate([run for position, run in continued])):
+    finished[position] = (run[0], result)
+  best = [None] * len(pairs)
+  for index, result in finished:
+    if result is not None and (best[index] is None or result[0] < best[index][0]):
+      best[index] = result
+  return best, infos
+
+def alignPair(X, Y, mirror=False, maxIter=1000, tolerance=0.0, info=None, exhaustive=True):
+  """Aligns Y onto X, returning (distance, rotation, permutation index array).
+
+  The best starting principal axis alignment of each allowed handedness is
+  refined with locgpd and the closer of the refined alignments wins; see
+  alignPairsBatch for the pruning that exhaustive turns off.
+  """
+  results, infos = alignPairsBatch([X, Y], [(0, 1)], mirror, maxIter, None, tolerance, exhaustive)
+  if info is not None:
+    for key, value in infos[0].items():
+      info[key] = info.get(key, 0) + value
+  return results[0]
+
+def refinePair(X, Y, R, maxIter=1000, tolerance=0.0, info=None):
+  """Aligns Y onto X starting from a known rotation R, typically the pair's
+  rotation on coarser subsamples, instead of searching all principal axis
+  candidates. Only locgpd's local refinement runs and R's handedness is kept."""
+  return locgpd(X, Y, np.asarray(R, dtype=float), maxIter, tolerance, info)
+
+def alignOrRefinePair(X, Y, mirror=False, maxIter=1000, seed=None, tolerance=0.0, info=None, exhaustive=True):
+  if seed is None:
+    return alignPair(X, Y, mirror, maxIter, tolerance, info, exhaustive)
+  return refinePair(X, Y, seed, maxIter, tolerance, info)
+
+def libraryAlignPairs(points, pairs, mirror=False):
+  """Aligns every (i, j) pair with auto3dgm_nazar's Correspondence run on the
+  two meshes alone, returning (distance, rotation, permutation) results in
+  pair order. The library aligns pairs independently, so these are the
+  entries its Correspondence over all meshes would hold."""
+  if Correspondence is None:
+    raise ImportError("The 'library' alignment kernel needs auto3dgm_nazar")
+  meshes = {}
+  def mesh(i):
+    if i not in meshes:
+      meshes[i] = MeshFactory.mesh_from_data(vertices=np.asarray(points[i], dtype=float), name='specimen_%d' % i)
+    return meshes[i]
+  results = []
+  for i, j in pairs:
+    pairwise = Correspondence(meshes=[mesh(i), mesh(j)], mirror=mirror).pairwise_alignment
+    results.append((float(np.asarray(pairwise['d'])[0, 1]), np.asarray(pairwise['r'][0][1], dtype=float),
+                    permutationIndices(pairwise['p'][0][1]).astype(np.int64)))
+  return results
+
+# Pairs aligned together by alignPairsBatch in each engine
+BATCH_PAIRS = 50
+
+def alignPairs(points, pairs, mirror=False, maxIter=1000, progress=None, onChunk=None, chunkSize=BATCH_PAIRS, pairTimes=None, seeds=None,
+               tolerance=0.0, pairIterations=None, exhaustive=True, kernel='library'):
+  """Runs the kernel over a list of (i, j) pairs in batches of chunkSize,
+  returning {(i, j): result}. onChunk, if given, receives the results of
+  every batch. pairTimes, if given, is filled with {(i, j): seconds}, which
+  times every pair on its own, and pairIterations with {(i, j): locgpd
+  iterations}. The 'library' kernel reports progress after every pair and
+  has no iteration counts. The other arguments only apply to the 'native'
+  kernel: pairs with a starting rotation in seeds are refined from it, and
+  exhaustive refines both handedness of every pair without pruning."""
+  if kernel not in KERNELS:
+    raise ValueError('Unsupported alignment kernel: ' + str(kernel))
+  if kernel == 'library' and seeds is not None:
+    raise ValueError("Seeded refinement needs the 'native' alignment kernel")
+  results = {}
+  step = 1 if pairTimes is not None or kernel == 'library' else max(1, chunkSize)
+  chunk = {}
+  for offset in range(0, len(pairs), step):
+    batch = pairs[offset:offset + step]
+    start = time.time()
+    if kernel == 'library':
+      aligned, infos = libraryAlignPairs(points, batch, mirror), None
+    else:
+      aligned, infos = alignPairsBatch(points, batch, mirror, maxIter, [seeds.get(pair) for pair in batch] if seeds is not None else None,
+                                       tolerance, exhaustive)
+    for k, (pair, result) in enumerate(zip(batch, aligned)):
+      chunk[pair] = results[pair] = result
+      if pairTimes is not None:
+        pairTimes[pair] = time.time() - start
+      if pairIterations is not None and infos is not None:
+        pairIterations[pair] = infos[k]['iterations']
+    if onChunk and (len(chunk) >= chunkSize or offset + len(batch) == len(pairs)):
+      onChunk(chunk)
+      chunk = {}
+    if progress:
+      progress(offset + len(batch), len(pairs))
+  return results
+
+def permutationMatrix(perm):
+  n = len(perm)
+  return csr_matrix((np.ones(n), (np.arange(n), perm)), shape=(n, n))
+
+class Permutation():
+  """Permutation matrix kept as int32 column indices, one per row, which is a
+  quarter of the memory of the sparse matrix. The transpose shares the index
+  array and is inverted only when its indices are read. Multiplying a dense
+  array gathers its rows like the matrix product would, and tocsr() builds
+  the matrix when one is really needed."""
+  __slots__ = ['perm', 'transposed']
+
+  def __init__(self, perm, transposed=False):
+    self.perm = np.asarray(perm, dtype=np.int32)
+    self.transposed = transposed
+
+  @property
+  def indices(self):
+    if self.transposed:
+      return np.argsort(self.perm).astype(np.int32)
+    return self.perm
+
+  @property
+  def shape(self):
+    return (len(self.perm), len(self.perm))
+
+  @property
+  def T(self):
+    return Permutation(self.perm, not self.transposed)
+
+  def tocsr(self):
+    return permutationMatrix(self.indices)
+
+  def __mul__(self, other):
+    if isinstance(other, Permutation):
+      return Permutation(other.indices[self.indices])
+    return np.asarray(other)[self.indices]
+
+  __matmul__ = __mul__
+
+def permutationIndices(matrix):
+  """Column index of the single nonzero in each row of a permutation matrix."""
+  if isinstance(matrix, Permutation):
+    return matrix.indices
+  if isinstance(matrix, np.ndarray):
+    return np.argmax(matrix, axis=1)
+  return np.asarray(matrix.tocsr().indices)
+
+def assemblePairwise(n, results):
+  """Builds the n x n distance, rotation and permutation tables from pair results.
+  The (j, i) entries are the inverses of the computed (i, j) alignments.
+  Pairs missing from results, such as those skipped by candidate pair
+  selection, keep an infinite distance and no permutation."""
+  d = np.full((n, n), np.inf)
+  np.fill_diagonal(d, 0.0)
+  r = [[np.eye(3) for j in range(n)] for i in range(n)]
+  p = [[None for j in range(n)] for i in range(n)]
+  for (i, j), (dist, R, perm) in results.items():
+    d[i, j] = d[j, i] = dist
+    r[i][j] = R
+    r[j][i] = R.T
+    p[i][j] = Permutation(perm)
+    p[j][i] = p[i][j].T
+  return {'d': d, 'r': r, 'p': p}
+
+def findMst(distances):
+  """Minimum spanning tree of the distance graph (Prim's algorithm), as a
+  dense symmetric matrix. Infinite distances are missing edges. Edges between
+  identical meshes are stored as the smallest positive float so that every
+  tree edge stays nonzero."""
+  distances = np.asarray(distances, dtype=float)
+  n = len(distances)
+  tree = np.zeros((n, n))
+  if n == 0:
+    return tree
+  inTree = np.zeros(n, dtype=bool)
+  inTree[0] = True
+  best = distances[0].copy()
+  parent = np.zeros(n, dtype=int)
+  for step in range(n - 1):
+    candidates = np.where(inTree, np.inf, best)
+    node = int(np.argmin(candidates))
+    if np.isinf(candidates[node]):
+      raise ValueError('Distance graph is not connected, meshes cannot be globalized')
+    tree[node, parent[node]] = tree[parent[node], node] = max(distances[node, parent[node]], np.finfo(float).tiny)
+    inTree[node] = True
+    closer = distances[node] < best
+    best[closer] = distances[node][closer]
+    parent[closer] = node
+  return tree
+
+def treeOrder(mst, reference=0):
+  """Breadth first visiting order and parents of the tree rooted at reference."""
+  n = len(mst)
+  edges = np.asarray(mst) != 0
+  order = [reference]
+  predecessors = -np.ones(n, dtype=int)
+  seen = np.zeros(n, dtype=bool)
+  seen[reference] = True
+  for node in order:
+    for child in np.nonzero(edges[node] & ~seen)[0]:
+      seen[child] = True
+      predecessors[child] = node
+      order.append(int(child))
+  return order, predecessors
+
+def globalize(pairwise, mst, reference=0):
+  """Composes pairwise alignments along the tree into one rotation and
+  permutation per mesh, expressed in the frame and point order of reference."""
+  n = len(mst)
+  order, predecessors = treeOrder(mst, reference)
+  if len(order) != n:
+    raise ValueError('Distance graph is not connected, meshes cannot be globalized')
+  npoints = pairwise['p'][order[1]][order[0]].shape[0] if n > 1 else 0
+  rotations = [None] * n
+  indices = [None] * n
+  rotations[reference] = np.eye(3)
+  indices[reference] = np.arange(npoints)
+  for node in order[1:]:
+    parent = predecessors[node]
+    rotations[node] = rotations[parent] @ pairwise['r'][parent][node]
+    indices[node] = permutationIndices(pairwise['p'][parent][node])[indices[parent]]
+  return {'r': rotations, 'p': [Permutation(idx) for idx in indices]}
+
+def correspondenceFromPairs(n, results, reference=0):
+  """Minimum spanning tree and globalization over already aligned pairs."""
+  pairwise = assemblePairwise(n, results)
+  mst = findMst(pairwise['d'])
+  return CorrespondenceResult(pairwise, mst, globalize(pairwise, mst, reference), reference)
+
+def computeCorrespondence(points, mirror=False, maxIter=1000, progress=None, reference=0, tolerance=0.0, kernel='library'):
+  """Serial pairwise alignment, minimum spanning tree and globalization."""
+  points = [np.asarray(p, dtype=float) for p in points]
+  results = alignPairs(points, pairList(len(points)), mirror, maxIter, progress, tolerance=tolerance, kernel=kernel)
+  return correspondenceFromPairs(len(points), results, reference)
@@ -0,0 +1,100 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+import slicer
+
+from Auto3dgmLib.viewer import decimate
+
+#
+# Aligned meshes in the Slicer scene
+#
+# Every mesh is one model node whose vtkPolyData wraps the mesh's own vertex
+# array without copying it (or a decimated copy of it), under a linear
+# transform node. The topology and
+# points never change; showing another phase's alignment only sets the
+# transform matrices, and meshes are laid out on a grid so they do not
+# overlap.
+#
+
+def polyDataFromArrays(vertices, faces):
+  """vtkPolyData whose points are a view of the (n, 3) vertices array. VTK
+  keeps a reference to the array. Faces are copied once into the int64
+  layout of vtkCellArray unless they already have it."""
+  vertices = np.ascontiguousarray(vertices)
+  if vertices.dtype not in (np.float32, np.float64):
+    vertices = vertices.astype(np.float64)
+  points = vtk.vtkPoints()
+  try:
+    points.SetData(numpy_support.numpy_to_vtk(vertices, deep=False))
+  except (TypeError, ValueError):
+    # Read-only memory mapped arrays from the mesh cache cannot be wrapped
+    points.SetData(numpy_support.numpy_to_vtk(vertices, deep=True))
+  faces = np.asarray(faces)
+  cells = vtk.vtkCellArray()
+  if len(faces):
+    size = faces.shape[1]
+    if hasattr(cells, 'SetData'):
+      offsets = np.arange(0, size * (len(faces) + 1), size, dtype=np.int64)
+      connectivity = np.ascontiguousarray(faces, dtype=np.int64).reshape(-1)
+      cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=False),
+                    numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=False))
+    else:
+      # VTK 8 stores the size of every cell in front of its point ids
+      legacy = np.empty((len(faces), size + 1), dtype=np.int64)
+      legacy[:, 0] = size
+      legacy[:, 1:] = faces
+      cells.SetCells(len(faces), numpy_support.numpy_to_vtkIdTypeArray(legacy.reshape(-1), deep=False))
+  polyData = vtk.vtkPolyData()
+  polyData.SetPoints(points)
+  polyData.SetPolys(cells)
+  return polyData
+
+def gridOffsets(count, spacing):
+  """Centers of count cells of a square grid in the x/y plane."""
+  columns = max(1, int(np.ceil(np.sqrt(count))))
+  return [np.array([(k % columns) * spacing, -(k // columns) * spacing, 0.0]) for k in range(count)]
+
+class AlignedMeshDisplay():
+  """Model and transform nodes of a sequence of meshes, shown with one
+  rotation per mesh.
+
+  Nodes are made while the meshes are iterated and no mesh is kept, so a
+  StreamedMeshes dataset is read once, a few meshes at a time. With faces
+  set, meshes with more triangles are shown as decimated copies
+  (Auto3dgmLib.viewer.decimate) instead of wrapping their full arrays."""
+  def __init__(self, meshes, spacing=None, faces=0):
+    self.modelNodes = []
+    self.transformNodes = []
+    self.source = meshes
+    radii = []
+    for mesh in meshes:
+      vertices, triangles = mesh.vertices, mesh.faces
+      if faces:
+        vertices, triangles = decimate(vertices, triangles, faces)
+      radii.append(np.sqrt((np.asarray(vertices) ** 2).sum(axis=1).max()))
+      transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', mesh.name + ' alignment')
+      modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', mesh.name)
+      modelNode.SetAndObservePolyData(polyDataFromArrays(vertices, triangles))
+      modelNode.CreateDefaultDisplayNodes()
+      modelNode.SetAndObserveTransformNodeID(transformNode.GetID())
+      self.transformNodes.append(transformNode)
+      self.modelNodes.append(modelNode)
+    if spacing is None:
+      spacing = 2.5 * max(radii or [1.0])
+    self.offsets = gridOffsets(len(self.modelNodes), spacing)
+    self.showRotations([np.eye(3)] * len(self.modelNodes))
+
+  def showRotations(self, rotations):
+    for transformNode, offset, r in zip(self.transformNodes, self.offsets, rotations):
+      matrix = vtk.vtkMatrix4x4()
+      for i in range(3):
+        for j in range(3):
+          matrix.SetElement(i, j, float(r[i][j]))
+        matrix.SetElement(i, 3, float(offset[i]))
+      transformNode.SetMatrixTransformToParent(matrix)
+
+  def remove(self):
+    for node in self.modelNodes + self.transformNodes:
+      slicer.mrmlScene.RemoveNode(node)
+    self.modelNodes = []
+    self.transformNodes = []
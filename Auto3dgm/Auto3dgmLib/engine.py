@@ -0,0 +1,151 @@
+import logging
+import tempfile
+
+import numpy as np
+
+from Auto3dgmLib.checkpoint import Checkpoint
+from Auto3dgmLib.cluster import alignPairsCluster
+from Auto3dgmLib.correspondence import KERNELS, MIRROR_PRUNE_ITERATIONS, MIRROR_PRUNE_MARGIN, alignPairs, pairList
+from Auto3dgmLib.pairstore import PairStore, pointsDigest
+from Auto3dgmLib.parallel import alignPairsParallel
+
+#
+# Pairwise alignment of a whole phase
+#
+
+PROCESSING_MODES = ['single', 'multicore', 'cluster']
+
+def alignmentParameters(mirror, seeded=False, maxIter=1000, tolerance=0.0, exhaustive=True, kernel='library'):
+  """Parameters that determine pairwise results, used to key stored results.
+  Library kernel results only depend on mirror. Pruned reflection searches
+  carry their pruning constants, so they never share results with
+  exhaustive runs or with other constants."""
+  if kernel == 'library':
+    return {'kernel': 'library', 'mirror': bool(mirror)}
+  parameters = {'mirror': bool(mirror), 'maxIter': int(maxIter)}
+  if seeded:
+    parameters['seeded'] = True
+  if tolerance:
+    parameters['tolerance'] = float(tolerance)
+  if mirror and not exhaustive:
+    parameters['mirrorPrune'] = [MIRROR_PRUNE_ITERATIONS, MIRROR_PRUNE_MARGIN]
+  return parameters
+
+def meshKeys(points, seedKeys=None):
+  """Per mesh identity of the inputs of a pair result: the point set digest,
+  plus what the seed rotations were derived from for seeded runs."""
+  digests = [pointsDigest(p) for p in points]
+  if seedKeys is None:
+    return digests
+  return [digest + '/' + key for digest, key in zip(digests, seedKeys)]
+
+def checkpointManifest(points, mirror, seedKeys=None, maxIter=1000, tolerance=0.0, exhaustive=True, kernel='library'):
+  return {
+    'parameters': alignmentParameters(mirror, seedKeys is not None, maxIter, tolerance, exhaustive, kernel),
+    'npoints': [len(p) for p in points],
+    'meshes': meshKeys(points, seedKeys),
+  }
+
+def checkpointStatus(points, mirror, checkpointFolder, seedKeys=None, maxIter=1000, tolerance=0.0, exhaustive=True, kernel='library'):
+  return Checkpoint(checkpointFolder, checkpointManifest(points, mirror, seedKeys, maxIter, tolerance, exhaustive, kernel)).status()
+
+def convergenceStats(pairIterations, results, maxIter):
+  """Iterations and final distances of the newly computed pairs: means,
+  maxima and how many pairs stopped at maxIter rather than converging."""
+  if not pairIterations:
+    return {'pairs': 0}
+  iterations = np.array(list(pairIterations.values()))
+  residuals = np.array([results[pair][0] for pair in pairIterations])
+  return {
+    'pairs': len(iterations),
+    'mean_iterations': float(iterations.mean()),
+    'max_iterations': int(iterations.max()),
+    'at_iteration_limit': int((iterations >= maxIter).sum()),
+    'mean_residual': float(residuals.mean()),
+    'max_residual': float(residuals.max()),
+  }
+
+def alignAllPairs(points, mirror=False, processing='single', workers=None, progress=None, executable=None,
+                  clusterFolder=None, pairStoreFolder=None, checkpointFolder=None, resume=True, pairTimes=None, counts=None,
+                  seeds=None, seedKeys=None, candidates=None, maxIter=1000, tolerance=0.0, pairIterations=None,
+                  exhaustive=True, kernel='library'):
+  """Aligns every pair of point sets, or only the candidates pairs when given,
+  and returns {(i, j): result} for i < j in pairList order.
+
+  processing selects the engine ('single', 'multicore' or 'cluster'); all give
+  identical results. Pairs found in the pair store under pairStoreFolder, or
+  in a matching checkpoint under checkpointFolder, are not recomputed. Newly
+  finished pairs are checkpointed chunk by chunk and the checkpoint is removed
+  once the run completes. pairTimes, if given, is filled with the seconds of
+  every newly computed pair and counts with how many pairs came from where.
+
+  seeds, {(i, j): rotation}, switches pairs from the full search to a local
+  refinement of those rotations (correspondence.refinePair), as used by
+  progressive coarse-to-fine phases. seedKeys then names per mesh what the
+  seeds were computed from, so stored and checkpointed seeded results are
+  only reused for the same coarser inputs.
+
+  Each pair runs at most maxIter locgpd iterations and, with a tolerance,
+  stops once an iteration improves its distance by less than that fraction.
+  pairIterations, if given, is filled with the iterations of every newly
+  computed pair. exhaustive turns off the pruning of principal axis starts
+  and of the worse handedness in correspondence.alignPair, to verify it.
+
+  kernel is 'library', auto3dgm_nazar's Correspondence per pair, or
+  'native', the batched kernel of correspondence.py. Seeds, maxIter,
+  tolerance and exhaustive only apply to the native kernel.
+  """
+  if processing not in PROCESSING_MODES:
+    raise ValueError('Unsupported processing mode: ' + str(processing))
+  if kernel not in KERNELS:
+    raise ValueError('Unsupported alignment kernel: ' + str(kernel))
+  if seeds is not None and kernel == 'library':
+    raise ValueError("Progressive refinement needs the 'native' alignment kernel")
+  if seeds is not None and seedKeys is None:
+    raise ValueError('Seeded alignment needs seedKeys')
+  selected = pairList(len(points)) if candidates is None else sorted(set(tuple(pair) for pair in candidates))
+  pairs = list(selected)
+  digests = meshKeys(points, seedKeys if seeds is not None else None)
+  known = {}
+  store = None
+  if pairStoreFolder:
+    store = PairStore(pairStoreFolder, alignmentParameters(mirror, seeds is not None, maxIter, tolerance, exhaustive, kernel))
+    known, pairs = store.lookup(digests, pairs)
+  checkpoint = None
+  onChunk = None
+  if checkpointFolder:
+    checkpoint = Checkpoint(checkpointFolder, checkpointManifest(points, mirror, seedKeys if seeds is not None else None, maxIter, tolerance, exhaustive,
+                                                                 kernel))
+    wanted = set(pairs)
+    resumed = dict((pair, result) for pair, result in checkpoint.open(resume).items() if pair in wanted)
+    pairs = [pair for pair in pairs if pair not in resumed]
+    onChunk = checkpoint.saveBlock
+  else:
+    resumed = {}
+  logging.info("Aligning %d pairs (%d stored, %d resumed from checkpoint)" % (len(pairs), len(known), len(resumed)))
+  if counts is not None:
+    counts.update(computed=len(pairs), stored=len(known), resumed=len(resumed))
+
+  if not pairs:
+    results = {}
+  elif processing == 'single':
+    results = alignPairs(points, pairs, mirror, maxIter, progress=progress, onChunk=onChunk, pairTimes=pairTimes, seeds=seeds,
+                         tolerance=tolerance, pairIterations=pairIterations, exhaustive=exhaustive, kernel=kernel)
+  elif processing == 'multicore':
+    results = alignPairsParallel(points, pairs, mirror, maxIter, workers=workers, progress=progress, executable=executable, onChunk=onChunk,
+                                 pairTimes=pairTimes, seeds=seeds, tolerance=tolerance, pairIterations=pairIterations,
+                                 exhaustive=exhaustive, kernel=kernel)
+  else:
+    if clusterFolder is None:
+      clusterFolder = tempfile.mkdtemp(prefix='auto3dgm_cluster_')
+    results = alignPairsCluster(points, pairs, clusterFolder, mirror, maxIter, workers=workers or 1, progress=progress, executable=executable,
+                                onChunk=onChunk, pairTimes=pairTimes, seeds=seeds, tolerance=tolerance, pairIterations=pairIterations,
+                                exhaustive=exhaustive, kernel=kernel)
+
+  results.update(resumed)
+  if store is not None:
+    store.add(digests, results)
+  results.update(known)
+  if checkpoint is not None:
+    checkpoint.remove()
+  return dict((pair, results[pair]) for pair in selected)
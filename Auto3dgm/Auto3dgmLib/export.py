@@ -0,0 +1,229 @@
+import collections
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from Auto3dgmLib.correspondence import permutationIndices
+
+try:
+  import h5py
+except ImportError: # HDF5 output is optional, install h5py to enable it
+  h5py = None
+
+#
+# Batched export of aligned meshes and landmarks
+#
+
+def landmarkIndices(permutation):
+  """Vertex index of every landmark, from a Permutation, a permutation
+  matrix or an index array."""
+  if hasattr(permutation, 'tocsr'):
+    return permutationIndices(permutation)
+  return np.asarray(permutation)
+
+def alignedLandmarks(points, rotations, permutations):
+  """Landmarks of every specimen, points[i][index] rotated by rotations[i].
+  Same values as permutations[i] * (points[i] @ rotations[i].T) but gathers
+  the landmark rows first instead of multiplying by a sparse matrix."""
+  return [np.asarray(x)[landmarkIndices(p)] @ np.asarray(r).T for x, r, p in zip(points, rotations, permutations)]
+
+# 'ascii' keeps the full float64 vertex coordinates, like the meshes
+# exported before batching; 'binary' is float32 little endian, smaller and
+# faster to write and read.
+PLY_FORMATS = ['ascii', 'binary']
+
+def writePly(path, vertices, faces, format='ascii'):
+  """Writes a PLY file of vertices and polygon faces of one size, without
+  building a mesh object."""
+  if format not in PLY_FORMATS:
+    raise ValueError('Unsupported PLY format: ' + str(format))
+  vertices = np.asarray(vertices, dtype=np.float64 if format == 'ascii' else '<f4')
+  faces = np.asarray(faces)
+  if faces.ndim != 2:
+    faces = faces.reshape(0, 3)
+  coordinate = 'double' if format == 'ascii' else 'float'
+  header = '\n'.join([
+    'ply',
+    'format ascii 1.0' if format == 'ascii' else 'format binary_little_endian 1.0',
+    'element vertex %d' % len(vertices),
+    'property %s x' % coordinate,
+    'property %s y' % coordinate,
+    'property %s z' % coordinate,
+    'element face %d' % len(faces),
+    'property list uchar int vertex_indices',
+    'end_header',
+  ]) + '\n'
+  with open(path, 'wb') as f:
+    f.write(header.encode('ascii'))
+    if format == 'ascii':
+      # str of a Python float is its shortest exact representation
+      prefix = '%d ' % faces.shape[1]
+      f.write(''.join(' '.join(map(str, row)) + '\n' for row in vertices.tolist()).encode('ascii'))
+      f.write(''.join(prefix + ' '.join(map(str, row)) + '\n' for row in faces.tolist()).encode('ascii'))
+    else:
+      records = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', (faces.shape[1],))])
+      records['n'] = faces.shape[1]
+      records['v'] = faces
+      f.write(np.ascontiguousarray(vertices).tobytes())
+      f.write(records.tobytes())
+
+def readPly(path):
+  """(vertices, faces) of a PLY file laid out like writePly's, in either
+  format: x, y, z vertices and uchar int face lists of one size."""
+  with open(path, 'rb') as f:
+    lines = []
+    while not lines or lines[-1] != 'end_header':
+      line = f.readline()
+      if not line:
+        raise ValueError('Not a PLY file: ' + path)
+      lines.append(line.decode('ascii').strip())
+    counts = dict((l.split()[1], int(l.split()[2])) for l in lines if l.startswith('element'))
+    if 'property list uchar int vertex_indices' not in lines:
+      raise ValueError('Unsupported PLY layout: ' + path)
+    if 'format ascii 1.0' in lines:
+      rows = f.read().split(b'\n')
+      vertices = np.array([row.split() for row in rows[:counts['vertex']]], dtype=np.float64).reshape(-1, 3)
+      faces = [row.split()[1:] for row in rows[counts['vertex']:counts['vertex'] + counts['face']]]
+      return vertices, np.array(faces, dtype=np.int32) if faces else np.zeros((0, 3), dtype=np.int32)
+    if 'format binary_little_endian 1.0' not in lines or 'property float x' not in lines:
+      raise ValueError('Unsupported PLY layout: ' + path)
+    vertices = np.fromfile(f, dtype='<f4', count=3 * counts['vertex']).reshape(-1, 3)
+    data = f.read()
+  if counts['face'] == 0:
+    return vertices, np.zeros((0, 3), dtype=np.int32)
+  size = data[0]
+  records = np.frombuffer(data, dtype=[('n', 'u1'), ('v', '<i4', (size,))], count=counts['face'])
+  return vertices, np.array(records['v'])
+
+def writeCsv(path, array):
+  """Same text as np.savetxt(path, array, delimiter=',', fmt='%s'), formatted
+  from Python floats in one pass instead of row by row through numpy."""
+  with open(path, 'w') as f:
+    f.write(''.join(','.join(map(str, row)) + '\n' for row in np.asarray(array).tolist()))
+
+class BoundedWriter():
+  """Runs file writes on a thread pool while the caller prepares the next
+  ones. At most backlog writes are queued, so only that many prepared arrays
+  are held at once."""
+  def __init__(self, workers=None, backlog=None, progress=None, total=None):
+    self.workers = workers or min(8, (os.cpu_count() or 1))
+    self.backlog = backlog or 2 * self.workers
+    self.progress = progress
+    self.total = total
+    self.pending = collections.deque()
+    self.done = 0
+    self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+  def collect(self, limit):
+    while len(self.pending) > limit:
+      self.pending.popleft().result()
+      self.done += 1
+      if self.progress:
+        self.progress(self.done, self.total)
+
+  def submit(self, function, *args):
+    self.collect(self.backlog - 1)
+    self.pending.append(self.pool.submit(function, *args))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, exc, tb):
+    try:
+      if excType is None:
+        self.collect(0)
+    finally:
+      self.pool.shutdown(wait=True)
+    return False
+
+def exportMeshes(meshes, rotations, folder, workers=None, progress=None, format='ascii'):
+  """Writes every mesh rotated by its rotation to folder/<name>.ply, as ascii
+  or binary PLY (PLY_FORMATS).
+
+  Rotating a centered mesh keeps it centered and its scale unchanged, so the
+  vertices are only multiplied once and not centered, scaled or copied again.
+  meshes may be streamed; only the backlog of the writer is held in memory.
+  """
+  with BoundedWriter(workers, progress=progress, total=len(rotations)) as writer:
+    for mesh, r in zip(meshes, rotations):
+      vertices = np.asarray(mesh.vertices) @ np.asarray(r).T
+      writer.submit(writePly, os.path.join(folder, mesh.name + '.ply'), vertices, mesh.faces, format)
+
+def exportLandmarks(names, landmarks, folder, workers=None):
+  """Writes landmarks[i] to folder/<names[i]>.csv."""
+  with BoundedWriter(workers, total=len(landmarks)) as writer:
+    for name, l in zip(names, landmarks):
+      writer.submit(writeCsv, os.path.join(folder, name + '.csv'), l)
+
+LANDMARK_FORMATS = ['csv', 'npy', 'hdf5']
+
+def writeLandmarkArchive(folder, names, landmarks, rotations, permutations, format='npy'):
+  """Writes all landmarks of a phase as one (specimens, points, 3) array with
+  the rotations (specimens, 3, 3), the landmark vertex indices (specimens,
+  points) and the specimen names, either as landmarks.npy, rotations.npy,
+  permutations.npy and specimens.json in folder, or as folder/landmarks.h5.
+  Returns the path of the landmark array."""
+  count = len(landmarks)
+  shapes = set(np.shape(l) for l in landmarks)
+  if len(shapes) > 1:
+    raise ValueError('Landmark arrays of different shapes can not be archived together: ' + str(sorted(shapes)))
+  points = shapes.pop()[0] if shapes else 0
+  r = np.array([np.asarray(x, dtype=np.float64) for x in rotations]).reshape(count, 3, 3)
+  p = np.array([landmarkIndices(x) for x in permutations], dtype=np.int32).reshape(count, points)
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  if format == 'npy':
+    path = os.path.join(folder, 'landmarks.npy')
+    array = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.float64, shape=(count, points, 3))
+    for idx, l in enumerate(landmarks):
+      array[idx] = l
+    array.flush()
+    del array
+    os.replace(path + '.tmp.npy', path)
+    np.save(os.path.join(folder, 'rotations.npy'), r)
+    np.save(os.path.join(folder, 'permutations.npy'), p)
+    with open(os.path.join(folder, 'specimens.json'), 'w') as f:
+      json.dump(list(names), f, indent=1)
+  elif format == 'hdf5':
+    if h5py is None:
+      raise ImportError('HDF5 landmark output needs the h5py package')
+    path = os.path.join(folder, 'landmarks.h5')
+    with h5py.File(path + '.tmp', 'w') as f:
+      array = f.create_dataset('landmarks', shape=(count, points, 3), dtype='f8', chunks=(1, max(points, 1), 3))
+      for idx, l in enumerate(landmarks):
+        array[idx] = l
+      f.create_dataset('rotations', data=r)
+      f.create_dataset('permutations', data=p)
+      f.create_dataset('specimens', data=list(names), dtype=h5py.string_dtype())
+    os.replace(path + '.tmp', path)
+  else:
+    raise ValueError('Unsupported landmark archive format: ' + str(format))
+  return path
+
+def readLandmarkArchive(folder):
+  """{'landmarks', 'rotations', 'permutations', 'specimens'} of an archive
+  written by writeLandmarkArchive. .npy arrays are memory mapped; an HDF5
+  archive is read into memory."""
+  h5 = os.path.join(folder, 'landmarks.h5')
+  if os.path.exists(os.path.join(folder, 'landmarks.npy')):
+    with open(os.path.join(folder, 'specimens.json')) as f:
+      specimens = json.load(f)
+    return {
+      'landmarks': np.load(os.path.join(folder, 'landmarks.npy'), mmap_mode='r'),
+      'rotations': np.load(os.path.join(folder, 'rotations.npy'), mmap_mode='r'),
+      'permutations': np.load(os.path.join(folder, 'permutations.npy'), mmap_mode='r'),
+      'specimens': specimens,
+    }
+  if os.path.exists(h5):
+    if h5py is None:
+      raise ImportError('Reading HDF5 landmark archives needs the h5py package')
+    with h5py.File(h5, 'r') as f:
+      return {
+        'landmarks': f['landmarks'][()],
+        'rotations': f['rotations'][()],
+        'permutations': f['permutations'][()],
+        'specimens': [n.decode('utf-8') if isinstance(n, bytes) else n for n in f['specimens'][()]],
+      }
+  raise IOError('No landmark archive in ' + folder)
@@ -0,0 +1,134 @@
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+#
+# Furthest point sampling
+#
+# The sequence is defined as: start at startIndex(vertices, seed), then
+# repeatedly take the vertex with the largest squared distance to the
+# vertices chosen so far, the lowest index on ties. Both methods compute the
+# same squared distances in the same order of operations, so they return the
+# same indices for the same seed.
+#
+
+FPS_METHODS = ['dense', 'kdtree']
+
+# Bump when the sequence definition changes so cached subsamples are not reused.
+# 2: the start vertex is drawn at random as in auto3dgm_nazar's Subsample.
+ENGINE_VERSION = 2
+
+# The kdtree method updates every vertex for the first few points, while the
+# covering radius is still about the size of the mesh.
+DENSE_STEPS = 32
+
+class SquaredDistances():
+  """Squared distances from one vertex to all or some of the vertices, kept as
+  three contiguous coordinate columns with reusable output buffers."""
+  def __init__(self, vertices, dtype=np.float64):
+    columns = np.ascontiguousarray(np.asarray(vertices, dtype=dtype).T)
+    self.x, self.y, self.z = columns
+    self.n = len(self.x)
+    self.out = np.empty(self.n, dtype=dtype)
+    self.tmp = np.empty(self.n, dtype=dtype)
+
+  def fromVertex(self, i, subset=None):
+    if subset is None:
+      x, y, z, out, tmp = self.x, self.y, self.z, self.out, self.tmp
+    else:
+      x, y, z = self.x[subset], self.y[subset], self.z[subset]
+      out, tmp = np.empty_like(x), np.empty_like(x)
+    np.subtract(x, self.x[i], out=out)
+    np.multiply(out, out, out=out)
+    np.subtract(y, self.y[i], out=tmp)
+    np.multiply(tmp, tmp, out=tmp)
+    np.add(out, tmp, out=out)
+    np.subtract(z, self.z[i], out=tmp)
+    np.multiply(tmp, tmp, out=tmp)
+    np.add(out, tmp, out=out)
+    return out
+
+def startIndex(vertices, seed=None):
+  """A random vertex, as auto3dgm_nazar's Subsample starts: drawn with
+  np.random.randint from numpy's global generator, or from RandomState(seed)
+  when a seed is given so seeded runs repeat."""
+  n = len(vertices)
+  if seed is None:
+    return int(np.random.randint(n))
+  return int(np.random.RandomState(seed).randint(n))
+
+def furthestPointIndices(vertices, count, seed=None, method='dense', dtype=np.float64, start=None):
+  """Indices of count furthest point samples of an (n, 3) vertex array.
+
+  'dense' updates the distance of every vertex after each pick. 'kdtree'
+  only updates the vertices within the current covering radius of the new
+  pick, found through a KD-tree; vertices further away cannot get closer.
+  float32 halves the memory traffic on very large meshes, but near ties may
+  then resolve differently than in float64. start, when given, is the first
+  vertex instead of startIndex(vertices, seed).
+  """
+  if method not in FPS_METHODS:
+    raise ValueError('Unsupported furthest point sampling method: ' + str(method))
+  vertices = np.asarray(vertices, dtype=np.float64)
+  n = len(vertices)
+  if count > n:
+    raise ValueError('Cannot sample %d points from %d vertices' % (count, n))
+  indices = np.empty(count, dtype=np.int64)
+  if count == 0:
+    return indices
+  distances = SquaredDistances(vertices, dtype)
+  indices[0] = startIndex(vertices, seed) if start is None else start
+  nearest = distances.fromVertex(indices[0]).copy()
+  tree = cKDTree(vertices) if method == 'kdtree' and count > DENSE_STEPS else None
+  for k in range(1, count):
+    i = int(np.argmax(nearest))
+    indices[k] = i
+    if tree is None or k < DENSE_STEPS:
+      np.minimum(nearest, distances.fromVertex(i), out=nearest)
+    else:
+      # Only vertices closer to i than their current nearest pick change,
+      # and all of those lie within the covering radius sqrt(nearest[i]).
+      radius = np.sqrt(float(nearest[i])) * (1 + 1e-6) + 1e-12
+      subset = np.asarray(tree.query_ball_point(vertices[i], radius), dtype=np.int64)
+      if len(subset):
+        nearest[subset] = np.minimum(nearest[subset], distances.fromVertex(i, subset))
+  return indices
+
+def sampledIndices(vertices, sampled):
+  """Index in vertices of every row of sampled, a subset of the vertices in
+  sampling order, e.g. the output of a sampler that returns points rather
+  than indices."""
+  distance, indices = cKDTree(np.asarray(vertices)).query(np.asarray(sampled))
+  if len(distance) and distance.max() > 1e-9:
+    raise ValueError('Sampled points are not vertices of the mesh')
+  return indices.astype(np.int64)
+
+def nestedSubsamples(vertices, indices, counts):
+  """{count: vertices of the first count indices} for every count, all
+  gathered from one copy of the largest subsample. Greedy samplers pick the
+  same first points whatever the total, so smaller subsamples are prefixes
+  of larger ones."""
+  sampled = np.asarray(vertices)[indices[:max(counts)]]
+  return dict((count, sampled[:count]) for count in counts)
+
+def mapOrdered(function, items, workers=None, backlog=None):
+  """Yields function(item) for every item in order, computed on a pool of
+  threads. At most backlog items are in flight, so a streamed sequence is not
+  loaded all at once."""
+  workers = workers or min(8, (os.cpu_count() or 1))
+  if workers <= 1:
+    for item in items:
+      yield function(item)
+    return
+  backlog = backlog or 2 * workers
+  pending = collections.deque()
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for item in items:
+      pending.append(pool.submit(function, item))
+      if len(pending) >= backlog:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
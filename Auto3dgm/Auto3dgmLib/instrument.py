@@ -0,0 +1,208 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+  import resource
+except ImportError: # Windows
+  resource = None
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+#
+# Per stage timing, memory and count records of a pipeline run
+#
+
+MB = 1024.0 * 1024.0
+
+def peakRssMb(who='self'):
+  """Peak resident set size in MB of this process ('self') or of its waited
+  for child processes ('children') since they started, None where it can not
+  be measured. It never goes down, so it does not tell which stage used the
+  memory; see RssSampler for that."""
+  if resource is not None:
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+  if psutil is not None and who == 'self':
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) / MB
+  return None
+
+def currentRssMb():
+  """Current resident set size in MB of this process, from /proc/self/statm
+  or psutil, None where neither is available."""
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+  except (IOError, OSError, ValueError, IndexError, AttributeError):
+    pass
+  if psutil is not None:
+    return psutil.Process().memory_info().rss / MB
+  return None
+
+class RssSampler():
+  """Samples the current RSS on a thread every interval seconds while a stage
+  runs. peak - start is the most memory the stage held on top of what was
+  resident when it started, as far as the samples catch it."""
+  def __init__(self, interval=0.02):
+    self.interval = interval
+    self.start = self.peak = currentRssMb()
+    self.stopped = threading.Event()
+    self.thread = None
+    if self.start is not None:
+      self.thread = threading.Thread(target=self.run, name='RssSampler')
+      self.thread.daemon = True
+      self.thread.start()
+
+  def sample(self):
+    rss = currentRssMb()
+    if rss is not None and rss > self.peak:
+      self.peak = rss
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.sample()
+
+  def stop(self):
+    """(start, peak) RSS in MB, or (None, None) where it can not be measured."""
+    if self.thread is None:
+      return None, None
+    self.stopped.set()
+    self.thread.join()
+    self.sample()
+    return self.start, self.peak
+
+def cpuSeconds():
+  """CPU seconds used by this process and its waited for child processes."""
+  t = os.times()
+  return t.user + t.system + t.children_user + t.children_system
+
+def histogram(values, bins=10):
+  """Summary and log spaced histogram of positive values such as seconds."""
+  values = np.asarray(values, dtype=float)
+  if not len(values):
+    return {'count': 0}
+  low, high = max(values.min(), 1e-9), max(values.max(), 1e-9)
+  edges = np.geomspace(low, high * (1 + 1e-9), bins + 1) if high > low else np.array([low, high * (1 + 1e-9) + 1e-9])
+  counts, edges = np.histogram(np.clip(values, low, None), bins=edges)
+  return {
+    'count': int(len(values)),
+    'min': float(values.min()),
+    'median': float(np.median(values)),
+    'p90': float(np.percentile(values, 90)),
+    'max': float(values.max()),
+    'total': float(values.sum()),
+    'edges': [float(e) for e in edges],
+    'counts': [int(c) for c in counts],
+  }
+
+class StageRecord():
+  """Counts and histograms collected while a stage runs."""
+  def __init__(self, name, counts):
+    self.name = name
+    self.counts = dict(counts)
+    self.histograms = {}
+
+  def count(self, **counts):
+    self.counts.update(counts)
+
+  def histogram(self, key, values):
+    self.histograms[key] = histogram(values)
+
+class Instrumentation():
+  """Records wall and CPU time, memory and counts of named stages.
+
+  Every finished stage is appended to records and, when logPath is set, as
+  one JSON line to that file. The stage named profileStage also runs under
+  cProfile and its stats are dumped next to the log.
+  """
+  def __init__(self, logPath=None, profileStage=None):
+    self.logPath = logPath
+    self.profileStage = profileStage
+    self.records = []
+    self.lock = threading.Lock()
+
+  def stage(self, name, **counts):
+    return StageContext(self, name, counts)
+
+  def profilePath(self, name):
+    folder = os.path.dirname(self.logPath) if self.logPath else os.getcwd()
+    return os.path.join(folder, 'profile_%s_%s.prof' % (name.replace(' ', '_'), time.strftime('%Y%m%d_%H%M%S')))
+
+  def add(self, record):
+    with self.lock:
+      self.records.append(record)
+      if self.logPath:
+        folder = os.path.dirname(self.logPath)
+        if folder and not os.path.exists(folder):
+          os.makedirs(folder)
+        with open(self.logPath, 'a') as f:
+          f.write(json.dumps(record, sort_keys=True) + '\n')
+
+  def summaryRows(self):
+    """[(stage, wall s, cpu s, stage memory MB, counts text)] for display."""
+    rows = []
+    for record in self.records:
+      counts = ', '.join('%s %s' % (key, value) for key, value in sorted(record['counts'].items()))
+      rows.append((record['stage'] + ('' if record['status'] == 'ok' else ' (' + record['status'] + ')'),
+        record['wall_s'], record['cpu_s'], record['stage_rss_mb'], counts))
+    return rows
+
+class StageContext():
+  def __init__(self, instrumentation, name, counts):
+    self.instrumentation = instrumentation
+    self.record = StageRecord(name, counts)
+    self.profile = None
+
+  def __enter__(self):
+    if self.instrumentation is not None and self.instrumentation.profileStage == self.record.name:
+      self.profile = cProfile.Profile()
+      self.profile.enable()
+    self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    self.wall = time.time()
+    self.cpu = cpuSeconds()
+    self.rss = RssSampler() if self.instrumentation is not None else None
+    return self.record
+
+  def __exit__(self, excType, exc, tb):
+    wall = time.time() - self.wall
+    cpu = cpuSeconds() - self.cpu
+    if self.instrumentation is None:
+      return False
+    rssStart, rssPeak = self.rss.stop()
+    record = {
+      'stage': self.record.name,
+      'status': 'ok' if excType is None else excType.__name__,
+      'started': self.started,
+      'wall_s': wall,
+      'cpu_s': cpu,
+      # RSS at the start of the stage and the most it grew during the stage
+      'rss_start_mb': rssStart,
+      'stage_rss_mb': None if rssStart is None else rssPeak - rssStart,
+      # Lifetime peaks of the process and its children so far, not per stage
+      'process_peak_rss_mb': peakRssMb('self'),
+      'process_peak_children_rss_mb': peakRssMb('children'),
+      'counts': self.record.counts,
+    }
+    if self.record.histograms:
+      record['histograms'] = self.record.histograms
+    if self.profile is not None:
+      self.profile.disable()
+      record['profile'] = self.instrumentation.profilePath(self.record.name)
+      self.profile.dump_stats(record['profile'])
+    self.instrumentation.add(record)
+    return False
+
+def stage(instrumentation, name, **counts):
+  """instrumentation.stage(name, **counts), or a stage that records nothing
+  when instrumentation is None."""
+  return StageContext(instrumentation, name, counts)
@@ -0,0 +1,79 @@
+import threading
+import traceback
+
+#
+# Background jobs
+#
+
+class JobCancelled(Exception):
+  """Raised inside a job's worker when the user asked to stop it."""
+  pass
+
+class BackgroundJob():
+  """Runs target(job) on a worker thread.
+
+  The worker reports progress through job.reporter(stage)(done, total); the
+  GUI thread polls progress() from a timer instead of being called back, so
+  no Qt object is ever touched from the worker. Cancellation is cooperative:
+  the next progress report after cancel() raises JobCancelled in the worker.
+  """
+  def __init__(self, target, name=''):
+    self.target = target
+    self.name = name
+    self.result = None
+    self.error = None
+    self.errorTraceback = None
+    self.cancelled = False
+    self._cancelEvent = threading.Event()
+    self._lock = threading.Lock()
+    self._stage = name
+    self._done = 0
+    self._total = 0
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name='Auto3dgm ' + self.name)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def _run(self):
+    try:
+      self.result = self.target(self)
+    except JobCancelled:
+      self.cancelled = True
+    except Exception as e:
+      self.error = e
+      self.errorTraceback = traceback.format_exc()
+
+  def cancel(self):
+    self._cancelEvent.set()
+
+  def isCancelRequested(self):
+    return self._cancelEvent.is_set()
+
+  def checkCancelled(self):
+    if self._cancelEvent.is_set():
+      raise JobCancelled(self.name)
+
+  def isRunning(self):
+    return self._thread is not None and self._thread.is_alive()
+
+  def wait(self, timeout=None):
+    if self._thread is not None:
+      self._thread.join(timeout)
+
+  def report(self, stage, done, total):
+    with self._lock:
+      self._stage = stage
+      self._done = done
+      self._total = total
+    self.checkCancelled()
+
+  def reporter(self, stage):
+    """Returns a progress(done, total) callable bound to a stage label."""
+    return lambda done, total: self.report(stage, done, total)
+
+  def progress(self):
+    with self._lock:
+      return self._stage, self._done, self._total
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+#
+# Parsed mesh arrays cached as memory mappable .npy files
+#
+
+MESH_CACHE_VERSION = 1
+
+# Entries put before index.json is written at the latest, while it is small
+INDEX_BATCH = 64
+
+class MeshArrayCache():
+  """Vertex and face arrays of parsed mesh files, after center/scale.
+
+  Each mesh is stored as <key>_vertices.npy and <key>_faces.npy and read back
+  memory mapped. index.json records the size and mtime of every source file;
+  an entry whose source changed since is treated as missing and overwritten.
+  The index is written by flush() after a load or a streamed pass
+  (StreamedMeshes finish), and by put() only whenever
+  it has grown by half since it was last written, so a cold load of N files
+  does not rewrite it N times. Entries lost before a write are parsed again.
+  """
+  def __init__(self, folder):
+    self.folder = folder
+    self.indexPath = os.path.join(folder, 'index.json')
+    self.lock = threading.Lock()
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+    self.index = self.readIndex()
+    self.unsaved = 0
+    self.hits = 0
+    self.misses = 0
+
+  def readIndex(self):
+    try:
+      with open(self.indexPath) as f:
+        index = json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+    if index.get('version') != MESH_CACHE_VERSION:
+      return {}
+    return index.get('meshes', {})
+
+  def writeIndex(self):
+    tmp = self.indexPath + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'version': MESH_CACHE_VERSION, 'meshes': self.index}, f, indent=1, sort_keys=True)
+    os.replace(tmp, self.indexPath)
+    self.unsaved = 0
+
+  def flush(self):
+    with self.lock:
+      if self.unsaved:
+        self.writeIndex()
+
+  def paths(self, meshFile):
+    key = hashlib.sha1(os.path.abspath(meshFile.path).encode('utf-8')).hexdigest()
+    base = os.path.join(self.folder, key)
+    return base + '_vertices.npy', base + '_faces.npy'
+
+  def get(self, meshFile):
+    """(vertices, faces) memory mapped read-only, or None if missing or stale."""
+    with self.lock:
+      entry = self.index.get(os.path.abspath(meshFile.path))
+    if entry is None or entry['size'] != meshFile.size or entry['mtime'] != meshFile.mtime:
+      with self.lock:
+        self.misses += 1
+      return None
+    verticesPath, facesPath = self.paths(meshFile)
+    try:
+      arrays = np.load(verticesPath, mmap_mode='r'), np.load(facesPath, mmap_mode='r')
+    except (IOError, OSError, ValueError):
+      with self.lock:
+        self.misses += 1
+      return None
+    with self.lock:
+      self.hits += 1
+    return arrays
+
+  def put(self, meshFile, vertices, faces):
+    verticesPath, facesPath = self.paths(meshFile)
+    for path, array in [(verticesPath, vertices), (facesPath, faces)]:
+      tmp = path + '.tmp.npy'
+      np.save(tmp, np.ascontiguousarray(array))
+      os.replace(tmp, path)
+    with self.lock:
+      self.index[os.path.abspath(meshFile.path)] = {'size': meshFile.size, 'mtime': meshFile.mtime}
+      self.unsaved += 1
+      if self.unsaved >= max(INDEX_BATCH, len(self.index) // 2):
+        self.writeIndex()
+
+  def clear(self):
+    with self.lock:
+      shutil.rmtree(self.folder, ignore_errors=True)
+      os.makedirs(self.folder)
+      self.index = {}
+      self.unsaved = 0
+
+  def report(self):
+    return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.index)}
+
+def cachedArrays(meshFile, parse, cache=None):
+  """(vertices, faces) of meshFile from the cache, or from parse(meshFile)
+  which is then cached."""
+  if cache is not None:
+    arrays = cache.get(meshFile)
+    if arrays is not None:
+      return arrays
+  vertices, faces = parse(meshFile)
+  if cache is not None:
+    cache.put(meshFile, vertices, faces)
+  return vertices, faces
+
+def loadMeshArrays(files, parse, cache=None, workers=None, progress=None):
+  """[(vertices, faces)] for files, in order, parsed on a pool of threads.
+  progress(done, total) is called from the calling thread."""
+  workers = workers or min(8, (os.cpu_count() or 1))
+  results = [None] * len(files)
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+    futures = [pool.submit(cachedArrays, f, parse, cache) for f in files]
+    for idx, future in enumerate(futures):
+      results[idx] = future.result()
+      if progress:
+        progress(idx + 1, len(files))
+  return results
@@ -0,0 +1,74 @@
+import numpy as np
+
+from Auto3dgmLib.correspondence import findMst, pairList
+
+#
+# Candidate pairs from cheap shape descriptors
+#
+# Globalization only follows a minimum spanning tree of the distance graph,
+# so most of the N(N-1)/2 pairwise alignments never influence the result.
+# Meshes whose rotation and reflection invariant descriptors are far apart
+# are unlikely to be tree neighbors and are not aligned at all.
+#
+
+def shapeDescriptor(points, bins=32, maxPairs=200000, seed=0):
+  """Rotation, reflection and scale invariant descriptor of a point set: the
+  D2 histogram of point distances relative to their mean, followed by the
+  normalized principal moments. Large sets use a fixed random sample of
+  pairs so the descriptor of a point set is always the same."""
+  points = np.asarray(points, dtype=float)
+  n = len(points)
+  if n * (n - 1) // 2 <= maxPairs:
+    i, j = np.triu_indices(n, 1)
+  else:
+    rng = np.random.RandomState(seed)
+    i = rng.randint(0, n, maxPairs)
+    j = (i + rng.randint(1, n, maxPairs)) % n
+  distances = np.linalg.norm(points[i] - points[j], axis=1)
+  histogram = np.histogram(distances / max(distances.mean(), 1e-12), bins=bins, range=(0.0, 3.0))[0]
+  centered = points - points.mean(axis=0)
+  moments = np.linalg.svd(centered, compute_uv=False) ** 2
+  return np.concatenate([histogram / float(max(len(distances), 1)), moments / max(moments.sum(), 1e-12)])
+
+def descriptorDistances(points):
+  descriptors = np.array([shapeDescriptor(p) for p in points])
+  return np.sqrt(((descriptors[:, None, :] - descriptors[None, :, :]) ** 2).sum(axis=2))
+
+def candidatePairs(points, neighbors):
+  """Pairs (i, j), i < j, in pairList order, linking every mesh to its
+  neighbors nearest meshes by descriptor distance. The edges of the
+  descriptor distance spanning tree are always added so the candidate graph
+  is connected. All pairs are returned when neighbors covers every mesh."""
+  n = len(points)
+  if neighbors <= 0 or neighbors >= n - 1:
+    return pairList(n)
+  distances = descriptorDistances(points)
+  candidates = set()
+  ranked = np.argsort(distances + np.diag(np.full(n, np.inf)), axis=1)[:, :neighbors]
+  for i, row in enumerate(ranked):
+    for j in row:
+      candidates.add((min(i, int(j)), max(i, int(j))))
+  tree = findMst(distances)
+  for i, j in zip(*np.nonzero(np.triu(tree))):
+    candidates.add((int(i), int(j)))
+  return sorted(candidates)
+
+def treeEdges(mst):
+  return set((int(i), int(j)) for i, j in zip(*np.nonzero(np.triu(np.asarray(mst)))))
+
+def compareMst(mst, exhaustiveMst, distances):
+  """How far a spanning tree found on candidate pairs is from the tree of
+  the exhaustive run: shared edges, their fraction, and the tree weight
+  relative to the exhaustive one (1.0 when both are minimal), both weighed
+  with the exhaustive distances."""
+  edges = treeEdges(mst)
+  exhaustive = treeEdges(exhaustiveMst)
+  distances = np.asarray(distances)
+  weight = sum(distances[i, j] for i, j in edges)
+  exhaustiveWeight = sum(distances[i, j] for i, j in exhaustive)
+  return {
+    'edges': len(exhaustive),
+    'shared_edges': len(edges & exhaustive),
+    'edge_agreement': len(edges & exhaustive) / float(max(len(exhaustive), 1)),
+    'weight_ratio': weight / exhaustiveWeight if exhaustiveWeight else 1.0,
+  }
@@ -0,0 +1,95 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from Auto3dgmLib.cache import meshDigest
+
+#
+# Persisted pairwise alignment results
+#
+
+# Bump when the pairwise kernel changes so stored results are not reused.
+# 2: batched Procrustes and cdist matching costs (alignPairsBatch).
+# 3: auto3dgm_nazar's sign flips of the principal axes as starts.
+ENGINE_VERSION = 3
+
+def pointsDigest(points):
+  """Identity of a subsampled point set; pair results depend only on these."""
+  return meshDigest(np.asarray(points, dtype=np.float64))
+
+class PairStore():
+  """Pairwise alignments keyed by the digests of the two point sets.
+
+  Results live under folder/<parameter hash>/ as block_*.npz files, one per
+  call to add(), so runs with other alignment parameters never share
+  results. A stored alignment of b onto a also answers the pair (b, a) by
+  inverting the rotation and permutation.
+  """
+  def __init__(self, folder, parameters):
+    self.parameters = dict(parameters, engine=ENGINE_VERSION)
+    paramHash = hashlib.sha1(json.dumps(self.parameters, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    self.folder = os.path.join(folder, paramHash)
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+    manifest = os.path.join(self.folder, 'parameters.json')
+    if not os.path.exists(manifest):
+      with open(manifest, 'w') as f:
+        json.dump(self.parameters, f, indent=2, sort_keys=True)
+    self.results = None
+
+  def blockPaths(self):
+    return sorted(glob.glob(os.path.join(self.folder, 'block_*.npz')))
+
+  def load(self):
+    self.results = {}
+    for path in self.blockPaths():
+      with np.load(path) as block:
+        for a, b, d, r, p in zip(block['a'], block['b'], block['d'], block['r'], block['p']):
+          self.results[(str(a), str(b))] = (float(d), r, p)
+    return self.results
+
+  def get(self, a, b):
+    if self.results is None:
+      self.load()
+    if (a, b) in self.results:
+      d, r, p = self.results[(a, b)]
+      return d, r, p.astype(np.int64)
+    if (b, a) in self.results:
+      d, r, p = self.results[(b, a)]
+      return d, r.T, np.argsort(p)
+    return None
+
+  def lookup(self, digests, pairs):
+    """Splits pairs into ({pair: stored result}, [pairs still to compute])."""
+    found = {}
+    missing = []
+    for i, j in pairs:
+      result = self.get(digests[i], digests[j])
+      if result is None:
+        missing.append((i, j))
+      else:
+        found[(i, j)] = result
+    return found, missing
+
+  def add(self, digests, results):
+    """Stores {(i, j): (distance, rotation, permutation)} as one new block."""
+    if not results:
+      return
+    if self.results is None:
+      self.load()
+    pairs = list(results)
+    a = np.array([digests[i] for i, j in pairs])
+    b = np.array([digests[j] for i, j in pairs])
+    d = np.array([results[pair][0] for pair in pairs])
+    r = np.array([results[pair][1] for pair in pairs]).reshape(-1, 3, 3)
+    p = np.array([results[pair][2] for pair in pairs], dtype=np.int32)
+    name = 'block_%d_%d' % (int(time.time() * 1000), os.getpid())
+    path = os.path.join(self.folder, name + '.npz')
+    np.savez(path + '.tmp.npz', a=a, b=b, d=d, r=r, p=p)
+    os.replace(path + '.tmp.npz', path)
+    for k, pair in enumerate(pairs):
+      self.results[(str(a[k]), str(b[k]))] = (float(d[k]), r[k], p[k])
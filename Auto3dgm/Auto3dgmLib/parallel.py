@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+from Auto3dgmLib.correspondence import BATCH_PAIRS, alignPairs
+
+try:
+  from multiprocessing import shared_memory
+except ImportError: # Python < 3.8, fall back to a memory mapped .npy file
+  shared_memory = None
+
+#
+# Multi-core pairwise alignment
+#
+
+class SharedPoints():
+  """Subsampled point sets packed into one float64 block that worker processes
+  attach to once, instead of receiving pickled copies with every pair."""
+  def __init__(self, points):
+    self.shapes = [np.shape(p) for p in points]
+    sizes = [int(np.prod(shape)) for shape in self.shapes]
+    self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int).tolist()
+    total = self.offsets[-1]
+    self._shm = None
+    self._path = None
+    if shared_memory is not None:
+      self._shm = shared_memory.SharedMemory(create=True, size=max(total, 1) * 8)
+      block = np.ndarray((total,), dtype=np.float64, buffer=self._shm.buf)
+      self.handle = ('shm', self._shm.name, total)
+    else:
+      fd, self._path = tempfile.mkstemp(prefix='auto3dgm_points_', suffix='.npy')
+      os.close(fd)
+      block = np.lib.format.open_memmap(self._path, mode='w+', dtype=np.float64, shape=(total,))
+      self.handle = ('npy', self._path, total)
+    for p, start, end in zip(points, self.offsets[:-1], self.offsets[1:]):
+      block[start:end] = np.asarray(p, dtype=np.float64).ravel()
+    del block
+
+  def spec(self):
+    """Picklable description handed to workers, see attach()."""
+    return self.handle, self.offsets, self.shapes
+
+  def close(self):
+    if self._shm is not None:
+      self._shm.close()
+      self._shm.unlink()
+      self._shm = None
+    if self._path is not None:
+      os.remove(self._path)
+      self._path = None
+
+  @staticmethod
+  def attach(spec):
+    """Returns (owner, points) where points are read-only views into the shared
+    block. owner must be kept alive for as long as the views are used."""
+    (kind, name, total), offsets, shapes = spec
+    if kind == 'shm':
+      owner = shared_memory.SharedMemory(name=name)
+      block = np.ndarray((total,), dtype=np.float64, buffer=owner.buf)
+    else:
+      owner = None
+      block = np.load(name, mmap_mode='r')
+    block.flags.writeable = False
+    points = [block[start:end].reshape(shape) for start, end, shape in zip(offsets[:-1], offsets[1:], shapes)]
+    return owner, points
+
+# State of each worker process, set once by workerInit.
+workerState = {}
+
+def workerInit(spec, mirror, maxIter, tolerance=0.0, exhaustive=True, timePairs=False, kernel='library'):
+  owner, points = SharedPoints.attach(spec)
+  workerState.update(owner=owner, points=points, mirror=mirror, maxIter=maxIter, tolerance=tolerance, exhaustive=exhaustive,
+                     timePairs=timePairs, kernel=kernel)
+
+def workerAlignChunk(task):
+  """[((i, j), result, seconds or None, iterations or None)] for a (pairs,
+  seed rotations or None) chunk, aligned as one batch unless pairs are
+  timed."""
+  pairs, seeds = task
+  pairTimes = {} if workerState['timePairs'] else None
+  pairIterations = {}
+  results = alignPairs(workerState['points'], pairs, workerState['mirror'], workerState['maxIter'], chunkSize=len(pairs),
+                       pairTimes=pairTimes, seeds=dict(zip(pairs, seeds)) if seeds is not None else None,
+                       tolerance=workerState['tolerance'], pairIterations=pairIterations, exhaustive=workerState['exhaustive'],
+                       kernel=workerState['kernel'])
+  return [(pair, results[pair], pairTimes[pair] if pairTimes is not None else None, pairIterations.get(pair)) for pair in pairs]
+
+def chunkPairs(pairs, workers, chunksPerWorker=4, maxSize=BATCH_PAIRS):
+  """Splits the pair list into contiguous shards, several per worker so that
+  slow shards do not leave the other workers idle. Shards hold at most
+  maxSize pairs, so progress, cancellation and checkpoints come every few
+  dozen pairs however long the list is."""
+  size = max(1, min(maxSize, int(np.ceil(len(pairs) / float(max(1, workers) * chunksPerWorker)))))
+  return [pairs[start:start + size] for start in range(0, len(pairs), size)]
+
+def defaultWorkerCount():
+  return max(1, multiprocessing.cpu_count() - 1)
+
+def alignPairsParallel(points, pairs, mirror=False, maxIter=1000, workers=None, progress=None, executable=None, onChunk=None, pairTimes=None, seeds=None,
+                       tolerance=0.0, pairIterations=None, exhaustive=True, kernel='library'):
+  """Same contract and results as correspondence.alignPairs, computed on a pool
+  of worker processes. executable overrides the interpreter used for workers
+  (Slicer needs its PythonSlicer launcher rather than the application)."""
+  workers = workers or defaultWorkerCount()
+  context = multiprocessing.get_context('spawn')
+  if executable:
+    context.set_executable(executable)
+  shared = SharedPoints(points)
+  pool = context.Pool(workers, initializer=workerInit, initargs=(shared.spec(), mirror, maxIter, tolerance, exhaustive,
+                                                                     pairTimes is not None, kernel))
+  tasks = [(shard, [seeds.get(pair) for pair in shard] if seeds is not None else None) for shard in chunkPairs(pairs, workers)]
+  results = {}
+  try:
+    for timed in pool.imap_unordered(workerAlignChunk, tasks):
+      chunk = dict((pair, result) for pair, result, seconds, iterations in timed)
+      results.update(chunk)
+      if pairTimes is not None:
+        pairTimes.update((pair, seconds) for pair, result, seconds, iterations in timed)
+      if pairIterations is not None:
+        pairIterations.update((pair, iterations) for pair, result, seconds, iterations in timed if iterations is not None)
+      if onChunk:
+        onChunk(chunk)
+      if progress:
+        progress(len(results), len(pairs))
+    pool.close()
+  except BaseException:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    shared.close()
+  # Same key order as the serial engine
+  return dict((pair, results[pair]) for pair in pairs)
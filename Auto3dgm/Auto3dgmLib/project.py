@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from Auto3dgmLib.correspondence import CorrespondenceResult, Permutation, pairList, permutationIndices
+
+#
+# Project files: subsamples and correspondence results of a finished analysis
+#
+# A project is a folder holding project.json (parameters, specimens, phases)
+# and .npy arrays that are memory mapped on load:
+#
+#   subsample_<points>.npy       (specimens, points, 3) subsampled points
+#   phase<k>/distances.npy       (specimens, specimens) pairwise distances
+#   phase<k>/pair_rotations.npy  (pairs, 3, 3) rotation of every pair i < j
+#   phase<k>/pair_permutations.npy (pairs, points) vertex indices, uint16 when
+#                                   they fit
+#   phase<k>/mst.npy             (specimens, specimens) spanning tree
+#   phase<k>/rotations.npy       (specimens, 3, 3) globalized rotations
+#   phase<k>/permutations.npy    (specimens, points) globalized indices
+#
+# Pairs are stored in pairList order; the (j, i) alignment is the inverse of
+# the stored (i, j) one. Pairs that were not aligned have an infinite
+# distance and an identity rotation and permutation.
+#
+
+PROJECT_VERSION = 1
+PROJECT_FILE = 'project.json'
+
+def pairIndex(n, i, j):
+  """Position of the pair (i, j), i < j, in pairList(n)."""
+  return i * (2 * n - i - 1) // 2 + (j - i - 1)
+
+def indexDtype(points):
+  return np.uint16 if points <= np.iinfo(np.uint16).max + 1 else np.int32
+
+class PairwiseTables():
+  """Read-only stand in for the {'d', 'r', 'p'} pairwise tables of a
+  correspondence, reading single pairs from the memory mapped arrays."""
+  def __init__(self, folder):
+    self.folder = folder
+    self.arrays = {}
+
+  def array(self, name):
+    if name not in self.arrays:
+      self.arrays[name] = np.load(os.path.join(self.folder, name + '.npy'), mmap_mode='r')
+    return self.arrays[name]
+
+  def keys(self):
+    return ['d', 'r', 'p']
+
+  def __getitem__(self, key):
+    if key == 'd':
+      return self.array('distances')
+    if key in ('r', 'p'):
+      return PairTable(self, key)
+    raise KeyError(key)
+
+  def pair(self, key, i, j):
+    n = len(self.array('distances'))
+    if i == j:
+      if key == 'r':
+        return np.eye(3)
+      return Permutation(np.arange(self.array('pair_permutations').shape[1]))
+    k = pairIndex(n, min(i, j), max(i, j))
+    if key == 'r':
+      r = np.array(self.array('pair_rotations')[k])
+      return r if i < j else r.T
+    return Permutation(self.array('pair_permutations')[k], transposed=i > j)
+
+class PairTable():
+  def __init__(self, tables, key):
+    self.tables = tables
+    self.key = key
+
+  def __len__(self):
+    return len(self.tables.array('distances'))
+
+  def __getitem__(self, i):
+    return PairRow(self, i)
+
+class PairRow():
+  def __init__(self, table, i):
+    self.table = table
+    self.i = i
+
+  def __len__(self):
+    return len(self.table)
+
+  def __getitem__(self, j):
+    return self.table.tables.pair(self.table.key, self.i, j)
+
+def saveArray(path, array):
+  np.save(path, np.ascontiguousarray(array))
+
+def savePhase(folder, corr):
+  os.makedirs(folder)
+  pairwise = corr.pairwise_alignment
+  d = np.asarray(pairwise['d'])
+  n = len(d)
+  pairs = pairList(n)
+  points = len(permutationIndices(corr.globalized_alignment['p'][0])) if n else 0
+  rotations = np.lib.format.open_memmap(os.path.join(folder, 'pair_rotations.npy'), mode='w+', dtype=np.float64, shape=(len(pairs), 3, 3))
+  permutations = np.lib.format.open_memmap(os.path.join(folder, 'pair_permutations.npy'), mode='w+', dtype=indexDtype(points), shape=(len(pairs), points))
+  for k, (i, j) in enumerate(pairs):
+    if pairwise['p'][i][j] is None:
+      rotations[k] = np.eye(3)
+      permutations[k] = np.arange(points)
+      continue
+    rotations[k] = pairwise['r'][i][j]
+    permutations[k] = permutationIndices(pairwise['p'][i][j])
+  rotations.flush()
+  permutations.flush()
+  del rotations, permutations
+  saveArray(os.path.join(folder, 'distances.npy'), d)
+  saveArray(os.path.join(folder, 'mst.npy'), np.asarray(corr.mst_matrix))
+  saveArray(os.path.join(folder, 'rotations.npy'), np.array(corr.globalized_alignment['r']).reshape(n, 3, 3))
+  saveArray(os.path.join(folder, 'permutations.npy'),
+    np.array([permutationIndices(p) for p in corr.globalized_alignment['p']], dtype=np.int32).reshape(n, points))
+
+def writeProject(folder, parameters, specimens, subsamples, phases):
+  """Writes a project folder, replacing any project already there.
+
+  specimens: [{'name', 'path', ...}] in dataset order.
+  subsamples: {points: [(points, 3) array per specimen]}.
+  phases: {phase number: CorrespondenceResult}.
+  """
+  tmp = folder.rstrip(os.sep) + '.tmp'
+  shutil.rmtree(tmp, ignore_errors=True)
+  os.makedirs(tmp)
+  for points, arrays in subsamples.items():
+    saveArray(os.path.join(tmp, 'subsample_%d.npy' % points), np.array([np.asarray(a, dtype=np.float64) for a in arrays]))
+  phaseInfo = {}
+  for phase, corr in phases.items():
+    savePhase(os.path.join(tmp, 'phase%d' % phase), corr)
+    phaseInfo[str(phase)] = {'reference': int(getattr(corr, 'reference', 0))}
+  manifest = {
+    'version': PROJECT_VERSION,
+    'parameters': parameters,
+    'specimens': list(specimens),
+    'subsamples': sorted(int(points) for points in subsamples),
+    'phases': phaseInfo,
+  }
+  with open(os.path.join(tmp, PROJECT_FILE), 'w') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  shutil.rmtree(folder, ignore_errors=True)
+  os.rename(tmp, folder)
+
+def isProject(folder):
+  return os.path.isfile(os.path.join(folder, PROJECT_FILE))
+
+class Project():
+  """A saved project opened for reading. Nothing but project.json is read up
+  front; arrays are memory mapped when first used."""
+  def __init__(self, folder):
+    self.folder = folder
+    with open(os.path.join(folder, PROJECT_FILE)) as f:
+      manifest = json.load(f)
+    if manifest.get('version') != PROJECT_VERSION:
+      raise ValueError('Unsupported Auto3dgm project version: ' + str(manifest.get('version')))
+    self.parameters = manifest['parameters']
+    self.specimens = manifest['specimens']
+    self.subsamplePoints = manifest['subsamples']
+    self.phases = dict((int(phase), info) for phase, info in manifest['phases'].items())
+
+  def subsample(self, points):
+    return np.load(os.path.join(self.folder, 'subsample_%d.npy' % points), mmap_mode='r')
+
+  def correspondence(self, phase):
+    """CorrespondenceResult whose pairwise tables are read on demand."""
+    folder = os.path.join(self.folder, 'phase%d' % phase)
+    rotations = np.load(os.path.join(folder, 'rotations.npy'))
+    permutations = np.load(os.path.join(folder, 'permutations.npy'))
+    globalized = {'r': list(rotations), 'p': [Permutation(p) for p in permutations]}
+    return CorrespondenceResult(PairwiseTables(folder), np.load(os.path.join(folder, 'mst.npy'), mmap_mode='r'),
+      globalized, self.phases[phase]['reference'])
@@ -0,0 +1,129 @@
+import collections
+import os
+import queue
+import threading
+
+#
+# Meshes loaded from disk on demand
+#
+
+MESH_EXTENSIONS = ('.ply', '.obj', '.stl')
+
+# What stays resident per specimen of a streamed dataset.
+MeshFile = collections.namedtuple('MeshFile', ['path', 'name', 'size', 'mtime'])
+
+def meshFiles(folder, extensions=MESH_EXTENSIONS):
+  """MeshFile records of the mesh files in folder, sorted by file name."""
+  files = []
+  for entry in sorted(os.listdir(folder)):
+    path = os.path.join(folder, entry)
+    name, extension = os.path.splitext(entry)
+    if extension.lower() in extensions and os.path.isfile(path):
+      stat = os.stat(path)
+      files.append(MeshFile(path, name, stat.st_size, stat.st_mtime))
+  return files
+
+_DONE = object()
+
+def prefetch(items, load, depth=2):
+  """Yields load(item) for each item in order while a background thread loads
+  up to depth items ahead. At most depth + 2 loaded items are alive at once:
+  the queued ones, the one being loaded and the one handed out."""
+  if depth < 1:
+    for item in items:
+      yield load(item)
+    return
+  buffer = queue.Queue(maxsize=depth)
+  stop = threading.Event()
+
+  def put(entry):
+    while not stop.is_set():
+      try:
+        buffer.put(entry, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for item in items:
+        if not put((True, load(item))):
+          return
+      put((_DONE, None))
+    except BaseException as e:
+      put((False, e))
+
+  thread = threading.Thread(target=produce, name='Auto3dgm prefetch')
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      ok, value = buffer.get()
+      if ok is _DONE:
+        return
+      if not ok:
+        raise value
+      yield value
+      value = None
+  finally:
+    # Also reached when the consumer stops early, e.g. on cancellation
+    stop.set()
+    thread.join()
+
+class StreamedMeshes():
+  """Read-only sequence of meshes backed by files.
+
+  Only the MeshFile records stay resident. Indexing loads a mesh and iterating
+  streams them through prefetch(), so peak memory is bounded by the prefetch
+  depth instead of the number of specimens. Meshes are loaded again on every
+  access; nothing is kept. finish() is called when an iteration ends, also
+  early, e.g. to flush the index of the mesh cache the loads went through.
+  """
+  def __init__(self, files, load, depth=2, function=None, finish=None):
+    self.files = list(files)
+    self.load = load
+    self.depth = depth
+    self.function = function
+    self.finish = finish
+
+  def loadItem(self, item):
+    index, f = item
+    mesh = self.load(f)
+    return mesh if self.function is None else self.function(index, mesh)
+
+  def __len__(self):
+    return len(self.files)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      if self.function is not None:
+        raise TypeError('Mapped StreamedMeshes can not be sliced')
+      return StreamedMeshes(self.files[index], self.load, self.depth, finish=self.finish)
+    index = range(len(self.files))[index]
+    return self.loadItem((index, self.files[index]))
+
+  def __iter__(self):
+    meshes = prefetch(enumerate(self.files), self.loadItem, self.depth)
+    try:
+      for mesh in meshes:
+        yield mesh
+    finally:
+      # Stops the loading thread first, so no load is still running
+      meshes.close()
+      if self.finish is not None:
+        self.finish()
+
+  def __repr__(self):
+    return '<StreamedMeshes of %d files>' % len(self.files)
+
+  @property
+  def names(self):
+    return [f.name for f in self.files]
+
+  def map(self, function):
+    """Streamed sequence of function(index, mesh), e.g. aligned copies."""
+    if self.function is not None:
+      inner = self.function
+      return StreamedMeshes(self.files, self.load, self.depth, lambda index, mesh: function(index, inner(index, mesh)), self.finish)
+    return StreamedMeshes(self.files, self.load, self.depth, function, self.finish)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""Parameter sweep over subsampling settings.
+
+Runs load -> subsample -> phase 1 -> phase 2 through Auto3dgmLogic for every
+combination of phase point numbers, FPS seeds and subsampling methods, and
+writes one row per configuration with its runtime and alignment quality:
+
+  Slicer --no-main-window --python-script /path/to/Auto3dgmLib/sweep.py \\
+    --input meshes/ --output sweep/ --phase1-points 100 200 \\
+    --phase2-points 500 1000 --fps-seeds none 0 --cpus 8
+
+Work common to several configurations is done once: the meshes are loaded
+once, each mesh is subsampled once per method and seed at the largest point
+number of the sweep (smaller point numbers are its prefixes, and seeds only
+matter to FPS), and each distinct phase alignment runs once, e.g. phase 1 of
+configurations that differ only in their phase 2 points. Alignments run one
+at a time, each on all --cpus, since they share the instrumentation and
+Auto3dgmLogic.correspondence is not meant to run on several threads.
+
+The table is printed and written to <output>/sweep.csv, and with the
+parameters and task counts to <output>/sweep.json. Nothing is exported.
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+SUBSAMPLE_METHODS = ['FPS', 'GPL', 'Hybrid']
+FPS_METHODS = ['dense', 'kdtree']
+KERNELS = ['library', 'native']
+
+# Columns of the comparison table, in order
+TABLE_COLUMNS = ['configuration', 'subsample_method', 'fps_seed', 'phase1_points', 'phase2_points',
+                 'subsample_s', 'phase1_s', 'phase2_s', 'total_s', 'shared_alignments',
+                 'phase2_mean_distance', 'phase2_tree_distance', 'phase2_mean_iterations', 'angle_to_reference_deg']
+
+def parseSeed(text):
+  return None if text.lower() == 'none' else int(text)
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description="Run the Auto3dgm pipeline over a grid of subsampling settings")
+  parser.add_argument('--input', required=True, help="Folder of input meshes")
+  parser.add_argument('--output', required=True, help="Folder for the comparison table and instrumentation log")
+  parser.add_argument('--phase1-points', type=int, nargs='+', required=True, help="Phase 1 point numbers to try")
+  parser.add_argument('--phase2-points', type=int, nargs='+', required=True, help="Phase 2 point numbers to try")
+  parser.add_argument('--fps-seeds', type=parseSeed, nargs='+', default=[None], help="FPS seeds to try, 'none' for the default start")
+  parser.add_argument('--subsample-methods', choices=SUBSAMPLE_METHODS, nargs='+', default=['FPS'], help="Subsampling methods to try")
+  parser.add_argument('--fps-method', choices=FPS_METHODS, default='kdtree', help="Furthest point sampling engine, both give the same samples")
+  parser.add_argument('--max-iterations', type=int, default=1000, help="Maximum iterations for pairwise alignment")
+  parser.add_argument('--tolerance', type=float, default=0.0, help="Stop a pair once an iteration improves its distance by less than this fraction")
+  parser.add_argument('--reflection', action='store_true', help="Allow meshes to be reflected")
+  parser.add_argument('--kernel', choices=KERNELS, default='library', help="Pair alignment kernel: auto3dgm_nazar's Correspondence or the faster native one, which --progressive needs")
+  parser.add_argument('--progressive', action='store_true', help="Refine phase 2 from the phase 1 rotations")
+  parser.add_argument('--neighbors', type=int, default=0, help="Align each mesh only with this many nearest meshes by shape descriptor, 0 for all pairs")
+  parser.add_argument('--cpus', type=int, default=None, help="Worker processes for loading, subsampling and each alignment, all processors by default")
+  parser.add_argument('--stream', action='store_true', help="Load meshes from disk when used instead of all at once")
+  parser.add_argument('--no-mesh-cache', action='store_true', help="Parse every mesh file instead of reading unchanged ones from the mesh cache")
+  parser.add_argument('--no-subsample-cache', action='store_true', help="Do not reuse cached subsamples (runs without an FPS seed never do)")
+  return parser.parse_args(argv)
+
+def sweepGrid(phase1Points, phase2Points, seeds, methods):
+  """One configuration dict per combination, in argument order."""
+  grid = []
+  for method, seed, points1, points2 in itertools.product(methods, seeds, phase1Points, phase2Points):
+    name = '%s_seed%s_%d_%d' % (method, 'none' if seed is None else seed, points1, points2)
+    grid.append({'configuration': name, 'subsample_method': method, 'fps_seed': seed,
+                 'phase1_points': points1, 'phase2_points': points2})
+  return grid
+
+def samplingKey(config):
+  """Configurations with the same key share their subsamples. The seed only
+  selects the start of furthest point sampling."""
+  method = config['subsample_method']
+  return (method, config['fps_seed'] if method == 'FPS' else None)
+
+def phasePoints(config):
+  return [config['phase1_points'], config['phase2_points']]
+
+def alignmentKey(config, phase, progressive=False):
+  """Configurations with the same key share the alignment of that phase. A
+  progressive phase also depends on the point sets of the earlier phases."""
+  points = phasePoints(config)
+  return samplingKey(config) + (tuple(points[:phase]) if progressive else (points[phase - 1],))
+
+def alignmentQuality(corr):
+  """Mean pairwise distance over the aligned pairs and over the edges of the
+  minimum spanning tree of a correspondence result."""
+  distances = np.asarray(corr.pairwise_alignment['d'], dtype=float)
+  aligned = np.isfinite(distances) & ~np.eye(len(distances), dtype=bool)
+  tree = np.asarray(corr.mst_matrix) != 0
+  return {
+    'mean_distance': float(distances[aligned].mean()) if aligned.any() else 0.0,
+    'tree_distance': float(distances[tree].mean()) if tree.any() else 0.0,
+  }
+
+def rotationAgreement(rotations, reference):
+  """Mean angle in degrees between two sets of globalized rotations of the
+  same meshes, after removing the overall rotation between their frames."""
+  rotations = np.array([np.asarray(r, dtype=float) for r in rotations])
+  reference = np.array([np.asarray(r, dtype=float) for r in reference])
+  relative = rotations @ np.swapaxes(reference, 1, 2)
+  u, s, vt = np.linalg.svd(relative.sum(axis=0))
+  frame = u @ vt
+  residual = np.swapaxes(frame, 0, 1)[None] @ relative
+  cosines = np.clip((np.trace(residual, axis1=1, axis2=2) - 1) / 2.0, -1.0, 1.0)
+  return float(np.degrees(np.arccos(cosines)).mean())
+
+def configurationData(args, config, meshes, subsamples, instrumentation):
+  """Auto3dgmData of one configuration, whose dataset collection shares the
+  loaded meshes and the subsample lists of its sampling key."""
+  from Auto3dgm import Auto3dgmData, Auto3dgmLogic
+
+  data = Auto3dgmData()
+  data.inputFolder = args.input
+  data.instrumentation = instrumentation
+  data.phase1SampledPoints = config['phase1_points']
+  data.phase2SampledPoints = config['phase2_points']
+  data.progressive = args.progressive
+  data.neighbors = args.neighbors
+  data.maxIterations = args.max_iterations
+  data.convergenceTolerance = args.tolerance
+  data.alignmentKernel = args.kernel
+  data.fpsSeed = config['fps_seed']
+  data.subsampleMethod = config['subsample_method']
+  data.fpsMethod = args.fps_method
+  data.datasetCollection = Auto3dgmLogic.createDatasetCollection(meshes, config['configuration'])
+  for points in sorted(set(phasePoints(config))):
+    data.datasetCollection.add_dataset({points: subsamples[points]}, points)
+  return data
+
+def runSweep(args, grid):
+  """Runs the sweep and returns (table rows, task counts)."""
+  from Auto3dgm import Auto3dgmData, Auto3dgmLogic
+  from Auto3dgmLib.cache import SubsampleCache
+  from Auto3dgmLib.instrument import Instrumentation
+  from Auto3dgmLib.meshcache import MeshArrayCache
+
+  cpus = args.cpus or os.cpu_count() or 1
+  instrumentation = Instrumentation(os.path.join(args.output, 'instrumentation.jsonl'))
+  meshCache = None if args.no_mesh_cache else MeshArrayCache(Auto3dgmLogic.cacheFolder('meshes'))
+  collection = Auto3dgmLogic.createDataset(args.input, stream=args.stream, workers=cpus, meshCache=meshCache,
+                                           instrumentation=instrumentation)
+  meshes = collection.datasets[0]
+
+  # One subsampling per sampling key, at every point number its
+  # configurations use
+  samplings = {}
+  for config in grid:
+    samplings.setdefault(samplingKey(config), set()).update(phasePoints(config))
+  subsamples = {}
+  subsampleSeconds = {}
+  for key, points in samplings.items():
+    print("Auto3dgm sweep: subsample %s seed %s at %s points" % (key[0], key[1], sorted(points)))
+    sampling = Auto3dgmData()
+    sampling.instrumentation = instrumentation
+    sampling.subsampleMethod, sampling.fpsSeed = key
+    sampling.fpsMethod = args.fps_method
+    if not args.no_subsample_cache:
+      sampling.subsampleCache = SubsampleCache(Auto3dgmLogic.subsampleCacheFolder())
+    sampling.datasetCollection = Auto3dgmLogic.createDatasetCollection(meshes, '%s_%s' % key)
+    start = time.time()
+    Auto3dgmLogic.subsample(sampling, sorted(points), meshes, workers=cpus)
+    subsampleSeconds[key] = time.time() - start
+    subsamples[key] = dict((p, sampling.datasetCollection.datasets[p][p]) for p in points)
+
+  datas = [configurationData(args, config, meshes, subsamples[samplingKey(config)], instrumentation) for config in grid]
+  seconds = [{} for config in grid]
+  shared = [0] * len(grid)
+  alignments = 0
+  for phase in [1, 2]:
+    # The first configuration of each key computes the phase for all of them
+    owners = {}
+    for index, config in enumerate(grid):
+      owners.setdefault(alignmentKey(config, phase, args.progressive), []).append(index)
+    processing = 'multicore' if cpus > 1 else 'single'
+    print("Auto3dgm sweep: phase %d, %d alignments on %d workers" % (phase, len(owners), cpus))
+    for indices in owners.values():
+      start = time.time()
+      corr = Auto3dgmLogic.correspondence(datas[indices[0]], args.reflection, phase=phase, processing=processing, workers=cpus)
+      elapsed = time.time() - start
+      for index in indices:
+        datas[index].datasetCollection.add_analysis_set(corr, "Phase %d" % phase)
+        datas[index].convergence[phase] = datas[indices[0]].convergence.get(phase, {})
+        seconds[index][phase] = elapsed
+        shared[index] += len(indices) > 1
+    alignments += len(owners)
+
+  # The configuration with the most points is the reference for agreement
+  reference = max(range(len(grid)), key=lambda index: (grid[index]['phase2_points'], grid[index]['phase1_points'], -index))
+  referenceRotations = datas[reference].datasetCollection.analysis_sets["Phase 2"].globalized_alignment['r']
+  rows = []
+  for index, config in enumerate(grid):
+    corr = datas[index].datasetCollection.analysis_sets["Phase 2"]
+    quality = alignmentQuality(corr)
+    row = dict(config)
+    row.update({
+      'subsample_s': subsampleSeconds[samplingKey(config)],
+      'phase1_s': seconds[index][1],
+      'phase2_s': seconds[index][2],
+      'total_s': subsampleSeconds[samplingKey(config)] + seconds[index][1] + seconds[index][2],
+      'shared_alignments': shared[index],
+      'phase2_mean_distance': quality['mean_distance'],
+      'phase2_tree_distance': quality['tree_distance'],
+      'phase2_mean_iterations': datas[index].convergence[2].get('mean_iterations'),
+      'angle_to_reference_deg': rotationAgreement(corr.globalized_alignment['r'], referenceRotations),
+    })
+    rows.append(row)
+  counts = {'configurations': len(grid), 'subsamplings': len(samplings), 'alignments': alignments}
+  return rows, counts
+
+def formatCell(value):
+  if isinstance(value, float):
+    return '%.4g' % value
+  return 'none' if value is None else str(value)
+
+def printTable(rows):
+  widths = [max([len(column)] + [len(formatCell(row[column])) for row in rows]) for column in TABLE_COLUMNS]
+  print('  '.join(column.ljust(width) for column, width in zip(TABLE_COLUMNS, widths)))
+  for row in rows:
+    print('  '.join(formatCell(row[column]).ljust(width) for column, width in zip(TABLE_COLUMNS, widths)))
+
+def writeTable(path, rows):
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(TABLE_COLUMNS)
+    for row in rows:
+      writer.writerow([formatCell(row[column]) for column in TABLE_COLUMNS])
+  os.replace(tmp, path)
+
+def main(argv=None):
+  args = parseArguments(sys.argv[1:] if argv is None else argv)
+  if not os.path.exists(args.output):
+    os.makedirs(args.output)
+  grid = sweepGrid(args.phase1_points, args.phase2_points, args.fps_seeds, args.subsample_methods)
+  start = time.time()
+  rows, counts = runSweep(args, grid)
+  summary = {'parameters': vars(args), 'tasks': counts, 'configurations': rows, 'seconds': time.time() - start}
+  printTable(rows)
+  print("%d configurations from %d subsamplings and %d alignments in %.1f s" % (
+    counts['configurations'], counts['subsamplings'], counts['alignments'], summary['seconds']))
+  writeTable(os.path.join(args.output, 'sweep.csv'), rows)
+  tmp = os.path.join(args.output, 'sweep.json.tmp')
+  with open(tmp, 'w') as f:
+    json.dump(summary, f, indent=2, sort_keys=True)
+  os.replace(tmp, os.path.join(args.output, 'sweep.json'))
+  return 0
+
+if __name__ == '__main__':
+  # Run as a script, the folder holding Auto3dgm.py is not on the path yet
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  status = main()
+  try:
+    import slicer
+    slicer.util.exit(status)
+  except (ImportError, AttributeError):
+    sys.exit(status)
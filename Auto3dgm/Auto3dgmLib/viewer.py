@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from Auto3dgmLib.export import BoundedWriter, readPly, writePly
+
+#
+# Web viewer assets
+#
+# The web viewer loads every mesh of a phase into the browser, so full
+# resolution exports make it slow to appear. Each exported aligned mesh is
+# decimated by vertex clustering and quantized once per phase into
+# <folder>/phase<k>/<name>.ply; assets.json records the size and mtime of the
+# source file each asset was made from, and only changed sources are redone.
+# Showing a phase hard links its assets into the served folder.
+#
+
+VIEWER_ASSET_VERSION = 1
+ASSET_INDEX = 'assets.json'
+
+# Faces per mesh shown in the viewer, 0 for the full resolution
+DEFAULT_VIEWER_FACES = 20000
+
+def quantize(vertices, bits=16):
+  """Vertices snapped to a grid of 2**bits steps over their bounding box, as
+  float32. Snapped coordinates repeat, so they compress well in transfer."""
+  vertices = np.asarray(vertices, dtype=np.float64)
+  if not len(vertices):
+    return vertices.astype('<f4')
+  low = vertices.min(axis=0)
+  step = np.maximum(vertices.max(axis=0) - low, 1e-12) / (2 ** bits - 1)
+  return (np.round((vertices - low) / step) * step + low).astype('<f4')
+
+def clusterVertices(vertices, faces, cells):
+  """Merges the vertices within each cell of a cells**3 grid over the bounding
+  box into their mean and drops faces that collapse or repeat."""
+  low = vertices.min(axis=0)
+  size = np.maximum(vertices.max(axis=0) - low, 1e-12)
+  grid = np.minimum((vertices - low) / size * cells, cells - 1).astype(np.int64)
+  keys = (grid[:, 0] * cells + grid[:, 1]) * cells + grid[:, 2]
+  unique, inverse = np.unique(keys, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  counts = np.bincount(inverse, minlength=len(unique)).astype(np.float64)
+  merged = np.stack([np.bincount(inverse, weights=vertices[:, k], minlength=len(unique)) for k in range(3)], axis=1) / counts[:, None]
+  remapped = inverse[faces]
+  valid = (remapped[:, 0] != remapped[:, 1]) & (remapped[:, 1] != remapped[:, 2]) & (remapped[:, 0] != remapped[:, 2])
+  remapped = remapped[valid]
+  # Keep one of the faces joining the same three vertices, in its orientation
+  ordered = np.sort(remapped, axis=1)
+  first = np.unique(ordered, axis=0, return_index=True)[1] if len(ordered) else np.zeros(0, dtype=np.int64)
+  return merged, remapped[np.sort(first)]
+
+def decimate(vertices, faces, targetFaces):
+  """Vertex clustering at the finest grid that leaves at most targetFaces
+  triangles. Meshes already that small, or not made of triangles, are kept."""
+  vertices = np.asarray(vertices, dtype=np.float64)
+  faces = np.asarray(faces)
+  if targetFaces <= 0 or len(faces) <= targetFaces or faces.ndim != 2 or faces.shape[1] != 3:
+    return vertices, faces
+  best = None
+  low, high = 2, max(4, int(4 * np.sqrt(targetFaces)))
+  while low <= high:
+    cells = (low + high) // 2
+    merged, remapped = clusterVertices(vertices, faces, cells)
+    if len(remapped) <= targetFaces:
+      best = (merged, remapped)
+      low = cells + 1
+    else:
+      high = cells - 1
+  return best if best is not None else clusterVertices(vertices, faces, 2)
+
+def makeAsset(source, target, targetFaces):
+  vertices, faces = readPly(source)
+  vertices, faces = decimate(vertices, faces, targetFaces)
+  # Written aside and moved in place, so a link shown in the viewer keeps the
+  # previous asset intact
+  tmp = target + '.tmp'
+  writePly(tmp, quantize(vertices), faces, format='binary')
+  os.replace(tmp, target)
+  return len(faces)
+
+def readIndex(folder):
+  try:
+    with open(os.path.join(folder, ASSET_INDEX)) as f:
+      index = json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+  return index.get('assets', {}) if index.get('version') == VIEWER_ASSET_VERSION else {}
+
+def buildViewerAssets(sourceFolder, assetFolder, targetFaces=DEFAULT_VIEWER_FACES, workers=None, progress=None):
+  """Makes an asset in assetFolder for every .ply file of sourceFolder whose
+  size, mtime or target face count changed since its asset was made, and
+  removes assets of files that are gone. Returns the number of assets made."""
+  if not os.path.isdir(sourceFolder):
+    raise ValueError('No aligned meshes to view in ' + sourceFolder)
+  if not os.path.exists(assetFolder):
+    os.makedirs(assetFolder)
+  index = readIndex(assetFolder)
+  sources = sorted(name for name in os.listdir(sourceFolder) if name.lower().endswith('.ply'))
+  entries = {}
+  stale = []
+  for name in sources:
+    stat = os.stat(os.path.join(sourceFolder, name))
+    entries[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'target_faces': int(targetFaces)}
+    entry = index.get(name)
+    if entry is None or any(entry.get(key) != value for key, value in entries[name].items()) \
+        or not os.path.exists(os.path.join(assetFolder, name)):
+      stale.append(name)
+  for name in set(index) - set(entries):
+    if os.path.exists(os.path.join(assetFolder, name)):
+      os.unlink(os.path.join(assetFolder, name))
+  with BoundedWriter(workers, progress=progress, total=len(stale)) as writer:
+    for name in stale:
+      writer.submit(makeAsset, os.path.join(sourceFolder, name), os.path.join(assetFolder, name), targetFaces)
+  tmp = os.path.join(assetFolder, ASSET_INDEX + '.tmp')
+  with open(tmp, 'w') as f:
+    json.dump({'version': VIEWER_ASSET_VERSION, 'assets': entries}, f, indent=1, sort_keys=True)
+  os.replace(tmp, os.path.join(assetFolder, ASSET_INDEX))
+  return len(stale)
+
+def showViewerAssets(assetFolder, viewerFolder):
+  """Replaces the meshes in the served viewerFolder by hard links to the
+  assets of assetFolder, or copies where links are not supported."""
+  for name in os.listdir(viewerFolder):
+    path = os.path.join(viewerFolder, name)
+    if os.path.isfile(path):
+      os.unlink(path)
+  for name in os.listdir(assetFolder):
+    if not name.lower().endswith('.ply'):
+      continue
+    source, target = os.path.join(assetFolder, name), os.path.join(viewerFolder, name)
+    try:
+      os.link(source, target)
+    except (OSError, AttributeError):
+      shutil.copy2(source, target)
@@ -0,0 +1,652 @@
+"""Tests of the Auto3dgmLib modules that run without Slicer and auto3dgm_nazar.
+
+Run them from this folder with plain Python:
+
+  python -m pytest test_Auto3dgmLib.py
+
+or python -m unittest test_Auto3dgmLib. Widget and Auto3dgmLogic integration
+stays in Auto3dgmTest in Auto3dgm.py, which runs inside Slicer.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import weakref
+
+import numpy as np
+
+
+def rotatedCopies(base, count, rng, noise=0.0):
+  points = []
+  for i in range(count):
+    q = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+    points.append((base + rng.normal(scale=noise, size=base.shape)) @ q.T if noise else base @ q.T)
+  return points
+
+
+class CorrespondenceTest(unittest.TestCase):
+
+  def test_backgroundCorrespondence(self):
+    """ Rotated, shuffled copies of one point set should align back onto each
+    other when run as a background job, and a cancelled job should stop.
+    """
+    from Auto3dgmLib.correspondence import computeCorrespondence
+    from Auto3dgmLib.jobs import BackgroundJob
+    rng = np.random.RandomState(0)
+    base = rng.normal(size=(60, 3)) * [3.0, 2.0, 1.0]
+    points = []
+    for i in range(4):
+      q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+      q = q * np.sign(np.linalg.det(q))
+      points.append((base @ q.T)[rng.permutation(len(base))])
+
+    job = BackgroundJob(lambda job: computeCorrespondence(points, progress=job.reporter("pairs"), kernel='native'), "test").start()
+    job.wait()
+    self.assertIsNone(job.error)
+    self.assertEqual(job.progress(), ("pairs", 6, 6))
+    g = job.result.globalized_alignment
+    landmarks = [g['p'][i] * (points[i] @ g['r'][i].T) for i in range(4)]
+    for l in landmarks[1:]:
+      self.assertLess(np.abs(l - landmarks[0]).max(), 1e-6)
+
+    job = BackgroundJob(lambda job: computeCorrespondence(points, progress=job.reporter("pairs"), kernel='native'), "test")
+    job.cancel()
+    job.start().wait()
+    self.assertTrue(job.cancelled)
+
+  def test_parallelCorrespondence(self):
+    """ The multi-core and spool directory engines must reproduce the serial
+    pairwise results exactly.
+    """
+    from Auto3dgmLib.cluster import alignPairsCluster
+    from Auto3dgmLib.correspondence import alignPairs, pairList
+    from Auto3dgmLib.parallel import alignPairsParallel
+    rng = np.random.RandomState(1)
+    base = rng.normal(size=(40, 3)) * [3.0, 2.0, 1.0]
+    points = [base + rng.normal(scale=0.05, size=base.shape) for i in range(5)]
+    pairs = pairList(len(points))
+    serial = alignPairs(points, pairs, mirror=True, kernel='native')
+    parallel = alignPairsParallel(points, pairs, mirror=True, workers=2, kernel='native')
+    workDir = tempfile.mkdtemp()
+    cluster = alignPairsCluster(points, pairs, workDir, mirror=True, workers=2, chunkSize=3, kernel='native')
+    shutil.rmtree(workDir)
+    for results in [parallel, cluster]:
+      self.assertEqual(list(serial), list(results))
+      for pair in pairs:
+        self.assertEqual(serial[pair][0], results[pair][0])
+        self.assertTrue(np.array_equal(serial[pair][1], results[pair][1]))
+        self.assertTrue(np.array_equal(serial[pair][2], results[pair][2]))
+
+  def test_chunkPairs(self):
+    """ Shards must cover the pairs in order and stay small on long lists.
+    """
+    from Auto3dgmLib.correspondence import BATCH_PAIRS, pairList
+    from Auto3dgmLib.parallel import chunkPairs
+    pairs = pairList(200)
+    shards = chunkPairs(pairs, 4)
+    self.assertEqual(sum(shards, []), pairs)
+    self.assertEqual(max(len(shard) for shard in shards), BATCH_PAIRS)
+    self.assertEqual(len(chunkPairs(pairList(6), 4)), 15)
+
+  def test_progressiveRefinement(self):
+    """ Refining the coarse pairwise rotations on finer point sets must find
+    the same alignments as the full search, in every engine.
+    """
+    from Auto3dgmLib.correspondence import alignPairs, pairList
+    from Auto3dgmLib.engine import alignAllPairs
+    rng = np.random.RandomState(3)
+    base = rng.normal(size=(120, 3)) * [3.0, 2.0, 1.0]
+    fine, coarse = [], []
+    for i in range(4):
+      q = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+      q = q * np.sign(np.linalg.det(q))
+      shape = (base + rng.normal(scale=0.01, size=base.shape)) @ q.T
+      fine.append(shape[rng.permutation(120)])
+      coarse.append(shape[:30])
+    pairs = pairList(4)
+    seeds = dict((pair, result[1]) for pair, result in alignPairs(coarse, pairs, kernel='native').items())
+    full = alignPairs(fine, pairs, kernel='native')
+    seedKeys = ['coarse'] * 4
+    for processing in ['single', 'multicore', 'cluster']:
+      refined = alignAllPairs(fine, processing=processing, workers=2, seeds=seeds, seedKeys=seedKeys, kernel='native')
+      for pair in pairs:
+        self.assertAlmostEqual(refined[pair][0], full[pair][0])
+        self.assertTrue(np.array_equal(refined[pair][2], full[pair][2]))
+
+  def test_candidatePairs(self):
+    """ Candidate pairs must connect all meshes and globalize, and with every
+    mesh a neighbor of every other must give the exhaustive spanning tree.
+    """
+    from Auto3dgmLib.benchmark import benchmarkNeighbors
+    from Auto3dgmLib.correspondence import correspondenceFromPairs
+    from Auto3dgmLib.neighbors import candidatePairs
+    rng = np.random.RandomState(4)
+    points = [rng.normal(size=(40, 3)) * rng.uniform(0.5, 2.0, size=3) for i in range(12)]
+    candidates = candidatePairs(points, 2)
+    self.assertLess(len(candidates), 12 * 11 // 2)
+    self.assertEqual(candidatePairs(points, 11), candidatePairs(points, 0))
+    results = dict((pair, (1.0 + pair[1] - pair[0], np.eye(3), np.arange(40))) for pair in candidates)
+    corr = correspondenceFromPairs(12, results)
+    self.assertEqual(len(corr.globalized_alignment['r']), 12)
+    with self.assertRaises(ValueError):
+      correspondenceFromPairs(12, dict((pair, results[pair]) for pair in candidates if 0 not in pair))
+    result = benchmarkNeighbors(meshes=6, points=30, neighbors=5)
+    self.assertEqual(result['sparse_pairs'], result['exhaustive_pairs'])
+    self.assertEqual(result['shared_edges'], result['edges'])
+
+  def test_permutationIndices(self):
+    """ Permutations kept as indices must act like the permutation matrices
+    they replace: products, transposes and the globalized alignment.
+    """
+    from Auto3dgmLib.correspondence import Permutation, correspondenceFromPairs, permutationIndices, permutationMatrix
+    rng = np.random.RandomState(6)
+    points = rng.normal(size=(30, 3))
+    a, b = rng.permutation(30), rng.permutation(30)
+    for p, matrix in [(Permutation(a), permutationMatrix(a)), (Permutation(a).T, permutationMatrix(a).T)]:
+      self.assertTrue(np.array_equal(p * points, matrix * points))
+      self.assertTrue(np.array_equal(p.tocsr().toarray(), matrix.toarray()))
+    self.assertTrue(np.array_equal((Permutation(a) * Permutation(b)).tocsr().toarray(), (permutationMatrix(a) * permutationMatrix(b)).toarray()))
+    self.assertEqual(Permutation(a).indices.dtype, np.int32)
+    results = dict(((i, j), (1.0 + i + j, np.eye(3), rng.permutation(30))) for i in range(4) for j in range(i + 1, 4))
+    corr = correspondenceFromPairs(4, results)
+    for node in range(1, 4):
+      self.assertTrue(np.array_equal(permutationIndices(corr.globalized_alignment['p'][node]), results[(0, node)][2]))
+
+  def test_convergence(self):
+    """ Every engine must report the same iterations per pair, the iteration
+    limit must hold, and a tolerance must never add iterations.
+    """
+    from Auto3dgmLib.engine import alignAllPairs, convergenceStats
+    rng = np.random.RandomState(8)
+    base = rng.normal(size=(60, 3)) * [3.0, 2.0, 1.0]
+    points = rotatedCopies(base, 4, rng, noise=0.3)
+    iterations = {}
+    for processing in ['single', 'multicore', 'cluster']:
+      iterations[processing] = {}
+      alignAllPairs(points, processing=processing, workers=2, pairIterations=iterations[processing], kernel='native')
+    self.assertEqual(iterations['single'], iterations['multicore'])
+    self.assertEqual(iterations['single'], iterations['cluster'])
+    limited = {}
+    results = alignAllPairs(points, maxIter=1, pairIterations=limited, kernel='native')
+    stats = convergenceStats(limited, results, 1)
+    self.assertEqual(stats['max_iterations'], 1)
+    self.assertEqual(stats['at_iteration_limit'], len(results))
+    tolerant = {}
+    alignAllPairs(points, tolerance=0.05, pairIterations=tolerant, kernel='native')
+    for pair in tolerant:
+      self.assertLessEqual(tolerant[pair], iterations['single'][pair])
+
+  def test_mirrorPruning(self):
+    """ With reflection, pruned alignment of specimens of both handedness must
+    match the exhaustive search pair for pair with fewer iterations, and the
+    two must be stored apart.
+    """
+    from Auto3dgmLib.engine import alignAllPairs, alignmentParameters
+    rng = np.random.RandomState(9)
+    base = rng.normal(size=(60, 3)) * [3.0, 2.0, 1.0]
+    points = []
+    for i in range(6):
+      p = base + rng.normal(scale=0.2, size=base.shape)
+      if i % 2:
+        p = p * [-1, 1, 1]
+      points.append(p @ np.linalg.qr(rng.normal(size=(3, 3)))[0].T)
+    iterations = {True: {}, False: {}}
+    results = {}
+    for exhaustive in [True, False]:
+      results[exhaustive] = alignAllPairs(points, mirror=True, pairIterations=iterations[exhaustive], exhaustive=exhaustive,
+                                            kernel='native')
+    for pair in results[True]:
+      self.assertAlmostEqual(results[False][pair][0], results[True][pair][0])
+      self.assertTrue(np.array_equal(results[False][pair][2], results[True][pair][2]))
+    self.assertLess(sum(iterations[False].values()), sum(iterations[True].values()))
+    self.assertNotEqual(alignmentParameters(True, exhaustive=False, kernel='native'), alignmentParameters(True, kernel='native'))
+    self.assertEqual(alignmentParameters(False, exhaustive=False, kernel='native'), alignmentParameters(False, kernel='native'))
+    self.assertNotEqual(alignmentParameters(True), alignmentParameters(True, kernel='native'))
+
+  def test_batchedAlignment(self):
+    """ Stacked Procrustes must solve every problem like the single one, and
+    pair results must not depend on how pairs are batched.
+    """
+    from Auto3dgmLib.correspondence import alignPairs, pairList, procrustesRotation, procrustesRotations
+    rng = np.random.RandomState(10)
+    X = rng.normal(size=(5, 30, 3))
+    Z = rng.normal(size=(5, 30, 3))
+    reflect = np.array([False, True, False, True, False])
+    solved = procrustesRotations(X, Z, reflect)
+    for k in range(5):
+      self.assertTrue(np.allclose(solved[k], procrustesRotation(X[k], Z[k], reflect[k])))
+      self.assertEqual(np.linalg.det(solved[k]) < 0, reflect[k])
+    base = rng.normal(size=(40, 3)) * [3.0, 2.0, 1.0]
+    points = rotatedCopies(base, 6, rng, noise=0.3)
+    for mirror in [False, True]:
+      single = alignPairs(points, pairList(6), mirror, chunkSize=1, kernel='native')
+      batched = alignPairs(points, pairList(6), mirror, chunkSize=7, kernel='native')
+      for pair in single:
+        self.assertEqual(single[pair][0], batched[pair][0])
+        self.assertTrue(np.array_equal(single[pair][2], batched[pair][2]))
+
+  def test_batchedAgainstPerPair(self):
+    """ Batched alignment must give every pair the result of a plain per pair
+    search from auto3dgm_nazar's sign flips of the principal axes, with and
+    without reflection and from seed rotations. Without reflection every
+    rotation must be proper, even from improper starts.
+    """
+    import itertools
+    from scipy.optimize import linear_sum_assignment
+    from Auto3dgmLib.correspondence import alignPairsBatch
+    def match(X, Y, R):
+      rows, cols = linear_sum_assignment(((X[:, None, :] - (Y @ R.T)[None, :, :]) ** 2).sum(axis=2))
+      return cols[np.argsort(rows)]
+    def distance(X, Y, R, perm):
+      return np.linalg.norm(X - Y[perm] @ R.T)
+    def refine(X, Y, R, reflect):
+      perm = match(X, Y, R)
+      while True:
+        u, s, vt = np.linalg.svd(X.T @ Y[perm])
+        d = np.ones(3)
+        d[2] = np.sign(np.linalg.det(u @ vt)) * (-1.0 if reflect else 1.0)
+        R = u @ np.diag(d) @ vt
+        newPerm = match(X, Y, R)
+        if np.array_equal(newPerm, perm):
+          return distance(X, Y, R, perm), R, perm
+        perm = newPerm
+    def axes(P):
+      return np.linalg.svd(P - P.mean(axis=0), full_matrices=False)[2].T
+    def search(X, Y, mirror):
+      best = {}
+      for signs in [[1, 1, 1], [1, -1, -1], [-1, -1, 1], [-1, 1, -1], [-1, 1, 1], [1, -1, 1], [1, 1, -1], [-1, -1, -1]]:
+        even = np.prod(signs) > 0
+        if mirror or even:
+          R = axes(X) @ np.diag(signs) @ axes(Y).T
+          d = distance(X, Y, R, match(X, Y, R))
+          if even not in best or d < best[even][0]:
+            best[even] = (d, R)
+      return min((refine(X, Y, R, mirror and np.linalg.det(R) < 0) for d, R in best.values()), key=lambda result: result[0])
+    rng = np.random.RandomState(17)
+    base = rng.normal(size=(50, 3)) * [3.0, 2.0, 1.0]
+    points = rotatedCopies(base, 8, rng, noise=0.4)
+    for i in [1, 4, 6]:
+      points[i] = points[i] * [-1, 1, 1]
+    pairs = [tuple(pair) for pair in rng.permutation(list(itertools.combinations(range(8), 2)))[:12]]
+    seeds = [np.linalg.qr(rng.normal(size=(3, 3)))[0] for pair in pairs]
+    for mirror in [False, True]:
+      batched, infos = alignPairsBatch(points, pairs, mirror)
+      for (i, j), result in zip(pairs, batched):
+        expected = search(points[i], points[j], mirror)
+        self.assertAlmostEqual(result[0], expected[0], places=9)
+        self.assertTrue(np.allclose(result[1], expected[1], atol=1e-9))
+        self.assertTrue(np.array_equal(result[2], expected[2]))
+        if not mirror:
+          self.assertGreater(np.linalg.det(result[1]), 0)
+    batched, infos = alignPairsBatch(points, pairs, seeds=seeds)
+    for (i, j), seed, result in zip(pairs, seeds, batched):
+      expected = refine(points[i], points[j], seed, np.linalg.det(seed) < 0)
+      self.assertAlmostEqual(result[0], expected[0], places=9)
+      self.assertTrue(np.allclose(result[1], expected[1], atol=1e-9))
+      self.assertTrue(np.array_equal(result[2], expected[2]))
+
+
+try:
+  from auto3dgm_nazar.analysis.correspondence import Correspondence
+  from auto3dgm_nazar.mesh.meshfactory import MeshFactory
+  from auto3dgm_nazar.mesh.subsample import Subsample
+except ImportError:
+  Correspondence = None
+  Subsample = None
+
+
+def treeEdges(mst):
+  mst = mst.toarray() if hasattr(mst, 'toarray') else np.asarray(mst)
+  return set((i, j) for i, j in zip(*np.nonzero(mst)) if i < j) | set((j, i) for i, j in zip(*np.nonzero(mst)) if i > j)
+
+
+@unittest.skipIf(Correspondence is None, "auto3dgm_nazar is not available")
+class LibraryEquivalenceTest(unittest.TestCase):
+
+  def test_libraryCorrespondence(self):
+    """ Both alignment kernels must reproduce auto3dgm_nazar's Correspondence
+    on a fixed dataset: the same distance matrix and spanning tree, and the
+    same pairwise and globalized rotations.
+    """
+    from Auto3dgmLib.benchmark import centerScale
+    from Auto3dgmLib.correspondence import computeCorrespondence, permutationIndices
+    rng = np.random.RandomState(11)
+    base = rng.normal(size=(60, 3)) * [3.0, 2.0, 1.0]
+    points = [centerScale(p) for p in rotatedCopies(base, 5, rng, noise=0.05)]
+    points[3] = points[3] * [-1, 1, 1]
+    for mirror in [False, True]:
+      meshes = [MeshFactory.mesh_from_data(vertices=p, name='specimen_%d' % i) for i, p in enumerate(points)]
+      library = Correspondence(meshes=meshes, mirror=mirror)
+      for kernel in ['library', 'native']:
+        ours = computeCorrespondence(points, mirror=mirror, kernel=kernel)
+        self.assertTrue(np.allclose(ours.pairwise_alignment['d'], np.asarray(library.pairwise_alignment['d']), rtol=1e-6, atol=1e-9))
+        self.assertEqual(treeEdges(ours.mst_matrix), treeEdges(library.mst_matrix))
+        for i in range(5):
+          for j in range(5):
+            if i != j:
+              self.assertTrue(np.allclose(ours.pairwise_alignment['r'][i][j], library.pairwise_alignment['r'][i][j], atol=1e-6))
+          self.assertTrue(np.allclose(ours.globalized_alignment['r'][i], library.globalized_alignment['r'][i], atol=1e-6))
+          self.assertTrue(np.array_equal(permutationIndices(ours.globalized_alignment['p'][i]), permutationIndices(library.globalized_alignment['p'][i])))
+
+
+class FurthestPointSamplingTest(unittest.TestCase):
+
+  def test_furthestPointSampling(self):
+    """ Both furthest point sampling engines must pick the same vertices as a
+    plain loop over all vertices, also with many equally distant vertices,
+    and a seed must always give the same random start.
+    """
+    from Auto3dgmLib.fps import furthestPointIndices, mapOrdered, nestedSubsamples, sampledIndices, startIndex
+    def naive(vertices, count, start):
+      indices = [start]
+      nearest = ((vertices - vertices[indices[0]]) ** 2).sum(axis=1)
+      while len(indices) < count:
+        indices.append(int(np.argmax(nearest)))
+        nearest = np.minimum(nearest, ((vertices - vertices[indices[-1]]) ** 2).sum(axis=1))
+      return indices
+    rng = np.random.RandomState(5)
+    grid = np.stack(np.meshgrid(*[np.arange(8.0)] * 3), axis=-1).reshape(-1, 3)
+    for vertices in [rng.normal(size=(3000, 3)), grid]:
+      for start in [0, 123, startIndex(vertices, 7)]:
+        expected = naive(vertices, 100, start)
+        for method in ['dense', 'kdtree']:
+          self.assertEqual(list(furthestPointIndices(vertices, 100, method=method, start=start)), expected)
+      self.assertEqual(list(furthestPointIndices(vertices, 100, seed=7)), naive(vertices, 100, startIndex(vertices, 7)))
+    self.assertEqual(furthestPointIndices(grid, 5, seed=7)[0], np.random.RandomState(7).randint(len(grid)))
+    np.random.seed(3)
+    unseeded = furthestPointIndices(grid, 5)
+    self.assertEqual(unseeded[0], np.random.RandomState(3).randint(len(grid)))
+    indices = furthestPointIndices(grid, 100, seed=7)
+    self.assertEqual(list(furthestPointIndices(grid, 30, seed=7)), list(indices[:30]))
+    nested = nestedSubsamples(grid, indices, [30, 100])
+    self.assertTrue(np.array_equal(nested[30], grid[indices[:30]]))
+    self.assertTrue(np.shares_memory(nested[30], nested[100]))
+    self.assertEqual(list(sampledIndices(grid, grid[indices])), list(indices))
+    with self.assertRaises(ValueError):
+      furthestPointIndices(grid, len(grid) + 1)
+    self.assertEqual(list(mapOrdered(lambda x: x * x, range(20), workers=4)), [x * x for x in range(20)])
+
+  @unittest.skipIf(Subsample is None, "auto3dgm_nazar is not available")
+  def test_librarySampling(self):
+    """ Unseeded sampling must start where auto3dgm_nazar's Subsample starts
+    for the same numpy random state and pick the same vertices after it.
+    """
+    from Auto3dgmLib.fps import furthestPointIndices, sampledIndices
+    rng = np.random.RandomState(13)
+    for vertices in [rng.normal(size=(2000, 3)) * [3.0, 2.0, 1.0], rng.uniform(size=(500, 3))]:
+      mesh = MeshFactory.mesh_from_data(vertices=vertices, name='specimen')
+      np.random.seed(21)
+      ss = Subsample(pointNumber=[50], meshes=[mesh], seed={}, center_scale=False)
+      sampled = list(ss.ret[50]['output']['output'].values())[0]
+      library = sampledIndices(vertices, np.asarray(sampled.vertices))
+      np.random.seed(21)
+      self.assertEqual(list(furthestPointIndices(vertices, 50)), list(library))
+      for method in ['dense', 'kdtree']:
+        self.assertEqual(list(furthestPointIndices(vertices, 50, method=method, start=library[0])), list(library))
+
+
+class MeshLoadingTest(unittest.TestCase):
+
+  def test_streamedMeshes(self):
+    """ Streamed meshes must come back in file order with no more than the
+    prefetch depth plus two of them loaded at once.
+    """
+    from Auto3dgmLib.streaming import StreamedMeshes, meshFiles
+    folder = tempfile.mkdtemp()
+    for i in range(12):
+      open(os.path.join(folder, 'specimen_%02d.ply' % i), 'w').close()
+    open(os.path.join(folder, 'notes.txt'), 'w').close()
+    files = meshFiles(folder)
+    self.assertEqual([f.name for f in files], ['specimen_%02d' % i for i in range(12)])
+
+    class Loaded(np.ndarray):
+      pass
+    alive = []
+    def load(meshFile):
+      mesh = np.full(3, float(meshFile.name[-2:])).view(Loaded)
+      alive.append(weakref.ref(mesh))
+      return mesh
+    meshes = StreamedMeshes(files, load, depth=3)
+    peak = 0
+    for i, mesh in enumerate(meshes):
+      self.assertEqual(mesh[0], i)
+      peak = max(peak, sum(1 for ref in alive if ref() is not None))
+      del mesh
+    self.assertLessEqual(peak, 3 + 2)
+    self.assertEqual(meshes[5][0], 5)
+    shifted = meshes.map(lambda index, mesh: mesh + index)
+    self.assertEqual([m[0] for m in shifted], [2 * i for i in range(12)])
+    shutil.rmtree(folder)
+
+  def test_meshCache(self):
+    """ A second load must read every mesh back from the cache, except for
+    files whose size or mtime changed.
+    """
+    from Auto3dgmLib.meshcache import MeshArrayCache, loadMeshArrays
+    from Auto3dgmLib.streaming import meshFiles
+    folder = tempfile.mkdtemp()
+    meshFolder = os.path.join(folder, 'meshes')
+    os.makedirs(meshFolder)
+    for i in range(6):
+      with open(os.path.join(meshFolder, 'specimen_%d.ply' % i), 'w') as f:
+        f.write(str(i))
+    parsed = []
+    def parse(meshFile):
+      parsed.append(meshFile.name)
+      with open(meshFile.path) as f:
+        value = float(f.read())
+      return np.full((4, 3), value), np.arange(6).reshape(2, 3)
+
+    cache = MeshArrayCache(os.path.join(folder, 'cache'))
+    first = loadMeshArrays(meshFiles(meshFolder), parse, cache, workers=3)
+    self.assertFalse(os.path.exists(cache.indexPath))
+    cache.flush()
+    self.assertEqual(len(parsed), 6)
+    with open(os.path.join(meshFolder, 'specimen_2.ply'), 'w') as f:
+      f.write('20')
+    parsed = []
+    cache = MeshArrayCache(os.path.join(folder, 'cache'))
+    second = loadMeshArrays(meshFiles(meshFolder), parse, cache, workers=3)
+    self.assertEqual(parsed, ['specimen_2'])
+    self.assertIsInstance(second[0][0], np.memmap)
+    for i in range(6):
+      self.assertTrue(np.array_equal(second[i][0], np.full((4, 3), 20 if i == 2 else i)))
+      self.assertTrue(np.array_equal(first[i][1], second[i][1]))
+    shutil.rmtree(folder)
+
+  def test_streamedMeshCache(self):
+    """ A streamed pass must write the cache index when it ends, so a new
+    cache reads the meshes back without parsing them.
+    """
+    from Auto3dgmLib.meshcache import MeshArrayCache, cachedArrays
+    from Auto3dgmLib.streaming import StreamedMeshes, meshFiles
+    folder = tempfile.mkdtemp()
+    meshFolder = os.path.join(folder, 'meshes')
+    os.makedirs(meshFolder)
+    for i in range(5):
+      with open(os.path.join(meshFolder, 'specimen_%d.ply' % i), 'w') as f:
+        f.write(str(i))
+    parsed = []
+    def parse(meshFile):
+      parsed.append(meshFile.name)
+      return np.full((4, 3), float(meshFile.name[-1])), np.arange(6).reshape(2, 3)
+
+    def streamed(cache):
+      return StreamedMeshes(meshFiles(meshFolder), lambda meshFile: cachedArrays(meshFile, parse, cache), finish=cache.flush)
+    cache = MeshArrayCache(os.path.join(folder, 'cache'))
+    self.assertEqual(len(list(streamed(cache))), 5)
+    self.assertTrue(os.path.exists(cache.indexPath))
+    parsed = []
+    cache = MeshArrayCache(os.path.join(folder, 'cache'))
+    for i, (vertices, faces) in enumerate(streamed(cache)):
+      self.assertTrue(np.array_equal(vertices, np.full((4, 3), i)))
+    self.assertEqual(parsed, [])
+    self.assertEqual(cache.report()['hits'], 5)
+    shutil.rmtree(folder)
+
+
+class SubsampleCacheTest(unittest.TestCase):
+
+  def test_eviction(self):
+    """ The cache must stay within its budget by dropping the least recently
+    used entries, and its running total must match the folder.
+    """
+    from Auto3dgmLib.cache import SubsampleCache
+    folder = tempfile.mkdtemp()
+    cache = SubsampleCache(folder, maxBytes=5 * (100 * 3 * 8 + 128))
+    for i in range(8):
+      cache.put('key%d' % i, np.full((100, 3), float(i)))
+      if i == 3:
+        self.assertIsNotNone(cache.get('key0'))
+    self.assertTrue(np.array_equal(cache.get('key0'), np.zeros((100, 3))))
+    for i in [1, 2, 3]:
+      self.assertIsNone(cache.get('key%d' % i))
+    self.assertEqual(cache.evictions, 3)
+    self.assertEqual(cache.totalBytes, cache.report()['bytes'])
+    self.assertLessEqual(cache.totalBytes, cache.maxBytes)
+    cache.put('key7', np.zeros((100, 3)))
+    self.assertEqual(cache.totalBytes, cache.report()['bytes'])
+    shutil.rmtree(folder)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+  @unittest.skipIf(not os.path.exists('/proc/self/statm'), "needs /proc/self/statm")
+  def test_stageMemory(self):
+    """ Stage memory must show what a stage allocated while it ran, even
+    once freed, and a later small stage must not inherit it the way the
+    lifetime process peak does.
+    """
+    import time
+    from Auto3dgmLib.instrument import Instrumentation
+    instrumentation = Instrumentation()
+    with instrumentation.stage('large'):
+      data = np.ones(200 * 1024 * 1024 // 8)
+      time.sleep(0.2)
+      del data
+    with instrumentation.stage('small'):
+      np.ones(1000).sum()
+    large, small = instrumentation.records
+    self.assertGreater(large['stage_rss_mb'], 150)
+    self.assertLess(small['stage_rss_mb'], 50)
+    self.assertGreater(small['process_peak_rss_mb'], 150)
+    self.assertEqual(instrumentation.summaryRows()[0][3], large['stage_rss_mb'])
+
+
+class ExportTest(unittest.TestCase):
+
+  def test_batchedExport(self):
+    """ Gathered landmarks must equal the sparse permutation product and the
+    written PLY files must hold the rotated vertices, at full precision
+    unless binary float32 output is asked for, and the faces.
+    """
+    from Auto3dgmLib.benchmark import syntheticAlignment, syntheticMeshes
+    from Auto3dgmLib.export import alignedLandmarks, exportMeshes, readPly
+    meshes = syntheticMeshes(4, 300)
+    rotations, permutations = syntheticAlignment(4, 300, 40)
+    landmarks = alignedLandmarks([mesh.vertices for mesh in meshes], rotations, permutations)
+    for mesh, r, p, l in zip(meshes, rotations, permutations, landmarks):
+      self.assertLess(np.abs(l - p * (mesh.vertices @ r.T)).max(), 1e-12)
+    folder = tempfile.mkdtemp()
+    rotated = meshes[2].vertices @ rotations[2].T
+    exportMeshes(meshes, rotations, folder, workers=2)
+    vertices, faces = readPly(os.path.join(folder, meshes[2].name + '.ply'))
+    self.assertTrue(np.array_equal(vertices, rotated))
+    self.assertTrue(np.array_equal(faces, meshes[2].faces))
+    exportMeshes(meshes, rotations, folder, workers=2, format='binary')
+    with open(os.path.join(folder, meshes[2].name + '.ply'), 'rb') as f:
+      body = f.read().split(b'end_header\n', 1)[1]
+    vertices = np.frombuffer(body[:300 * 12], dtype='<f4').reshape(-1, 3)
+    faces = np.frombuffer(body[300 * 12:], dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+    self.assertLess(np.abs(vertices - rotated).max(), 1e-6)
+    self.assertTrue(np.array_equal(faces['v'], meshes[2].faces))
+    shutil.rmtree(folder)
+
+  def test_landmarkArchive(self):
+    """ An NPY landmark archive must read back memory mapped, with rotations
+    and landmark indices that reproduce the landmarks.
+    """
+    from Auto3dgmLib.benchmark import syntheticAlignment, syntheticMeshes
+    from Auto3dgmLib.export import alignedLandmarks, readLandmarkArchive, writeLandmarkArchive
+    meshes = syntheticMeshes(5, 300)
+    rotations, permutations = syntheticAlignment(5, 300, 40)
+    landmarks = alignedLandmarks([mesh.vertices for mesh in meshes], rotations, permutations)
+    folder = tempfile.mkdtemp()
+    writeLandmarkArchive(folder, [mesh.name for mesh in meshes], landmarks, rotations, permutations, format='npy')
+    archive = readLandmarkArchive(folder)
+    self.assertIsInstance(archive['landmarks'], np.memmap)
+    self.assertEqual(archive['landmarks'].shape, (5, 40, 3))
+    self.assertEqual(archive['specimens'], [mesh.name for mesh in meshes])
+    for i, mesh in enumerate(meshes):
+      self.assertTrue(np.array_equal(archive['landmarks'][i], landmarks[i]))
+      rebuilt = mesh.vertices[archive['permutations'][i]] @ archive['rotations'][i].T
+      self.assertLess(np.abs(rebuilt - landmarks[i]).max(), 1e-12)
+    del archive
+    shutil.rmtree(folder)
+
+  def test_viewerAssets(self):
+    """ Viewer meshes must be decimated to the face budget, made once per
+    phase and remade only for meshes exported again.
+    """
+    from Auto3dgmLib.benchmark import syntheticSpecimens
+    from Auto3dgmLib.export import readPly, writePly
+    from Auto3dgmLib.viewer import buildViewerAssets, showViewerAssets
+    outputFolder = tempfile.mkdtemp(prefix='auto3dgm_test_')
+    viewerFolder = os.path.join(outputFolder, 'viewer_tmp')
+    alignedFolder = os.path.join(outputFolder, 'phase1', 'aligned_meshes')
+    os.makedirs(viewerFolder)
+    os.makedirs(alignedFolder)
+    try:
+      for mesh in syntheticSpecimens(3, 5000):
+        writePly(os.path.join(alignedFolder, mesh.name + '.ply'), mesh.vertices, mesh.faces)
+      assetFolder = os.path.join(outputFolder, 'viewer', 'phase1')
+      self.assertEqual(buildViewerAssets(alignedFolder, assetFolder, 1000), 3)
+      self.assertEqual(buildViewerAssets(alignedFolder, assetFolder, 1000), 0)
+      showViewerAssets(assetFolder, viewerFolder)
+      shown = sorted(os.listdir(viewerFolder))
+      self.assertEqual(shown, sorted(os.listdir(alignedFolder)))
+      for name in shown:
+        vertices, faces = readPly(os.path.join(viewerFolder, name))
+        self.assertTrue(0 < len(faces) <= 1000)
+        self.assertLess(faces.max(), len(vertices))
+      os.utime(os.path.join(alignedFolder, shown[0]), (0, 0))
+      self.assertEqual(buildViewerAssets(alignedFolder, assetFolder, 1000), 1)
+    finally:
+      shutil.rmtree(outputFolder)
+
+
+class ProjectTest(unittest.TestCase):
+
+  def test_project(self):
+    """ A saved project must give back the same pairwise and globalized
+    alignments and subsamples.
+    """
+    from Auto3dgmLib.correspondence import computeCorrespondence, permutationIndices
+    from Auto3dgmLib.project import Project, writeProject
+    rng = np.random.RandomState(2)
+    base = rng.normal(size=(50, 3)) * [3.0, 2.0, 1.0]
+    points = [base[rng.permutation(50)] + rng.normal(scale=0.01, size=base.shape) for i in range(5)]
+    corr = computeCorrespondence(points, mirror=True, kernel='native')
+    folder = os.path.join(tempfile.mkdtemp(), 'project')
+    specimens = [{'name': 'specimen_%d' % i, 'path': None} for i in range(5)]
+    writeProject(folder, {'mirror': True}, specimens, {50: points}, {1: corr})
+    project = Project(folder)
+    self.assertEqual(project.parameters, {'mirror': True})
+    self.assertTrue(np.array_equal(project.subsample(50), np.array(points)))
+    loaded = project.correspondence(1)
+    self.assertTrue(np.array_equal(loaded.pairwise_alignment['d'], corr.pairwise_alignment['d']))
+    for i in range(5):
+      for j in range(5):
+        if i == j:
+          continue
+        self.assertTrue(np.allclose(loaded.pairwise_alignment['r'][i][j], corr.pairwise_alignment['r'][i][j]))
+        self.assertTrue(np.array_equal(permutationIndices(loaded.pairwise_alignment['p'][i][j]), permutationIndices(corr.pairwise_alignment['p'][i][j])))
+      self.assertTrue(np.allclose(loaded.globalized_alignment['r'][i], corr.globalized_alignment['r'][i]))
+      self.assertTrue(np.array_equal(permutationIndices(loaded.globalized_alignment['p'][i]), permutationIndices(corr.globalized_alignment['p'][i])))
+    del project, loaded
+    shutil.rmtree(os.path.dirname(folder))
+
+
+if __name__ == '__main__':
+  unittest.main()